@@ -3,16 +3,22 @@ This module provides a class for interacting with the Boardroom API and handling
 
 The BoardroomAPI class offers methods to retrieve and process data from the Boardroom API,
 specifically for DAO forums. It includes functionality
-to fetch forum data, protocol data, and standardize URLs.
+to fetch forum data, protocol data, and standardize URLs. Forum topics can be fetched
+several at once under a rate limit shared by every thread.
 
 Note: This module requires the proper configuration of environment variables for Boardroom API access.
 """
 
+import json
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 import sys, os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
+from concurrent_fetch import RateLimiter, retry_delay, fetch_concurrently
+from response_archive import ArchiveMiss
+
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -29,13 +35,29 @@ class BoardroomAPI:
     Attributes:
         key (str): The API key for accessing the Boardroom API.
         forum_url_map (dict): A mapping of DAO protocols to their forum URLs.
+        archive (ResponseArchive): Archive the responses are recorded to or replayed from, None to only use the network.
+        workers (int): Number of forum topics fetched at once.
     """
+    # Number of times a rate limited request is retried
+    MAX_RETRIES = 5
 
-    def __init__(self) -> None:
+    def __init__(self, archive=None, requests_per_second=2.0, workers=4) -> None:
         """
         Initializes the BoardroomAPI instance with the API key and forum URL mappings.
+
+        Args:
+            archive (ResponseArchive, optional): Archive to record the responses to, or to replay them from without the network.
+            requests_per_second (float, optional): Requests sent per second over all threads.
+            workers (int, optional): Number of forum topics fetched at once.
         """
         self.key = BOARDROOM_API_KEY
+        self.archive = archive
+        self.workers = workers
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.forum_url_map = {
             "optimism": "https://gov.optimism.io/t/",
             "arbitrum": "https://forum.arbitrum.foundation/t/",
@@ -43,6 +65,42 @@ class BoardroomAPI:
             "nounsdao": "https://discourse.nouns.wtf/t/"
         }
 
+    def get(self, endpoint, url, params):
+        """
+        Sends a GET request within the rate limit, recording its response to the archive or replaying it from there.
+
+        A 429 response pauses every thread for the Retry-After delay before the request is sent again.
+        The request is archived under its endpoint and parameters, the API key is left out.
+
+        Args:
+            endpoint (str): The API endpoint.
+            url (str): The URL of the endpoint, with the API key.
+            params (dict): Query parameters for the API request.
+
+        Returns:
+            requests.Response: The response, a 404 when replaying a request that was never recorded.
+        """
+        if self.archive is not None and self.archive.replay:
+            response = requests.Response()
+            try:
+                response._content = json.dumps(self.archive.lookup('boardroom', endpoint, params)).encode()
+                response.status_code = 200
+            except ArchiveMiss as e:
+                response._content = str(e).encode()
+                response.status_code = 404
+            return response
+
+        for attempt in range(self.MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            response = self.session.get(url, params=params)
+            if response.status_code == 200 and self.archive is not None:
+                self.archive.record('boardroom', endpoint, dict(params), response.json())
+            if response.status_code != 429 or attempt == self.MAX_RETRIES:
+                return response
+            retry_after = retry_delay(response, attempt)
+            print(f"Rate limited. Waiting for {retry_after} seconds...")
+            self.rate_limiter.pause(retry_after)
+
     def get_boardroom_data(self, endpoint, key, params, pages=5):
         """
         Retrieves data from the Boardroom API and returns it as a pandas DataFrame.
@@ -54,34 +112,34 @@ class BoardroomAPI:
             pages (int, optional): Number of pages to retrieve. Defaults to 5.
 
         Returns:
-            pandas.DataFrame: A DataFrame containing the data retrieved from the Boardroom API.
+            pandas.DataFrame: A DataFrame containing the data retrieved from the Boardroom API, None if no page was retrieved.
         """
         boardroom_url = f"https://api.boardroom.info/v1/{endpoint}?key={key}"
 
         next_cursor = None
-        df = None
+        pages_data = []
+        records = 0
 
         try:
             for i in range(pages):
                 if (next_cursor):
                     params['cursor'] = next_cursor
-                response = requests.get(boardroom_url, params=params)
+                response = self.get(endpoint, boardroom_url, params)
                 if response.status_code == 200:
                     json_data = response.json()
                     data = json_data['data']
                     next_cursor = json_data['nextCursor'] if 'nextCursor' in json_data else None
-                    if i == 0:
-                        df = pd.DataFrame(data)
-                    else:
-                        df = pd.concat([df, pd.DataFrame(data)])
-                    print(f"Page {i+1} retrieved, {len(df)} records in total")
+                    pages_data.append(pd.DataFrame(data))
+                    records += len(data)
+                    print(f"Page {i+1} retrieved, {records} records in total")
                     if not next_cursor:
                         break
                 else:
                     print(f"Failed to retrieve data: {response.status_code}")
         except Exception as e:
             print(f"Failed to retrieve data: {str(e)}")
-        return df
+        # The pages are concatenated once, instead of copying the frame again for every page
+        return pd.concat(pages_data) if pages_data else None
     
     def get_discourse_data(self, params, pages=5, export_csv=True):
         """
@@ -117,6 +175,23 @@ class BoardroomAPI:
             protocol_df.to_csv("local/boardroom/br_protocols.csv", index=True)
         return protocol_df
     
+    def fetch_topics(self, topics):
+        """
+        Fetches several forum topics at once, within the rate limit shared by every thread.
+
+        Args:
+            topics (iterable): (protocol, topic_id) tuples of the topics to fetch.
+
+        Yields:
+            tuple: The (protocol, topic_id) tuple and a DataFrame of the topic's data, empty if Boardroom does not
+            know the topic and None if it could not be retrieved, in completion order.
+        """
+        def fetch_topic(topic):
+            protocol, topic_id = topic
+            return self.get_boardroom_data("discourseTopics", self.key, {"protocol": protocol, "topicId": topic_id})
+
+        yield from fetch_concurrently(fetch_topic, topics, self.workers)
+
     def to_url(self, protocol, slug, topic_id):
         """
         Constructs a forum URL from protocol, slug, and topic ID.
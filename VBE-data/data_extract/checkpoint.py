@@ -0,0 +1,310 @@
+"""
+checkpoint.py
+
+This module records the progress of the API extractors, so a run that stops halfway resumes where it stopped.
+
+The checkpoints are kept in a local SQLite file. After each page of votes is written, the cursor to the next
+page, the number of rows written for the proposal and, for CSV outputs, the size of the file are saved in one
+transaction. A restart first truncates a CSV output to the rows written before the last checkpoint, then fetches each
+unfinished proposal from its saved cursor. The votes table needs no rollback, votes of a page fetched again that were
+stored before are skipped by DatabaseHandler.copy_upsert.
+
+The same file indexes the proposals that already have votes in each output. The index is built once from the
+output and then kept up to date as proposals are written, so runs do not read the votes to skip them.
+
+Proposals are discovered from a per DAO watermark, the cursor after the last page of proposals written. The
+proposals of a page are registered as pending in the same transaction that moves the watermark past them.
+
+Key features:
+- Per DAO watermark of the proposals discovered
+- Per proposal cursor, row count and completion flag
+- Per DAO proposal count and completion flag
+- Rollback of rows written to a CSV file after the last checkpoint
+- Index of the proposals already in the output
+
+Example usage:
+    store = CheckpointStore('Snapshot', output=output_name(csv_path='../data_output/votes.csv'))
+    store.rollback(csv_path='../data_output/votes.csv')
+    store.index_ingested(lambda: loader.load_table('ingestion', 'votes', distinct=True)['proposal_id'])
+    for proposals, cursor in api.iter_proposal_pages(dao_id, store.watermark(dao_id)):
+        store.save_discovered(dao_id, [proposal['id'] for proposal in proposals], cursor)
+    for proposal_id, cursor in store.pending_proposals(dao_id).items():
+        ...
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_output', 'checkpoints.sqlite')
+# Number of proposal IDs looked up in the index per query, below SQLite's limit on query parameters
+LOOKUP_BATCH = 500
+
+
+def output_name(sql_handler=None, csv_path=None):
+    """
+    Names the votes output the ingested proposals are indexed for.
+
+    Args:
+        sql_handler (DatabaseHandler, optional): The database the votes are written to.
+        csv_path (str, optional): The CSV file the votes are written to.
+
+    Returns:
+        str: The absolute CSV path, or the database's host, port and name.
+    """
+    if csv_path is not None:
+        return os.path.abspath(csv_path)
+    return "postgresql://{host}:{port}/{database}".format(**sql_handler.config)
+
+
+class CheckpointStore:
+    """
+    Progress of one platform's extraction, shared by the fetch threads.
+
+    Attributes:
+        platform (str): The platform extracted, e.g. 'Snapshot' or 'Tally'.
+        path (str): The SQLite file the checkpoints are kept in.
+        output (str): The votes output, a CSV path or a database, whose ingested proposals are indexed.
+    """
+    def __init__(self, platform, path=DEFAULT_PATH, output='votes'):
+        self.platform = platform
+        self.path = path
+        self.output = output
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS proposal_progress (
+                    platform TEXT,
+                    proposal_id TEXT,
+                    dao_id TEXT,
+                    cursor TEXT,
+                    rows INTEGER,
+                    completed INTEGER,
+                    updated_at TEXT,
+                    PRIMARY KEY (platform, proposal_id)
+                );
+                CREATE TABLE IF NOT EXISTS dao_progress (
+                    platform TEXT,
+                    dao_id TEXT,
+                    proposals INTEGER,
+                    completed INTEGER,
+                    updated_at TEXT,
+                    PRIMARY KEY (platform, dao_id)
+                );
+                CREATE TABLE IF NOT EXISTS dao_watermarks (
+                    platform TEXT,
+                    dao_id TEXT,
+                    cursor TEXT,
+                    updated_at TEXT,
+                    PRIMARY KEY (platform, dao_id)
+                );
+                CREATE TABLE IF NOT EXISTS csv_progress (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS ingested_outputs (
+                    output TEXT PRIMARY KEY,
+                    indexed_at TEXT
+                );
+                CREATE TABLE IF NOT EXISTS ingested_proposals (
+                    output TEXT,
+                    proposal_id TEXT,
+                    PRIMARY KEY (output, proposal_id)
+                ) WITHOUT ROWID;
+            """)
+
+    def _query(self, query, params=()):
+        with self._lock:
+            return self._connection.execute(query, params).fetchall()
+
+    def index_ingested(self, load_proposal_ids, rebuild=False):
+        """
+        Builds the index of the proposals already in the output, the first time the output is used.
+
+        Args:
+            load_proposal_ids (callable): Returns the IDs of the proposals with votes in the output, only called to build the index.
+            rebuild (bool, optional): Build the index again, e.g. after the output was changed by another program.
+        """
+        if not rebuild and self._query("SELECT 1 FROM ingested_outputs WHERE output = ?", (self.output,)):
+            return
+        proposal_ids = {str(proposal_id) for proposal_id in load_proposal_ids() if proposal_id is not None}
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM ingested_proposals WHERE output = ?", (self.output,))
+            self._connection.executemany(
+                "INSERT INTO ingested_proposals (output, proposal_id) VALUES (?, ?)",
+                ((self.output, proposal_id) for proposal_id in proposal_ids),
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO ingested_outputs (output, indexed_at) VALUES (?, ?)",
+                (self.output, datetime.now().isoformat()),
+            )
+        print(f"Indexed {len(proposal_ids)} proposals with votes in {self.output}")
+
+    def ingested_proposals(self, proposal_ids):
+        """
+        Looks up which of the given proposals already have votes in the output.
+
+        Args:
+            proposal_ids (iterable): The IDs of the proposals to look up.
+
+        Returns:
+            set: The IDs found in the index.
+        """
+        proposal_ids = [str(proposal_id) for proposal_id in proposal_ids]
+        ingested = set()
+        for start in range(0, len(proposal_ids), LOOKUP_BATCH):
+            batch = proposal_ids[start:start + LOOKUP_BATCH]
+            rows = self._query(
+                f"SELECT proposal_id FROM ingested_proposals WHERE output = ? AND proposal_id IN ({', '.join('?' * len(batch))})",
+                (self.output, *batch),
+            )
+            ingested.update(proposal_id for proposal_id, in rows)
+        return ingested
+
+    def incomplete_proposals(self, dao_id=None):
+        """
+        Returns the proposals whose votes were not all written yet.
+
+        Args:
+            dao_id (str, optional): Only return the proposals of this DAO.
+
+        Returns:
+            dict: Number of rows written and cursor to the next page, None to start at the first page, by proposal ID.
+                Interrupted proposals come first, then the others in the order they were discovered.
+        """
+        query = "SELECT proposal_id, rows, cursor FROM proposal_progress WHERE platform = ? AND completed = 0"
+        params = (self.platform,)
+        if dao_id is not None:
+            query += " AND dao_id = ?"
+            params += (dao_id,)
+        rows = self._query(query + " ORDER BY rows = 0 AND cursor = 'null', rowid", params)
+        return {proposal_id: (row_count, json.loads(cursor)) for proposal_id, row_count, cursor in rows}
+
+    def pending_proposals(self, dao_id):
+        """
+        Selects the proposals of a DAO whose votes still have to be fetched.
+
+        Args:
+            dao_id (str): The ID of the DAO.
+
+        Returns:
+            dict: Cursor to start fetching from, None to start at the first page, by proposal ID. Interrupted proposals come first.
+        """
+        incomplete = self.incomplete_proposals(dao_id)
+        resumed = sum(1 for row_count, cursor in incomplete.values() if row_count or cursor is not None)
+        if resumed:
+            print(f"Resuming {resumed} interrupted {self.platform} proposals of {dao_id}")
+        return {proposal_id: cursor for proposal_id, (_, cursor) in incomplete.items()}
+
+    def watermark(self, dao_id):
+        """Returns the cursor after the last page of a DAO's proposals discovered, None before the first page."""
+        rows = self._query("SELECT cursor FROM dao_watermarks WHERE platform = ? AND dao_id = ?", (self.platform, dao_id))
+        return json.loads(rows[0][0]) if rows else None
+
+    def save_discovered(self, dao_id, proposal_ids, cursor, advance=True):
+        """
+        Registers a page of discovered proposals and moves the DAO's watermark past it, in one transaction.
+
+        Proposals already in the output or already registered are left as they are, the others are pending.
+
+        Args:
+            dao_id (str): The ID of the DAO.
+            proposal_ids (iterable): The IDs of the page's proposals, once they are written to the output.
+            cursor: The cursor after the page, JSON serializable.
+            advance (bool, optional): Whether to move the watermark, False keeps the page to be discovered again on the
+                next run, e.g. while some of its proposals are still open.
+        """
+        proposal_ids = [str(proposal_id) for proposal_id in proposal_ids]
+        ingested = self.ingested_proposals(proposal_ids)
+        now = datetime.now().isoformat()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO proposal_progress (platform, proposal_id, dao_id, cursor, rows, completed, updated_at) VALUES (?, ?, ?, 'null', 0, 0, ?)",
+                ((self.platform, proposal_id, dao_id, now) for proposal_id in proposal_ids if proposal_id not in ingested),
+            )
+            if advance:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO dao_watermarks (platform, dao_id, cursor, updated_at) VALUES (?, ?, ?, ?)",
+                    (self.platform, dao_id, json.dumps(cursor), now),
+                )
+
+    def save_page(self, proposal_id, dao_id, cursor, rows, csv_path=None):
+        """
+        Records a page of votes once it is written.
+
+        Args:
+            proposal_id (str): The ID of the proposal.
+            dao_id (str): The ID of the proposal's DAO.
+            cursor: The cursor to the next page, JSON serializable, or None when this was the last page.
+            rows (int): Number of rows written from this page.
+            csv_path (str, optional): The CSV file the rows were appended to, its size is recorded as well.
+        """
+        now = datetime.now().isoformat()
+        with self._lock, self._connection:
+            self._connection.execute("""
+                INSERT INTO proposal_progress (platform, proposal_id, dao_id, cursor, rows, completed, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (platform, proposal_id) DO UPDATE SET
+                    cursor = excluded.cursor,
+                    rows = proposal_progress.rows + excluded.rows,
+                    completed = excluded.completed,
+                    updated_at = excluded.updated_at
+            """, (self.platform, proposal_id, dao_id, json.dumps(cursor), rows, int(cursor is None), now))
+            if cursor is None:
+                self._connection.execute(
+                    "INSERT OR IGNORE INTO ingested_proposals (output, proposal_id) VALUES (?, ?)",
+                    (self.output, proposal_id),
+                )
+            if csv_path is not None:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO csv_progress (path, size) VALUES (?, ?)",
+                    (os.path.abspath(csv_path), os.path.getsize(csv_path) if os.path.exists(csv_path) else 0),
+                )
+
+    def start_dao(self, dao_id, proposal_count):
+        """Records that the votes of a DAO's proposals are being fetched."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO dao_progress (platform, dao_id, proposals, completed, updated_at) VALUES (?, ?, ?, 0, ?)",
+                (self.platform, dao_id, proposal_count, datetime.now().isoformat()),
+            )
+
+    def finish_dao(self, dao_id):
+        """
+        Marks a DAO completed when the votes of all of its proposals were written.
+
+        Args:
+            dao_id (str): The ID of the DAO.
+
+        Returns:
+            bool: Whether the DAO is completed.
+        """
+        completed = not self.incomplete_proposals(dao_id)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE dao_progress SET completed = ?, updated_at = ? WHERE platform = ? AND dao_id = ?",
+                (int(completed), datetime.now().isoformat(), self.platform, dao_id),
+            )
+        return completed
+
+    def rollback(self, csv_path):
+        """
+        Removes the votes written to a CSV file after the last checkpoint, so interrupted proposals resume without
+        duplicates.
+
+        Args:
+            csv_path (str): The votes CSV file to roll back.
+        """
+        rows = self._query("SELECT size FROM csv_progress WHERE path = ?", (os.path.abspath(csv_path),))
+        if rows and os.path.exists(csv_path) and os.path.getsize(csv_path) > rows[0][0]:
+            print(f"Removing {os.path.getsize(csv_path) - rows[0][0]} bytes written to {csv_path} after the last checkpoint")
+            if rows[0][0] == 0:
+                # The header is written again with the next rows
+                os.remove(csv_path)
+            else:
+                with open(csv_path, 'r+b') as f:
+                    f.truncate(rows[0][0])
@@ -5,6 +5,7 @@ This module performs clustering analysis on DAO proposal, voting data, and categ
 import ast
 import os
 import re
+import sys
 import pandas as pd
 import numpy as np
 from sklearn.preprocessing import StandardScaler
@@ -13,6 +14,14 @@ from sklearn.decomposition import PCA
 import database as db
 from scipy.stats import entropy
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../VBE-library/vbe'))
+from choice_encoding import encode_choice_positions
+from result_sink import ResultSink
+from vote_cache import VoteCache
+from vote_data import VoteDataLoader
+from vote_index import VoteIndex
+from vote_matrix import VoteMatrixBuilder, SlidingWindowMatrix
+
 
 class DataProcessor:
     @staticmethod
@@ -22,43 +31,18 @@ class DataProcessor:
         return dao_df.drop_duplicates()
     
     @staticmethod
-    def merge_data(window_df, voter_df):
+    def merge_data(window_df, window_matrix, start):
         if len(window_df['proposal_id'].unique()) != 5:
-            print("Stopping, proposal window smaller than 10")
+            print("Stopping, proposal window smaller than 5")
             return None
 
         proposal_id_list = window_df['proposal_id'].unique()
         # print("Proposal ID List: ", proposal_id_list)
-        mask = voter_df['proposal_id'].isin(proposal_id_list)
-        voter_df = voter_df[mask]
-        if len(voter_df) == 0:
+        # Voters are represented on every proposal in the window, skipped proposals are 0
+        training_df = window_matrix.build(start)
+        if training_df is None:
             print("Stopping, no votes for proposals in window", proposal_id_list)
             return None
-        voter_df.to_csv('data_output/sample_choice_DELETE.csv', index=False)
-        
-        # Make sure all voters are represented even if they don't vote on a proposal
-        unique_voter_proposals = pd.MultiIndex.from_product([voter_df['voter_address'].unique(), window_df['proposal_id'].unique()], names=['voter_address', 'proposal_id']).to_frame(index=False)
-        new_voter_df = pd.merge(unique_voter_proposals, voter_df, how='left', on=['voter_address', 'proposal_id'])
-        new_voter_df['choice_position'] = new_voter_df['choice_position'].fillna(0)
-        new_voter_df['voting_power'] = pd.to_numeric(new_voter_df['voting_power'], errors='coerce')
-        new_voter_df.to_csv('data_output/sample_choice_DELETE.csv', index=False)
-
-        grouped = new_voter_df.groupby('voter_address')['voting_power']
-
-        def fill_voting_power(series):
-            mean_value = series.mean(skipna=True)  
-            return series.fillna(mean_value)
-        
-        transformed_voting_power = grouped.transform(fill_voting_power)
-        new_voter_df['voting_power'] = transformed_voting_power
-        new_voter_df['voting_power'] = new_voter_df.groupby('voter_address')['voting_power'].transform(lambda x: x.fillna(x.mean()))
-
-        training_df = pd.pivot_table(new_voter_df, values=['choice_position'], index=['voter_address', 'voting_power'], columns=['proposal_id'], fill_value=0)
-        training_df.reset_index(inplace=True)
-        training_df.columns = training_df.columns.get_level_values(1)
-        training_df.to_csv('data_output/sample_choice_DELETE2.csv', index=False)
-
-        training_df.columns = ['voter_address', 'voting_power'] + list(training_df.columns[2:])
 
         return training_df
 
@@ -101,8 +85,10 @@ class Clusterer:
         return X_pca_sampled, sampled_indices
 
 class DataSaver:
-    def __init__(self, engine):
+    def __init__(self, engine, sink):
         self.engine = engine
+        # Rows are buffered and written to data_output/ in bulk
+        self.sink = sink
     def save_dao_vbe(self, dao, window_df, labels_count, window, dao_df):
         # Calculate min entropy
         if len(labels_count) < 3:
@@ -139,10 +125,7 @@ class DataSaver:
         #     self.tables_created['vbe_dao'] = True
         # else:
         #     vbe_dao.to_sql('vbe_dao', self.engine, schema='public', if_exists='append', index=False)
-        if not os.path.exists('data_output/vbe_dao_cat.csv'):
-            vbe_dao.to_csv('data_output/vbe_dao_cat.csv', index=False)
-        else:
-            vbe_dao.to_csv('data_output/vbe_dao_cat.csv', mode='a', header=False, index=False)
+        self.sink.append('vbe_dao_cat', vbe_dao)
         # vbe_dao.to_sql('vbe_dao', self.engine, schema='public', if_exists='append', index=False)
 
     def save_pca(self, X_train, cluster_labels, X_pca_sampled, window, dao_df, model, sampled_indices):
@@ -172,10 +155,7 @@ class DataSaver:
         #     self.tables_created['vbe_pca'] = True
         # else:
         #     vbe_pca.to_sql('vbe_pca', self.engine, schema='public', if_exists='append', index=False)
-        if not os.path.exists('data_output/vbe_pca_cat.csv'):
-            vbe_pca.to_csv('data_output/vbe_pca_cat.csv', index=False)
-        else:
-            vbe_pca.to_csv('data_output/vbe_pca_cat.csv', mode='a', header=False, index=False)
+        self.sink.append('vbe_pca_cat', vbe_pca)
         # vbe_pca.to_sql('vbe_pca', self.engine, schema='public', if_exists='append', index=False)
 
     def save_cluster_weights(self, cluster_centroids, window_df, window, dao):
@@ -199,10 +179,7 @@ class DataSaver:
         #     self.tables_created['cluster_weight'] = True
         # else:
         #     cluster_explain.to_sql('cluster_weight', self.engine, schema='public', if_exists='append', index=False)
-        if not os.path.exists('data_output/cluster_weight_cat.csv'):
-            cluster_explain.to_csv('data_output/cluster_weight_cat.csv', index=False)
-        else:
-            cluster_explain.to_csv('data_output/cluster_weight_cat.csv', mode='a', header=False, index=False)
+        self.sink.append('cluster_weight_cat', cluster_explain)
         # cluster_explain.to_sql('cluster_weight', self.engine, schema='public', if_exists='append', index=False)
 
 class MainProcessor:
@@ -210,9 +187,10 @@ class MainProcessor:
         self.db_connector = db.DatabaseHandler()
         self.data_processor = DataProcessor()
         self.clusterer = Clusterer()
-        self.data_saver = DataSaver(self.db_connector.engine)
+        self.sink = ResultSink(output_dir='data_output')
+        self.data_saver = DataSaver(self.db_connector.engine, self.sink)
 
-    def process_proposals_in_windows(self, dao, dao_df, voter_df):
+    def process_proposals_in_windows(self, dao, dao_df, matrix_builder):
         dao_df_sorted = dao_df.sort_values(by='end_date', ascending=False)
         # Remove values where forum_url is null
         # dao_df_sorted = dao_df_sorted[dao_df_sorted['forum_url'].notnull()]
@@ -220,13 +198,15 @@ class MainProcessor:
         total_rows = len(dao_df_sorted)
         end = total_rows - 4
         windows = 0
+        # Windows slide one proposal at a time, so each one reuses the previous window's matrix
+        window_matrix = SlidingWindowMatrix(matrix_builder, dao_df_sorted['proposal_id'], 5)
 
         for start in range(end):
             window = end - start
             print("Processing window #: ", window)
 
             window_df = dao_df_sorted.iloc[start:start + 5]
-            training_df = self.data_processor.merge_data(window_df, voter_df)
+            training_df = self.data_processor.merge_data(window_df, window_matrix, start)
             if training_df is None:
                 continue
             X_train = training_df[training_df.columns[2:]]
@@ -248,48 +228,49 @@ class MainProcessor:
         print(f"Total windows processed: {windows}")
 
     def run(self):
-        proposal_df = self.db_connector.db_to_df("proposals")
-        voter_df = self.db_connector.db_to_df("votes")
         pc_results = pd.read_csv('data_input/pc_results.csv')
-        
+
+        # Only the columns used for clustering of the DAOs in pc_results are loaded, from the local cache first
+        dao_ids = pc_results['dao_id'].dropna().unique()
+        loader = VoteDataLoader(self.db_connector, cache=VoteCache(self.db_connector))
+        proposal_df = loader.load_table('clustering', 'proposals', dao_ids=dao_ids)
+        voter_df = loader.load_table('clustering', 'votes', dao_ids=dao_ids)
+
         voter_df['proposal_id'] = voter_df['proposal_id'].astype(str)
         proposal_df['proposal_id'] = proposal_df['proposal_id'].astype(str)
 
-        # Narrow down proposal to records where dao_id in pc_results['dao_id']
-        proposal_df = proposal_df[proposal_df['dao_id'].isin(pc_results['dao_id'])]
-        # Narrow down voter to records where proposal_id in proposal_df['proposal_id']
-        voter_df = voter_df[voter_df['proposal_id'].isin(proposal_df['proposal_id'])]
+        # Position of each vote's choice among its proposal's declared choices
+        voter_df = voter_df.assign(choice_position=encode_choice_positions(voter_df, proposal_df))
 
-        # Voter DF add choices manually - for each proposal in voter df, get all unique values for "choice" in a list
-        choices_per_proposal = voter_df.groupby('proposal_id')['choice'].unique().reset_index()
-        choices_per_proposal.rename(columns={'choice': 'unique_choices'}, inplace=True)
-        
         # Merge category clusters into the proposal_df
         proposal_df = pd.merge(proposal_df, pc_results, how="left", on=['proposal_id'], suffixes=('', '_cats'))
         proposal_df.drop(proposal_df.filter(regex='_cats$').columns, axis=1, inplace=True)
     
-        voter_df = voter_df.merge(choices_per_proposal, on='proposal_id', how='left')
-
-        voter_df['choice_position'] = voter_df.apply(lambda row: row['unique_choices'].tolist().index(row['choice']) + 1, axis=1)
+        # Group the votes by DAO and proposal once, windows are then sliced out of the index
+        vote_index = VoteIndex(voter_df, proposal_df)
+        # Encode voters once, windows are then assembled from the codes
+        matrix_builder = VoteMatrixBuilder(vote_index)
 
         dao_list = proposal_df['dao_id'].unique()
         print("Unique daos", dao_list)
         # print("Unique proposals", proposal_df['proposal_id'].unique())
         
-        for dao in dao_list:
-            print("Processing DAO", dao)
-            # Returns proposals in the dao listed
-            prop_df = self.data_processor.process_dao(dao, proposal_df)
-            if pd.isna(dao):
-                continue
-
-            # Get a list of category clusters in the dao_id, iterate through list
-            category_cluster_list = prop_df[prop_df['dao_id'] == dao]['category_cluster'].unique()
-            
-            for category in category_cluster_list:
-                # filter proposals only with category_cluster == category
-                prop_df_filtered = prop_df[prop_df['category_cluster'] == category]
-                self.process_proposals_in_windows(dao, prop_df_filtered, voter_df)
+        # Buffered results are written when the run ends, or stops with an error
+        with self.sink:
+            for dao in dao_list:
+                print("Processing DAO", dao)
+                # Returns proposals in the dao listed
+                prop_df = self.data_processor.process_dao(dao, proposal_df)
+                if pd.isna(dao):
+                    continue
+
+                # Get a list of category clusters in the dao_id, iterate through list
+                category_cluster_list = prop_df[prop_df['dao_id'] == dao]['category_cluster'].unique()
+                
+                for category in category_cluster_list:
+                    # filter proposals only with category_cluster == category
+                    prop_df_filtered = prop_df[prop_df['category_cluster'] == category]
+                    self.process_proposals_in_windows(dao, prop_df_filtered, matrix_builder)
     
     def save_to_db(self):
         cluster_explain = pd.read_csv('data_output/cluster_weight_cat.csv')
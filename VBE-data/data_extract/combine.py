@@ -4,6 +4,10 @@ combine.py
 This script combines and processes DAO (Decentralized Autonomous Organization) data from multiple sources,
 including Snapshot proposal data, manual proposal category annotations, and forum data from the Boardroom API.
 This creates the proposal_categories table.
+
+Proposals whose forum topic is missing from the forums table are enriched from Boardroom. The topics are deduplicated
+across all DAOs and fetched concurrently, and every fetched topic is kept in a local cache, so later runs only query
+topics that were never fetched before.
 """
 
 import sys
@@ -18,8 +22,11 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from database import DatabaseHandler
 from boardroom_api import BoardroomAPI
 
+# Forum topics already fetched from Boardroom, including the ones it does not know
+TOPIC_CACHE_PATH = "./local/boardroom/forum_topics.csv"
+
 class CombineDAOData:
-    def __init__(self, dao_category_dfs, dao_names):
+    def __init__(self, dao_category_dfs, dao_names, topic_cache_path=TOPIC_CACHE_PATH):
         load_dotenv()
 
         self.config = {
@@ -35,6 +42,7 @@ class CombineDAOData:
 
         self.dao_dfs = dao_category_dfs
         self.dao_names = dao_names
+        self.topic_cache_path = topic_cache_path
 
         self.column_names = {
             "id": "topic_id",
@@ -52,24 +60,64 @@ class CombineDAOData:
         self.forum_df = self.handler.execute_query(forum_query)
         self.forum_df.rename(columns=self.column_names, inplace=True)
 
-    def get_supplement_forum_data(self, dao_df, dao):
-        supplement_df = pd.DataFrame()
-        for url in dao_df[dao_df['url'].isnull()]['forum_url']:
-            try:
-                if url:
-                    print(f"Querying {url}")
-                    boardroom_data = self.boardroom_api.query_from_url(dao, url)
-                    if not boardroom_data.empty:
-                        supplement_df = pd.concat([supplement_df, boardroom_data])
-            
-            except Exception as e:
-                print(f"Failed to query {url}: {str(e)}")
+    def topic_id(self, protocol, url):
+        """Returns the Boardroom topic ID of a cleaned forum URL, None if there is none."""
+        if not isinstance(url, str):
+            return None
+        return self.boardroom_api.get_slug_topic_id(protocol, url)[1]
+
+    def load_topic_cache(self):
+        """Reads the forum topics fetched on earlier runs."""
+        if not os.path.exists(self.topic_cache_path):
+            return pd.DataFrame(columns=['protocol', 'topic_id'])
+        return pd.read_csv(self.topic_cache_path, dtype={'protocol': str, 'topic_id': str})
+
+    def get_supplement_forum_data(self, dao_dfs):
+        """
+        Fetches the forum topics missing from the forums table, for every DAO at once.
+
+        Topics are deduplicated across the DAOs, and only those missing from the topic cache are queried,
+        concurrently. Newly fetched topics are added to the cache, topics Boardroom does not know as a row
+        without data so they are not queried again. Topics that could not be retrieved are queried again
+        on the next run.
+
+        Args:
+            dao_dfs (dict): Proposals of each DAO with their forum data, by protocol.
+
+        Returns:
+            pandas.DataFrame: Boardroom data of the missing topics, with their protocol and topic_id.
+        """
+        missing = pd.concat([
+            pd.DataFrame({'protocol': dao, 'forum_url': dao_df.loc[dao_df['url'].isnull(), 'forum_url']})
+            for dao, dao_df in dao_dfs.items()
+        ])
+        missing['topic_id'] = [self.topic_id(protocol, url) for protocol, url in zip(missing['protocol'], missing['forum_url'])]
+        missing = missing.dropna(subset=['topic_id']).drop_duplicates(['protocol', 'topic_id'])
+
+        cache_df = self.load_topic_cache()
+        cached = set(zip(cache_df['protocol'], cache_df['topic_id']))
+        topics = [topic for topic in zip(missing['protocol'], missing['topic_id']) if topic not in cached]
+        print(f"{len(missing)} forum topics missing, {len(topics)} not fetched before")
+
+        fetched = []
+        for (protocol, topic_id), topic_df in self.boardroom_api.fetch_topics(topics):
+            if topic_df is None:
+                print(f"Failed to query topic {topic_id} of {protocol}")
                 continue
-        
-        supplement_df.to_csv(f"./local/{dao}_forums_supplement.csv", index=False)
-        return supplement_df
+            if topic_df.empty:
+                topic_df = pd.DataFrame(index=[0])
+            fetched.append(topic_df.assign(protocol=protocol, topic_id=topic_id))
 
-    def get_forum_data(self, dao):
+        if fetched:
+            cache_df = pd.concat([cache_df, *fetched], ignore_index=True)
+            os.makedirs(os.path.dirname(self.topic_cache_path), exist_ok=True)
+            cache_df.to_csv(self.topic_cache_path, index=False)
+
+        requested = missing[['protocol', 'topic_id']]
+        return pd.merge(cache_df, requested, on=['protocol', 'topic_id'])
+
+    def get_snapshot_forum_data(self, dao):
+        """Joins a DAO's Snapshot proposals with their categories and the forums table."""
         # Get Snapshot DB data
         snapshot_query = f"SELECT dao_name, proposal_id, proposal_title, created, discussion FROM proposals WHERE dao_name='{self.dao_names[dao]}' ORDER BY proposal_id ASC"
         snapshot_df = self.handler.execute_query(snapshot_query)
@@ -83,24 +131,42 @@ class CombineDAOData:
 
         # Merge with forum_df on URL
         forum_columns = self.column_names.keys()
-        dao_df = pd.merge(dao_df, self.forum_df[forum_columns], left_on='forum_url', right_on='url', how='left')
-        supplement_df = self.get_supplement_forum_data(dao_df, dao)
-        dao_df = pd.merge(dao_df, supplement_df[forum_columns], left_on='forum_url', right_on='url', how='left', suffixes=('', '_supplement'))
+        return pd.merge(dao_df, self.forum_df[forum_columns], left_on='forum_url', right_on='url', how='left')
+
+    def merge_supplement_forum_data(self, dao_df, dao, supplement_df):
+        """Fills the forum data missing from a DAO's proposals with the topics fetched from Boardroom."""
+        forum_columns = list(self.column_names.keys())
+        supplement_columns = [column for column in forum_columns if column != 'url']
+        # Topics Boardroom does not know are cached without data
+        dao_supplement_df = supplement_df[supplement_df['protocol'] == dao].reindex(columns=['topic_id', *supplement_columns])
+        dao_supplement_df = dao_supplement_df.dropna(subset=['id'])
+        dao_supplement_df.to_csv(f"./local/{dao}_forums_supplement.csv", index=False)
+
+        dao_df['supplement_topic_id'] = [self.topic_id(dao, url) for url in dao_df['forum_url']]
+        dao_supplement_df = dao_supplement_df.add_suffix('_supplement').rename(columns={'topic_id_supplement': 'supplement_topic_id'})
+        dao_df = pd.merge(dao_df, dao_supplement_df, on='supplement_topic_id', how='left')
+        # The topic's URL is the forum URL it was queried from
+        dao_df['url_supplement'] = dao_df['forum_url'].where(dao_df['id_supplement'].notna())
         for column in forum_columns:
             if column in dao_df.columns:
                 dao_df[column] = dao_df[column].fillna(dao_df[f"{column}_supplement"])
 
         # Drop the supplemental columns
-        dao_df.drop(columns=[f"{col}_supplement" for col in forum_columns], inplace=True)
+        dao_df.drop(columns=['supplement_topic_id', *[f"{col}_supplement" for col in forum_columns]], inplace=True)
+        return dao_df
+
+    def get_forum_data(self, dao):
+        dao_df = self.get_snapshot_forum_data(dao)
+        supplement_df = self.get_supplement_forum_data({dao: dao_df})
+        dao_df = self.merge_supplement_forum_data(dao_df, dao, supplement_df)
         print(dao_df)
         return dao_df
 
     def get_combined_dao_data(self):
-        combined_df = pd.DataFrame()
-        for dao in self.dao_names:
-            dao_df = self.get_forum_data(dao)
-            combined_df = pd.concat([combined_df, dao_df])
-            
+        dao_dfs = {dao: self.get_snapshot_forum_data(dao) for dao in self.dao_names}
+        supplement_df = self.get_supplement_forum_data(dao_dfs)
+        combined_df = pd.concat([self.merge_supplement_forum_data(dao_df, dao, supplement_df) for dao, dao_df in dao_dfs.items()])
+
         # Write to CSV
         combined_df.to_csv("./local/combined_dao.csv", index=False)
 
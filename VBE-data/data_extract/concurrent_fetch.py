@@ -0,0 +1,116 @@
+"""
+concurrent_fetch.py
+
+This module provides the pieces shared by the API extractors to fetch several proposals at once without
+exceeding the API's rate limit.
+
+Key features:
+- A token bucket rate limiter shared by every fetch thread, paused by 429 responses
+- A thread pool that yields each fetch's result as soon as it completes
+
+Example usage:
+    limiter = RateLimiter(requests_per_second=4)
+    for proposal_id, votes in fetch_concurrently(get_votes, proposal_ids, workers=4):
+        save(votes)
+"""
+
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class RateLimiter:
+    """
+    Token bucket shared by threads, each request takes one token.
+
+    Attributes:
+        requests_per_second (float): Rate at which tokens are added.
+        burst (int): Maximum number of tokens, the number of requests that can be sent at once after a pause.
+    """
+    def __init__(self, requests_per_second, burst=1):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request can be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.requests_per_second)
+                self._updated = now
+                wait_time = self._paused_until - now
+                if wait_time <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait_time = (1 - self._tokens) / self.requests_per_second
+            time.sleep(wait_time)
+
+    def pause(self, seconds):
+        """
+        Stops every thread from sending requests for a while, e.g. after a 429 response.
+
+        Args:
+            seconds (float): How long to wait before the next request.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+def retry_delay(response, attempt):
+    """
+    Returns how long to wait before retrying a rate limited request.
+
+    Args:
+        response (requests.Response): The 429 response.
+        attempt (int): Number of the failed attempt, starting at 0.
+
+    Returns:
+        float: The Retry-After header in seconds if given, otherwise an exponential backoff.
+    """
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is not None:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+    return 2.0 ** attempt
+
+
+def fetch_concurrently(fetch, items, workers=4):
+    """
+    Calls fetch on each item in a thread pool and yields the results as they complete.
+
+    At most twice as many items as workers are in flight, so results do not pile up in memory
+    when the caller is slower than the fetches. An exception raised by fetch is raised here.
+
+    Args:
+        fetch (callable): Function called with one item.
+        items (iterable): The items to fetch.
+        workers (int, optional): Number of fetch threads.
+
+    Yields:
+        tuple: The item and the value returned by fetch, in completion order.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(fetch, item): item for item in itertools.islice(items, workers * 2)}
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    result = future.result()
+                    for next_item in itertools.islice(items, 1):
+                        pending[executor.submit(fetch, next_item)] = next_item
+                    yield item, result
+        finally:
+            # Fetches that have not started yet are dropped when the caller stops early or a fetch fails
+            for future in pending:
+                future.cancel()
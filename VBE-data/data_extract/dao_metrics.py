@@ -0,0 +1,297 @@
+"""
+dao_metrics.py
+
+This module computes the DAO level voting metrics of every DAO at once, instead of filtering the votes DAO by DAO.
+
+The votes are reduced once to one row per DAO and voter, holding the voter's number of votes and largest voting
+power. Those rows are sorted by DAO and voting power, so every DAO is a contiguous segment, and each metric is a
+segmented reduction (np.add.reduceat) over the segments. The runtime is near-linear in the number of votes however
+many DAOs there are.
+
+Key features:
+- Participation measures: votes cast, unique voters, proposals, average votes and voting power per voter
+- Concentration measures of voting power: Gini index, Nakamoto coefficient, min entropy and HHI
+- Mean, standard deviation and deciles of the voting power and vote count per voter
+- The dao_percentile and proposal_stats tables, shared with streaming_analytics.py
+
+Example usage:
+    metrics = DaoMetrics(merged_df)
+    dao_stats_df = metrics.stats()
+    dao_percentile_df = metrics.percentiles()
+"""
+
+import numpy as np
+import pandas as pd
+
+# Percentiles of the percentile table, as fractions and as reported
+PERCENTILES = np.arange(0.1, 1.0, 0.1)
+PERCENTILE_LABELS = np.arange(10, 100, 10).astype(np.float64)
+# Measures of each proposal choice in the proposal_stats table
+PROPOSAL_MEASURES = ['sum_choice', 'sum_voting_power', 'avg_voting_power']
+
+
+def segment_starts(codes, n_segments):
+    """
+    Returns where each segment of sorted codes starts and how long it is.
+
+    Args:
+        codes (numpy.ndarray): Segment code of each row, sorted.
+        n_segments (int): Number of segments, codes are below it.
+
+    Returns:
+        tuple: Start offset and length of each segment, a segment without rows has length 0.
+    """
+    counts = np.bincount(codes, minlength=n_segments)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return starts, counts
+
+
+def segment_sum(values, starts, counts):
+    """Sums the values of each segment, 0 for a segment without rows."""
+    sums = np.zeros(len(starts), dtype=np.float64)
+    present = counts > 0
+    if present.any():
+        sums[present] = np.add.reduceat(values, starts[present])
+    return sums
+
+
+def segment_quantiles(sorted_values, starts, counts, quantiles):
+    """
+    Returns quantiles of each segment of sorted values, with linear interpolation as pandas computes them.
+
+    Args:
+        sorted_values (numpy.ndarray): Values, sorted within each segment.
+        starts (numpy.ndarray): Start offset of each segment.
+        counts (numpy.ndarray): Length of each segment.
+        quantiles (numpy.ndarray): Quantiles as fractions.
+
+    Returns:
+        numpy.ndarray: One row per segment and one column per quantile, NaN for a segment without rows.
+    """
+    result = np.full((len(starts), len(quantiles)), np.nan)
+    present = counts > 0
+    if not present.any():
+        return result
+    n = counts[present][:, None]
+    position = quantiles[None, :] * (n - 1)
+    low = np.floor(position).astype(np.int64)
+    high = np.minimum(low + 1, n - 1)
+    fraction = position - low
+    below = sorted_values[starts[present][:, None] + low]
+    above = sorted_values[starts[present][:, None] + high]
+    # Interpolated from the nearer end, as numpy does
+    difference = above - below
+    result[present] = np.where(fraction >= 0.5, above - difference * (1 - fraction), below + difference * fraction)
+    return result
+
+
+def percentile_table(dao_ids, summaries):
+    """
+    Formats the summaries of each measure as the dao_percentile table.
+
+    Args:
+        dao_ids (numpy.ndarray): The DAOs, in the order of their rows.
+        summaries (dict): Mean, standard deviation and percentile values of each DAO, as arrays of one row per
+            DAO, by measure.
+
+    Returns:
+        pandas.DataFrame: Nine rows per DAO and measure, the measures of a DAO in the order of summaries.
+    """
+    n_daos = len(dao_ids)
+    n_percentiles = len(PERCENTILES)
+    dao_index = np.repeat(np.arange(n_daos), len(summaries) * n_percentiles)
+    measure_index = np.tile(np.repeat(np.arange(len(summaries)), n_percentiles), n_daos)
+    percentile_index = np.tile(np.arange(n_percentiles), len(summaries) * n_daos)
+    measures = np.array(list(summaries))
+    stacked = {part: np.stack([summaries[measure][position] for measure in measures]) for position, part in enumerate(('mean', 'std', 'value'))}
+    return pd.DataFrame({
+        'id': np.arange(1, len(dao_index) + 1),
+        'protocol': np.asarray(dao_ids, dtype=object)[dao_index],
+        'measure': measures[measure_index],
+        'mean': stacked['mean'][measure_index, dao_index],
+        'std': stacked['std'][measure_index, dao_index],
+        'percentile': PERCENTILE_LABELS[percentile_index],
+        'value': stacked['value'][measure_index, dao_index, percentile_index],
+    })
+
+
+def proposal_table(stats):
+    """
+    Formats the stats of proposal choices as the proposal_stats table.
+
+    Args:
+        stats (pandas.DataFrame): One row per proposal and choice, with 'proposal_id', 'choice' and a column
+            for each of PROPOSAL_MEASURES.
+
+    Returns:
+        pandas.DataFrame: One row per proposal, choice and measure, in the order of stats.
+    """
+    n_rows = len(stats) * len(PROPOSAL_MEASURES)
+    return pd.DataFrame({
+        'id': np.arange(1, n_rows + 1),
+        'proposal_id': np.repeat(stats['proposal_id'].to_numpy(), len(PROPOSAL_MEASURES)),
+        'choice': np.repeat(stats['choice'].to_numpy(), len(PROPOSAL_MEASURES)),
+        'measure': np.tile(PROPOSAL_MEASURES, len(stats)),
+        'value': stats[PROPOSAL_MEASURES].to_numpy(dtype=np.float64).ravel(),
+    })
+
+
+class DaoMetrics:
+    """
+    Voting metrics of every DAO, computed from one row per DAO and voter.
+
+    Attributes:
+        dao_ids (numpy.ndarray): The DAOs, in the order they first appear in the votes.
+        dao_names (numpy.ndarray): Name of each DAO, from its first vote.
+    """
+    def __init__(self, merged_df):
+        """
+        Args:
+            merged_df (pandas.DataFrame): Votes with 'dao_id', 'dao_name', 'proposal_id', 'voter_address' and
+                'voting_power' columns. Votes without a DAO are left out.
+        """
+        votes = merged_df[merged_df['dao_id'].notna()]
+        dao_codes, self.dao_ids = pd.factorize(votes['dao_id'])
+        self.n_daos = len(self.dao_ids)
+        first_votes = np.unique(dao_codes, return_index=True)[1]
+        self.dao_names = votes['dao_name'].to_numpy()[first_votes] if 'dao_name' in votes.columns else np.full(self.n_daos, None)
+
+        voter_codes, voters = pd.factorize(votes['voter_address'])
+        proposal_codes, proposals = pd.factorize(votes['proposal_id'])
+        voting_power = pd.to_numeric(votes['voting_power'], errors='coerce').to_numpy(dtype=np.float64)
+        has_voter = voter_codes >= 0
+
+        self.total_votes_cast = np.bincount(dao_codes, minlength=self.n_daos).astype(np.float64)
+        dao_proposals = np.unique(dao_codes.astype(np.int64) * len(proposals) + proposal_codes) // max(len(proposals), 1)
+        self.total_proposals = np.bincount(dao_proposals, minlength=self.n_daos).astype(np.float64)
+        # Votes without a voter count as one more unique voter, as pandas unique() counts a missing value
+        voters_without_address = np.bincount(dao_codes[~has_voter], minlength=self.n_daos) > 0
+        # Voters of each proposal, summed over the DAO's proposals
+        proposal_voter_keys = np.unique((dao_codes[has_voter].astype(np.int64) * len(proposals) + proposal_codes[has_voter]) * len(voters) + voter_codes[has_voter])
+        self.proposal_voters = np.bincount(proposal_voter_keys // (len(proposals) * len(voters)), minlength=self.n_daos).astype(np.float64)
+
+        # One row per DAO and voter, with the voter's vote count and largest voting power
+        voter_keys = dao_codes[has_voter].astype(np.int64) * len(voters) + voter_codes[has_voter]
+        order = np.argsort(voter_keys, kind='stable')
+        sorted_keys = voter_keys[order]
+        first = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1]))) if len(sorted_keys) else np.array([], dtype=np.int64)
+        self.voter_dao = (sorted_keys[first] // len(voters)) if len(voters) else np.array([], dtype=np.int64)
+        self.voter_votes = np.diff(np.append(first, len(sorted_keys))).astype(np.float64)
+        # fmax skips missing voting power, a voter without any keeps NaN
+        self.voter_power = np.fmax.reduceat(voting_power[has_voter][order], first) if len(first) else np.array([], dtype=np.float64)
+        self.unique_voters = np.bincount(self.voter_dao, minlength=self.n_daos) + voters_without_address
+
+    @classmethod
+    def from_state(cls, dao_df, voter_df, proposal_df):
+        """
+        Builds the metrics from aggregates of the votes instead of the votes, see dao_state.py.
+
+        Args:
+            dao_df (pandas.DataFrame): One row per DAO, with 'dao_id', 'dao_name', 'votes_cast' and 'null_voter',
+                whether a vote without a voter was cast.
+            voter_df (pandas.DataFrame): One row per DAO and voter, with 'dao_id', 'voting_power', the voter's
+                largest, and 'vote_count'.
+            proposal_df (pandas.DataFrame): One row per DAO, with 'dao_id', 'total_proposals' and
+                'proposal_voters', the voters of each proposal summed over the DAO's proposals.
+
+        Returns:
+            DaoMetrics: The metrics of the DAOs of dao_df, in its order.
+        """
+        metrics = cls.__new__(cls)
+        metrics.dao_ids = pd.Index(dao_df['dao_id'].to_numpy(), dtype=object)
+        metrics.n_daos = len(metrics.dao_ids)
+        metrics.dao_names = dao_df['dao_name'].to_numpy()
+        metrics.total_votes_cast = dao_df['votes_cast'].to_numpy(dtype=np.float64)
+        proposals = proposal_df.set_index('dao_id').reindex(metrics.dao_ids, fill_value=0)
+        metrics.total_proposals = proposals['total_proposals'].to_numpy(dtype=np.float64)
+        metrics.proposal_voters = proposals['proposal_voters'].to_numpy(dtype=np.float64)
+
+        metrics.voter_dao = metrics.dao_ids.get_indexer(voter_df['dao_id'])
+        metrics.voter_votes = voter_df['vote_count'].to_numpy(dtype=np.float64)
+        metrics.voter_power = pd.to_numeric(voter_df['voting_power'], errors='coerce').to_numpy(dtype=np.float64)
+        metrics.unique_voters = np.bincount(metrics.voter_dao, minlength=metrics.n_daos) + dao_df['null_voter'].to_numpy(dtype=bool)
+        return metrics
+
+    def _sorted_segments(self, values):
+        """Sorts voter values by DAO and value, leaving out missing values, and returns them with each DAO's segment."""
+        valid = ~np.isnan(values)
+        daos = self.voter_dao[valid]
+        order = np.lexsort((values[valid], daos))
+        sorted_values = values[valid][order]
+        starts, counts = segment_starts(daos[order], self.n_daos)
+        return sorted_values, daos[order], starts, counts
+
+    def concentration(self):
+        """
+        Computes the concentration of voting power in each DAO, over the voters with a voting power.
+
+        The Gini index is 1 - 2 * the trapezoid area under the Lorenz curve. The Nakamoto coefficient is the
+        number of largest voters holding at least half of the voting power.
+
+        Returns:
+            pandas.DataFrame: gini_index, nakamoto_coefficient, min_entropy and hhi of each DAO.
+        """
+        power, daos, starts, counts = self._sorted_segments(self.voter_power)
+        total = segment_sum(power, starts, counts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share = power / total[daos]
+            # Cumulative voting power within each DAO, ascending
+            cumulative = pd.Series(power).groupby(daos).cumsum().to_numpy()
+            lorenz_sum = segment_sum(cumulative, starts, counts) / total
+            smallest = np.full(self.n_daos, np.nan)
+            smallest[counts > 0] = power[starts[counts > 0]] / total[counts > 0]
+            gini_index = np.where(counts == 1, 1.0, 1 - 2 * (lorenz_sum - (smallest + 1) / 2) / (counts - 1))
+            # Voters above half of the voting power in ascending order are the ones needed from the top
+            nakamoto = np.bincount(daos[cumulative > 0.5 * total[daos]], minlength=self.n_daos)
+            min_entropy = -segment_sum(share * np.log2(share + 1e-10), starts, counts)
+            hhi = segment_sum(share ** 2, starts, counts)
+
+        missing = counts == 0
+        return pd.DataFrame({
+            'gini_index': np.where(missing, np.nan, gini_index),
+            'nakamoto_coefficient': pd.Series(nakamoto, dtype='Int64').mask(missing),
+            'min_entropy': np.where(missing, np.nan, min_entropy),
+            'hhi': np.where(missing, np.nan, hhi),
+        })
+
+    def stats(self):
+        """
+        Computes the DAO level stats.
+
+        Returns:
+            pandas.DataFrame: One row per DAO, the columns of the dao_stats table.
+        """
+        voters_per_dao = np.bincount(self.voter_dao, minlength=self.n_daos)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            valid_power = ~np.isnan(self.voter_power)
+            avg_vp_voter = np.bincount(self.voter_dao[valid_power], self.voter_power[valid_power], minlength=self.n_daos) / np.bincount(self.voter_dao[valid_power], minlength=self.n_daos)
+            stats_df = pd.DataFrame({
+                'id': np.arange(1, self.n_daos + 1),
+                'protocol': self.dao_ids,
+                'dao_name': self.dao_names,
+                'unique_voters': self.unique_voters.astype(np.float64),
+                'total_proposals': self.total_proposals,
+                'total_votes_cast': self.total_votes_cast,
+                'avg_votes_on_proposal': self.total_votes_cast / self.total_proposals,
+                'avg_votes_voter': np.bincount(self.voter_dao, self.voter_votes, minlength=self.n_daos) / voters_per_dao,
+                'avg_vp_voter': avg_vp_voter,
+                'avg_voter_participation': self.proposal_voters / self.total_proposals / self.unique_voters,
+            })
+        return pd.concat([stats_df, self.concentration()], axis=1)
+
+    def percentiles(self):
+        """
+        Computes the mean, standard deviation and deciles of the voting power and the vote count per voter.
+
+        Returns:
+            pandas.DataFrame: Nine rows per DAO and measure, the columns of the dao_percentile table.
+        """
+        summaries = {}
+        for measure, values in (('voting_power', self.voter_power), ('vote_counts', self.voter_votes)):
+            sorted_values, daos, starts, counts = self._sorted_segments(values)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = segment_sum(sorted_values, starts, counts) / counts
+                std = np.sqrt(segment_sum((sorted_values - mean[daos]) ** 2, starts, counts) / (counts - 1))
+            summaries[measure] = (mean, std, segment_quantiles(sorted_values, starts, counts, PERCENTILES))
+
+        return percentile_table(self.dao_ids.to_numpy(), summaries)
@@ -0,0 +1,243 @@
+"""
+dao_state.py
+
+This module refreshes the dao_stats and dao_percentile tables incrementally, recomputing only the DAOs that received
+votes since the last refresh.
+
+Aggregates of the votes are kept per DAO in the database (see migrations.py): the votes cast by each DAO, the number of
+votes and largest voting power of each of its voters, and the number of voters of each of its proposals. A refresh
+adds the votes stored after the watermark in analytics_watermarks to these aggregates, recomputes the stats of the DAOs
+they belong to from their aggregates with dao_metrics.DaoMetrics, and replaces those DAOs' rows of dao_stats and
+dao_percentile, all in one transaction. Inserts into votes wait for a refresh to commit, which takes seconds after a
+small ingest. A vote is counted once its proposal is stored, as the extractors store proposals before their votes.
+
+The extractors only ever insert votes, so the aggregates of the older votes stay valid. Any other change to the votes,
+e.g. migrations.py removing duplicates, deletes the watermark in its own transaction through a trigger on the votes
+table, so the next refresh rebuilds the aggregates from every vote.
+
+Key features:
+- Aggregates of the votes per DAO, voter and proposal, updated with the new votes only
+- dao_stats and dao_percentile updated in place for the DAOs with new votes
+- The first refresh, one after votes were updated or deleted, or one with rebuild=True, builds the aggregates and
+  tables from every vote
+
+Example usage:
+    refresh_dao_stats(db.DatabaseHandler())
+"""
+
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from dao_metrics import DaoMetrics
+
+WATERMARK = 'dao_stats'
+STATE_TABLES = ('dao_state', 'dao_voter_state', 'dao_proposal_state')
+VOTES_TRIGGER = 'votes_reset_dao_stats'
+
+# Deletes the watermark when votes are updated, deleted or truncated, the aggregates only ever add votes
+VOTES_TRIGGER_SQL = f"""
+    CREATE OR REPLACE FUNCTION reset_dao_stats_watermark() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF to_regclass('public.analytics_watermarks') IS NOT NULL THEN
+            DELETE FROM analytics_watermarks WHERE name = '{WATERMARK}';
+        END IF;
+        RETURN NULL;
+    END;
+    $$;
+    DROP TRIGGER IF EXISTS {VOTES_TRIGGER} ON votes;
+    CREATE TRIGGER {VOTES_TRIGGER} AFTER UPDATE OR DELETE OR TRUNCATE ON votes
+        FOR EACH STATEMENT EXECUTE FUNCTION reset_dao_stats_watermark();
+"""
+
+# New votes with the DAO of their proposal
+NEW_VOTES_SQL = """
+    CREATE TEMP TABLE new_votes ON COMMIT DROP AS
+    SELECT v.id, p.dao_id, v.proposal_id, v.voter_address, v.voting_power::DOUBLE PRECISION AS voting_power
+    FROM votes v
+    JOIN proposals p ON p.proposal_id = v.proposal_id
+    WHERE v.id > :low AND v.id <= :high AND p.dao_id IS NOT NULL;
+"""
+
+# Adds the new votes to the aggregates. A voter's largest voting power ignores missing ones, as dao_metrics does.
+UPDATE_STATE_SQL = [
+    """
+    INSERT INTO dao_state (dao_id, dao_name, votes_cast, null_voter)
+    SELECT n.dao_id, (SELECT d.dao_name FROM dao d WHERE d.dao_id = n.dao_id ORDER BY d.id LIMIT 1), COUNT(*), BOOL_OR(n.voter_address IS NULL)
+    FROM new_votes n
+    GROUP BY n.dao_id
+    ON CONFLICT (dao_id) DO UPDATE SET
+        dao_name = COALESCE(dao_state.dao_name, EXCLUDED.dao_name),
+        votes_cast = dao_state.votes_cast + EXCLUDED.votes_cast,
+        null_voter = dao_state.null_voter OR EXCLUDED.null_voter;
+    """,
+    """
+    INSERT INTO dao_voter_state (dao_id, voter_address, voting_power, vote_count)
+    SELECT dao_id, voter_address, MAX(voting_power), COUNT(*)
+    FROM new_votes
+    WHERE voter_address IS NOT NULL
+    GROUP BY dao_id, voter_address
+    ON CONFLICT (dao_id, voter_address) DO UPDATE SET
+        voting_power = GREATEST(dao_voter_state.voting_power, EXCLUDED.voting_power),
+        vote_count = dao_voter_state.vote_count + EXCLUDED.vote_count;
+    """,
+    # A proposal's voters are counted once, voters who voted on it before the watermark are not counted again
+    """
+    INSERT INTO dao_proposal_state (proposal_id, dao_id, voters)
+    SELECT n.proposal_id, MIN(n.dao_id), COUNT(DISTINCT n.voter_address) FILTER (WHERE n.is_new)
+    FROM (
+        SELECT proposal_id, dao_id, voter_address,
+            voter_address IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM votes o
+                WHERE o.proposal_id = new_votes.proposal_id AND o.voter_address = new_votes.voter_address AND o.id <= :low
+            ) AS is_new
+        FROM new_votes
+    ) n
+    GROUP BY n.proposal_id
+    ON CONFLICT (proposal_id) DO UPDATE SET voters = dao_proposal_state.voters + EXCLUDED.voters;
+    """,
+]
+
+
+def read_watermark(connection):
+    """Returns the id of the last vote added to the aggregates, or None if they were never built."""
+    row = connection.execute(text("SELECT last_vote_id FROM analytics_watermarks WHERE name = :name;"), {'name': WATERMARK}).fetchone()
+    return None if row is None else row[0]
+
+
+def update_dao_state(connection, low, high):
+    """
+    Adds the votes with an id in (low, high] to the aggregates.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): Connection in the refresh's transaction.
+        low (int): Id of the last vote already in the aggregates.
+        high (int): Id of the last vote to add.
+
+    Returns:
+        list: The DAOs of the added votes.
+    """
+    connection.execute(text(NEW_VOTES_SQL), {'low': low, 'high': high})
+    for statement in UPDATE_STATE_SQL:
+        connection.execute(text(statement), {'low': low})
+    return [row[0] for row in connection.execute(text("SELECT DISTINCT dao_id FROM new_votes ORDER BY dao_id;"))]
+
+
+def load_dao_state(connection, dao_ids):
+    """
+    Reads the aggregates of some DAOs.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): Connection in the refresh's transaction.
+        dao_ids (list): The DAOs.
+
+    Returns:
+        DaoMetrics: The metrics of the DAOs, in the order of dao_ids.
+    """
+    params = {'dao_ids': list(dao_ids)}
+    dao_df = pd.read_sql(text("SELECT dao_id, dao_name, votes_cast, null_voter FROM dao_state WHERE dao_id = ANY(:dao_ids);"), connection, params=params)
+    dao_df = dao_df.set_index('dao_id').reindex(dao_ids).reset_index()
+    voter_df = pd.read_sql(text("SELECT dao_id, voting_power, vote_count FROM dao_voter_state WHERE dao_id = ANY(:dao_ids);"), connection, params=params)
+    proposal_df = pd.read_sql(text("""
+        SELECT dao_id, COUNT(*) AS total_proposals, SUM(voters) AS proposal_voters
+        FROM dao_proposal_state
+        WHERE dao_id = ANY(:dao_ids)
+        GROUP BY dao_id;
+    """), connection, params=params)
+    return DaoMetrics.from_state(dao_df, voter_df, proposal_df)
+
+
+def ensure_votes_trigger(connection):
+    """
+    Creates the trigger deleting the watermark when votes change, if it does not exist, e.g. after migrations.py
+    partitioned the votes table.
+
+    Returns:
+        bool: Whether the trigger was created, votes may have changed unnoticed before.
+    """
+    exists = connection.execute(
+        text("SELECT 1 FROM pg_trigger WHERE tgrelid = 'public.votes'::regclass AND tgname = :name;"), {'name': VOTES_TRIGGER}
+    ).fetchone()
+    if exists is None:
+        connection.execute(text(VOTES_TRIGGER_SQL))
+    return exists is None
+
+
+def table_exists(connection, table_name):
+    return connection.execute(text("SELECT to_regclass(:name) IS NOT NULL;"), {'name': f"public.{table_name}"}).scalar()
+
+
+def replace_dao_rows(connection, df, table_name, key_columns, dao_ids):
+    """
+    Replaces the rows of some DAOs in a table. Rows keep their id, new rows get ids after the last one.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): Connection in the refresh's transaction.
+        df (pandas.DataFrame): The new rows of the DAOs, with 'id' and 'protocol' columns.
+        table_name (str): 'dao_stats' or 'dao_percentile'.
+        key_columns (list): Columns identifying a row.
+        dao_ids (list): The DAOs whose rows are replaced.
+    """
+    params = {'dao_ids': list(dao_ids)}
+    old_ids = pd.read_sql(text(f"SELECT id, {', '.join(key_columns)} FROM {table_name} WHERE protocol = ANY(:dao_ids);"), connection, params=params)
+    last_id = connection.execute(text(f"SELECT COALESCE(MAX(id), 0) FROM {table_name};")).scalar()
+    ids = df[key_columns].merge(old_ids, on=key_columns, how='left')['id'].to_numpy(dtype=np.float64)
+    new_rows = np.isnan(ids)
+    ids[new_rows] = last_id + np.arange(1, new_rows.sum() + 1)
+    connection.execute(text(f"DELETE FROM {table_name} WHERE protocol = ANY(:dao_ids);"), params)
+    df.assign(id=ids.astype(np.int64)).to_sql(table_name, connection, schema='public', if_exists='append', index=False)
+
+
+def refresh_dao_stats(sql_handler, rebuild=False):
+    """
+    Adds the new votes to the aggregates and refreshes the stats of the DAOs they belong to, in one transaction.
+
+    Args:
+        sql_handler (DatabaseHandler): The database.
+        rebuild (bool, optional): Build the aggregates and the tables again from every vote.
+
+    Returns:
+        list: The DAOs whose stats were refreshed.
+    """
+    start_time = time.perf_counter()
+    with sql_handler.engine.begin() as connection:
+        if not table_exists(connection, 'analytics_watermarks'):
+            raise ValueError("The DAO aggregates are missing, run migrations.py to create them")
+        # Refreshes run one at a time, each adding the votes after the watermark the previous one committed
+        connection.execute(text("LOCK TABLE analytics_watermarks IN EXCLUSIVE MODE;"))
+        low = read_watermark(connection)
+        rebuild = ensure_votes_trigger(connection) or rebuild or low is None or not table_exists(connection, 'dao_stats') or not table_exists(connection, 'dao_percentile')
+        if rebuild:
+            print("Building the DAO aggregates from every vote...")
+            connection.execute(text(f"TRUNCATE {', '.join(STATE_TABLES)};"))
+            low = 0
+        # Vote ids are taken from a sequence before their transaction commits, so an extractor can still commit ids
+        # below the largest committed one. The lock waits for every insert in progress and holds later ones until the
+        # refresh commits, which then get larger ids, so no vote at or below high is committed after it is read.
+        connection.execute(text("LOCK TABLE votes IN SHARE MODE;"))
+        high = connection.execute(text("SELECT COALESCE(MAX(id), 0) FROM votes;")).scalar()
+        if high <= low:
+            print("No new votes since the last refresh")
+            return []
+
+        dao_ids = update_dao_state(connection, low, high)
+        print(f"Added votes {low + 1} to {high} to the aggregates of {len(dao_ids)} DAOs")
+        if rebuild:
+            # Every DAO, including those without votes in the range, in case the aggregates had been reset
+            dao_ids = [row[0] for row in connection.execute(text("SELECT dao_id FROM dao_state ORDER BY dao_id;"))]
+        metrics = load_dao_state(connection, dao_ids)
+        dao_stats_df, dao_percentile_df = metrics.stats(), metrics.percentiles()
+
+        if rebuild:
+            dao_stats_df.to_sql('dao_stats', connection, schema='public', if_exists='replace', index=False)
+            dao_percentile_df.to_sql('dao_percentile', connection, schema='public', if_exists='replace', index=False)
+        else:
+            replace_dao_rows(connection, dao_stats_df, 'dao_stats', ['protocol'], dao_ids)
+            replace_dao_rows(connection, dao_percentile_df, 'dao_percentile', ['protocol', 'measure', 'percentile'], dao_ids)
+        connection.execute(text("""
+            INSERT INTO analytics_watermarks (name, last_vote_id, updated_at) VALUES (:name, :high, now())
+            ON CONFLICT (name) DO UPDATE SET last_vote_id = EXCLUDED.last_vote_id, updated_at = EXCLUDED.updated_at;
+        """), {'name': WATERMARK, 'high': high})
+    print(f"Refreshed the stats of {len(dao_ids)} DAOs in {time.perf_counter() - start_time:.2f}s")
+    return dao_ids
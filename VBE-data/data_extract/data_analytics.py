@@ -2,190 +2,192 @@
 data_analytics.py
 
 This module provides functionality to analyze and generate various analytics from DAO proposal and voting data.
+
+With --in_database, the stats are refreshed as materialized views in the database instead (see migrations.py),
+so only the results leave the database. With --streaming, the votes are streamed from the database in batches into
+aggregates of a bounded size (see streaming_analytics.py), so they never have to fit in memory. With --incremental,
+only the DAO stats of the DAOs that received votes since the last refresh are recomputed, from aggregates kept in the
+database (see dao_state.py).
 """
 
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import database as db
+from dao_metrics import DaoMetrics, PROPOSAL_MEASURES, proposal_table
+from dao_state import refresh_dao_stats
+from streaming_analytics import StreamingAnalytics
 import pandas as pd
 import numpy as np
 from dotenv import load_dotenv
 
-load_dotenv()
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../VBE-library/vbe'))
+from vote_cache import VoteCache
+from vote_data import VoteDataLoader
 
-class DataProcessor:
-    @staticmethod
-    def format_output(daopercentile_df, protocol, describe_output, measure):
-        percentiles = np.arange(10, 100, 10)
-        formatted_rows = []
-        for percentile in percentiles:
-            formatted_row = {
-                'id': len(daopercentile_df) + len(formatted_rows) + 1,
-                "protocol": protocol,
-                "measure": measure,
-                "percentile": float(percentile),
-                "value": describe_output.get(f'{percentile}%', np.nan),  # Handle missing percentiles
-                "mean": describe_output['mean'],
-                "std": describe_output['std']
-            }
-            formatted_rows.append(formatted_row)
-        
-        formatted_df = pd.DataFrame(formatted_rows)
-        daopercentile_df = pd.concat([daopercentile_df, formatted_df], ignore_index=True)
-
-        return daopercentile_df
-
-    @staticmethod
-    def votes_by_choice(proposal_df, field, measure, choice):
-        choice_df = proposal_df[proposal_df['choice'] == choice]
-        if measure == "sum_choice":
-            return choice_df['voter_address'].nunique()
-        
-        if measure in ["sum_voting_power", "avg_voting_power"]:
-            numeric_field = pd.to_numeric(choice_df[field], errors='coerce')  # Convert to numeric, set errors to NaN
-        
-            if measure == "sum_voting_power":
-                return numeric_field.sum()
-            
-            elif measure == "avg_voting_power":
-                return numeric_field.mean() if not numeric_field.isna().all() else 0  # Return 0 if all values are NaN
+load_dotenv()
 
 class AnalyticsGenerator:
     def __init__(self, merged_df):
         self.merged_df = merged_df
 
     def generate_dao_level_analytics(self):
-        protocol_list = self.merged_df['dao_id'].unique()
-        print("DAO list:", protocol_list)
-        daolevel_df = pd.DataFrame(columns=['id', 'protocol', 'dao_name', 'unique_voters', 'total_proposals', 'total_votes_cast', 'avg_votes_on_proposal', 'avg_votes_voter', 'avg_vp_voter', 'avg_voter_participation', 'gini_index', 'nakamoto_coefficient', 'min_entropy'])
-        daopercentile_df = pd.DataFrame(columns=['id', 'protocol', 'measure', 'mean', 'std', 'percentile', 'value'])
-
-        for dao_id in protocol_list:
-            print("DAO id:", dao_id)
-            dao_df = self.merged_df[self.merged_df['dao_id'] == dao_id]
-            if len(dao_df) == 0:
-                continue
-            
-            total_votes_cast = float(len(dao_df['voter_address']))  # Convert to float
-            unique_voter_ct = float(len(dao_df['voter_address'].unique()))  # Convert to float
-            total_proposals = float(len(dao_df['proposal_id'].unique()))  # Convert to float
-            avg_votes_voter = float(dao_df.groupby('voter_address').size().mean())  # Convert to float
-            average_vp = dao_df.groupby('voter_address')['voting_power'].max().astype(float)  # Convert to float # vag
-            average_vp_per_voter = float(average_vp.mean())  # Convert to float
-
-            # Gini index
-            sorted_vp = average_vp.sort_values().values
-            if len(sorted_vp) > 0:
-                cumulative_vp = np.cumsum(sorted_vp)
-                total_vp = cumulative_vp[-1]
-                normalized_cumulative_vp = cumulative_vp / total_vp
-                x = np.linspace(0, 1, len(normalized_cumulative_vp))
-                gini_index = 1 - 2 * np.trapz(normalized_cumulative_vp, x)
-            else:
-                gini_index = float('nan')
-            
-            # Average voter participation
-            votes_cast = dao_df.groupby('proposal_id')['voter_address'].nunique().tolist()
-            participation_rate = [votes / unique_voter_ct for votes in votes_cast]
-            avg_voter_participation = sum(participation_rate) / len(participation_rate)
-
-            # Nakamoto coefficient
-            sorted_vp_desc = average_vp.sort_values(ascending=False)
-            cumulative_vp_desc = np.cumsum(sorted_vp_desc)
-            threshold = 0.5 * cumulative_vp_desc[-1]  # 50% of the total voting power
-            index_of_threshold = np.argmax(cumulative_vp_desc >= threshold)
-            nakamoto_coefficient = int(index_of_threshold) + 1
-
-            # Minimum entropy
-            normalized_vp = average_vp / average_vp.sum()  # Normalize to get probabilities
-            min_entropy = -np.sum(normalized_vp * np.log2(normalized_vp + 1e-10))  # Add epsilon to avoid log(0)
-
-            new_row_df = pd.DataFrame([{
-                'id': len(daolevel_df) + 1,
-                'dao_name': dao_df['dao_name'].iloc[0],
-                'protocol': dao_id,
-                'total_votes_cast': total_votes_cast,
-                'total_proposals': total_proposals,
-                'unique_voters': unique_voter_ct,
-                'avg_votes_on_proposal': total_votes_cast / total_proposals,
-                'avg_vp_voter': average_vp_per_voter,
-                'avg_votes_voter': avg_votes_voter,
-                'avg_voter_participation': avg_voter_participation,
-                'gini_index': gini_index,
-                'nakamoto_coefficient': nakamoto_coefficient,
-                'min_entropy': min_entropy
-            }])
-            daolevel_df = pd.concat([daolevel_df, new_row_df], ignore_index=True)
-
-            # Create percentile df
-            avg_vp_describe = average_vp.describe(percentiles=np.arange(0.1, 1.0, 0.1)).to_dict()
-            vote_counts = dao_df['voter_address'].value_counts()
-            avg_vc_describe = vote_counts.describe(percentiles=np.arange(0.1, 1.0, 0.1)).to_dict()
-
-            # Create DataFrame for percentiles
-            daopercentile_df = DataProcessor.format_output(daopercentile_df, dao_id, avg_vp_describe, 'voting_power')
-            daopercentile_df = DataProcessor.format_output(daopercentile_df, dao_id, avg_vc_describe, 'vote_counts')
-
-        return daolevel_df, daopercentile_df
+        """
+        Computes the DAO level stats and percentiles of every DAO at once, see dao_metrics.DaoMetrics.
+
+        Returns:
+            tuple: The dao_stats and dao_percentile DataFrames.
+        """
+        metrics = DaoMetrics(self.merged_df)
+        print("DAO list:", list(metrics.dao_ids))
+        return metrics.stats(), metrics.percentiles()
 
     def generate_proposal_level_analytics(self, proposal_stats_df):
-        proposal_list = self.merged_df['proposal_id'].unique()
-        proposallevel_df = pd.DataFrame(columns=['id', 'proposal_id', 'choice', 'measure', 'value'])
-        if len(proposal_stats_df) > 0:
-            existing_proposals = proposal_stats_df['proposal_id'].unique()
-        else:
-            existing_proposals = []
-        
-        for proposal in proposal_list:
-            if proposal in existing_proposals:
-                continue
-            
-            print("Proposal id:", proposal)
-            proposal_df = self.merged_df[self.merged_df['proposal_id'] == proposal]
-            for choice in proposal_df['choice'].unique():
-                for measure in ['sum_choice', 'sum_voting_power', 'avg_voting_power']:
-                    field = 'voting_power' if 'voting_power' in measure else 'choice'
-                    value = DataProcessor.votes_by_choice(proposal_df, field, measure, choice)
-                    # Append the new row with the calculated metrics
-                    new_row = {
-                        'id': len(proposallevel_df) + 1,
-                        'proposal_id': proposal,
-                        'choice': choice,
-                        'measure': measure,
-                        'value': value
-                    }
-                    proposallevel_df = pd.concat([proposallevel_df, pd.DataFrame([new_row])], ignore_index=True)
+        """
+        Computes the votes and voting power of every choice of every proposal in one grouped pass.
 
+        Proposals already in proposal_stats_df are left out. Votes without a choice count as a choice
+        with zero values, as when each choice was filtered separately.
+
+        Args:
+            proposal_stats_df (pandas.DataFrame): The stored proposal stats, may be empty.
+
+        Returns:
+            pandas.DataFrame: One row per proposal, choice and measure, in the order proposals and choices first appear.
+        """
+        votes = self.merged_df[self.merged_df['proposal_id'].notna()]
+        if len(proposal_stats_df) > 0:
+            votes = votes[~votes['proposal_id'].isin(proposal_stats_df['proposal_id'])]
+
+        votes = pd.DataFrame({
+            'proposal_id': votes['proposal_id'].to_numpy(),
+            'choice': votes['choice'].to_numpy(),
+            'voter_address': votes['voter_address'].to_numpy(),
+            'voting_power': pd.to_numeric(votes['voting_power'], errors='coerce').to_numpy(),
+        })
+        stats = votes.groupby(['proposal_id', 'choice'], sort=False, dropna=False).agg(
+            sum_choice=('voter_address', 'nunique'),
+            sum_voting_power=('voting_power', 'sum'),
+            avg_voting_power=('voting_power', 'mean'),
+        ).reset_index()
+        # Choices of a proposal follow each other, proposals in the order they first appear
+        proposal_order = pd.Series(np.arange(votes['proposal_id'].nunique()), index=votes['proposal_id'].unique())
+        stats = stats.iloc[np.argsort(stats['proposal_id'].map(proposal_order).to_numpy(), kind='stable')]
+        stats['avg_voting_power'] = stats['avg_voting_power'].fillna(0)
+        stats.loc[stats['choice'].isna(), PROPOSAL_MEASURES] = 0
+
+        proposallevel_df = proposal_table(stats)
+        print(f"Computed stats of {len(proposal_order)} proposals")
         return proposallevel_df
 
+def get_args():
+    parser = argparse.ArgumentParser(description="Generate DAO and proposal level analytics")
+    parser.add_argument('--in_database', action='store_true', help='Refresh the stats as materialized views in the database instead of computing them here')
+    parser.add_argument('--incremental', action='store_true', help='Refresh the DAO stats of the DAOs with new votes only, from aggregates kept in the database')
+    parser.add_argument('--rebuild', action='store_true', help='With --incremental, build the aggregates again from every vote')
+    parser.add_argument('--streaming', action='store_true', help='Stream the votes from the database in batches instead of loading them all at once')
+    parser.add_argument('--batch_size', type=int, default=100000, help='Number of votes per batch when streaming')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes streaming the votes of different DAOs')
+    parser.add_argument('--relative_accuracy', type=float, default=0.01, help='Relative error of the deciles when streaming')
+    return parser.parse_args()
+
+def stream_partition(partition, batch_size, relative_accuracy):
+    """
+    Streams the votes of a partition of the DAOs from the database into streaming aggregates.
+
+    Args:
+        partition (tuple): (k, n) to stream the DAOs of partition k of n, or None for every DAO.
+        batch_size (int): Number of votes per batch.
+        relative_accuracy (float): Relative accuracy of the histograms.
+
+    Returns:
+        StreamingAnalytics: The aggregates of the partition's votes.
+    """
+    loader = VoteDataLoader(db.DatabaseHandler())
+    # Sorted by DAO and voter, so every voter's votes in a DAO are consecutive
+    batches = loader.iter_joined_votes('analytics', batch_size, order_by=('dao_id', 'voter_address'), partition=partition)
+    return StreamingAnalytics(relative_accuracy).consume(batches)
+
+def stream_from_database(workers, batch_size, relative_accuracy):
+    """
+    Streams the votes from the database, in parallel processes each streaming the votes of some of the DAOs.
+
+    Args:
+        workers (int): Number of processes.
+        batch_size (int): Number of votes per batch.
+        relative_accuracy (float): Relative accuracy of the histograms.
+
+    Returns:
+        StreamingAnalytics: The aggregates of every vote.
+    """
+    if workers <= 1:
+        return stream_partition(None, batch_size, relative_accuracy)
+    partitions = [(k, workers) for k in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(stream_partition, partitions, repeat(batch_size), repeat(relative_accuracy)))
+    analytics = results[0]
+    for result in results[1:]:
+        analytics.merge(result)
+    return analytics
+
+def refresh_in_database(save_to_csv):
+    """
+    Refreshes the stats views in the database, and copies their rows to CSV if asked to.
+
+    Args:
+        save_to_csv (str): "Y" to save the refreshed stats to CSV.
+    """
+    sql_handler = db.DatabaseHandler()
+    refreshed = sql_handler.refresh_materialized_views()
+    if not refreshed:
+        print("No stats views found, run migrations.py to create them")
+        return
+    if save_to_csv == "Y":
+        for view in refreshed:
+            print(f"Saving {view} to CSV...")
+            view_df = sql_handler.query_to_df(f"SELECT * FROM {view} ORDER BY id")
+            view_df.to_csv(f"../data_output/{view.removesuffix('_mv')}.csv", index=False)
+
 def main():
+    args = get_args()
     pd.set_option('display.max_columns', None)
-    load_from_csv = input("Do you want to **load** from CSV instead of using the database? (Y/N): ").strip().upper()
+    if args.in_database:
+        save_to_csv = input("Do you want to **save** the stats to CSV as well? (Y/N): ").strip().upper()
+        refresh_in_database(save_to_csv)
+        return
+    if args.incremental:
+        refresh_dao_stats(db.DatabaseHandler(), rebuild=args.rebuild)
+        return
+
+    # Votes are only streamed from the database
+    load_from_csv = "N" if args.streaming else input("Do you want to **load** from CSV instead of using the database? (Y/N): ").strip().upper()
     save_to_csv = input("Do you want to **save** to CSV instead of using the database? (Y/N): ").strip().upper()
     run_dao = input("Do you want to run DAO-level stats? (Y/N): ").strip().upper()
     run_proposal = input("Do you want to run proposal-level stats? (Y/N): ").strip().upper()
     
-    if load_from_csv == "Y":
+    # Votes are joined to their proposal and DAO while loading, proposals and votes come from the local cache first
+    if args.streaming:
+        print("Streaming data from database...")
+        sql_handler = db.DatabaseHandler()
+        analytics_generator = stream_from_database(args.workers, args.batch_size, args.relative_accuracy)
+        proposal_stats_df = VoteDataLoader(sql_handler).load_table('analytics', 'proposal_stats')
+    elif load_from_csv == "Y":
         print("Loading data from CSV files...")
-        voter_df = pd.read_csv("../data_output/votes.csv")
-        proposal_df = pd.read_csv("../data_output/proposals.csv")
-        dao_df = pd.read_csv("../data_output/dao.csv")
+        loader = VoteDataLoader(data_dir="../data_output", cache=VoteCache(data_dir="../data_output"))
+        merged_df = loader.load_joined_votes('analytics')
         proposal_stats_df = pd.DataFrame()
+        analytics_generator = AnalyticsGenerator(merged_df)
     else:
         print("Loading data from database...")
         sql_handler = db.DatabaseHandler()
-        voter_df = sql_handler.db_to_df("votes")
-        proposal_df = sql_handler.db_to_df("proposals")
-        dao_df = sql_handler.db_to_df("dao")
-        proposal_stats_df = sql_handler.db_to_df("proposal_stats")
-    
-    print("All data loaded, merging voters and proposals...")
-    merged_df = pd.merge(voter_df, proposal_df, how="left", on=['proposal_id'], suffixes=('', '_proposal'))
-    merged_df.drop(merged_df.filter(regex='_proposal$').columns, axis=1, inplace=True)
-    
-    print("Merging DAOs...")
-    merged_df = pd.merge(merged_df, dao_df, how="left", on=['dao_id'], suffixes=('', '_dao'))
-    merged_df.drop(merged_df.filter(regex='_dao$').columns, axis=1, inplace=True)
+        loader = VoteDataLoader(sql_handler, cache=VoteCache(sql_handler))
+        merged_df = loader.load_joined_votes('analytics')
+        proposal_stats_df = loader.load_table('analytics', 'proposal_stats')
+        analytics_generator = AnalyticsGenerator(merged_df)
+    print("All data loaded")
 
-    analytics_generator = AnalyticsGenerator(merged_df)
     if run_dao == "Y":
         print("Generating DAO level analytics...")
         dao_stats_df, dao_percentile_df = analytics_generator.generate_dao_level_analytics()
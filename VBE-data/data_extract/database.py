@@ -12,8 +12,12 @@ Example usage:
     handler.write_to_sql(df, 'my_table')
 
 """
+import io
+import math
 import os
+from decimal import Decimal
 from dotenv import load_dotenv
+import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine, text
 import psycopg2
@@ -21,7 +25,49 @@ from psycopg2 import sql
 
 load_dotenv()
 
+# Materialized views of the DAO and proposal stats, created by migrations.py
+ANALYTICS_VIEWS = ('dao_stats_mv', 'dao_percentile_mv', 'proposal_stats_mv')
+
+# Reads NUMERIC columns as floats instead of Decimal objects
+NUMERIC_AS_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, 'NUMERIC_AS_FLOAT', lambda value, cursor: float(value) if value is not None else None
+)
+
+def array_literal(values):
+    """
+    Formats a list as PostgreSQL prints an array, e.g. ['For', 'Against'] as {For,Against}.
+
+    Inserting a list with to_sql passes it as an array, which PostgreSQL stores in a text column in this format, so
+    rows copied with copy_upsert keep the format of the rows inserted before.
+    """
+    elements = []
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            elements.append(array_literal(value))
+        elif value is None:
+            elements.append('NULL')
+        elif isinstance(value, bool):
+            elements.append('t' if value else 'f')
+        elif isinstance(value, float):
+            elements.append('NaN' if math.isnan(value) else ('Infinity' if value > 0 else '-Infinity') if math.isinf(value) else format(Decimal(repr(value)), 'f'))
+        else:
+            element = str(value)
+            if element == '' or element.upper() == 'NULL' or any(c in element for c in '{},"\\ \t\n\r\v\f'):
+                element = '"' + element.replace('\\', '\\\\').replace('"', '\\"') + '"'
+            elements.append(element)
+    return '{' + ','.join(elements) + '}'
+
 class DatabaseHandler:
+    # Filters for tables without a dao_id column, matching rows through the DAO of their proposal
+    DAO_FILTERS = {
+        'votes': "proposal_id IN (SELECT proposal_id FROM proposals WHERE dao_id = ANY(%s))",
+        'proposal_stats': "proposal_id IN (SELECT proposal_id FROM proposals WHERE dao_id = ANY(%s))",
+    }
+    # Type OIDs of smallint, integer, bigint, real, double precision and numeric columns
+    NUMERIC_TYPE_CODES = {21, 23, 20, 700, 701, 1700}
+    # Marks missing values in the COPY data, so empty strings are kept as empty strings
+    COPY_NULL = '\\N'
+
     DEFAULT_CONFIG = {
         'host': os.getenv('DB_HOST'),
         'port': os.getenv('DB_PORT'),
@@ -39,6 +85,7 @@ class DatabaseHandler:
         """
         self.config = custom_config if custom_config else self.DEFAULT_CONFIG
         self.engine = create_engine(f"postgresql+psycopg2://{self.config['user']}:{self.config['password']}@{self.config['host']}:{self.config['port']}/{self.config['database']}")
+        self._unique_indexes = set()
         # print("DatabaseHandler init successful")
 
     def write_to_sql(self, df, table_name, if_exists='append', index=True):
@@ -57,16 +104,88 @@ class DatabaseHandler:
         print(f"Data written to table {table_name}")
 
 
-    def db_to_df(self, sql_table):
+    def db_to_df(self, sql_table, columns=None, dao_ids=None, batch_size=10000):
         """
         Retrieve data from the specified SQL table and return it as a pandas DataFrame.
 
+        Rows are streamed with query_to_df, so the table is never held as Python tuples.
+
         Parameters:
         sql_table (str): The name of the SQL table to retrieve data from.
+        columns (list, optional): The columns to retrieve, all columns if None.
+        dao_ids (list, optional): Only retrieve rows of these DAOs, filtered in the database. Tables without
+            a dao_id column are filtered through the DAO of their proposal.
+        batch_size (int, optional): The number of rows fetched per round trip.
 
         Returns:
         pandas.DataFrame: A DataFrame containing the retrieved data.
 
+        """
+        projection = sql.SQL(', ').join(sql.Identifier(column) for column in columns) if columns else sql.SQL('*')
+        query = sql.SQL("SELECT {} FROM {}").format(projection, sql.Identifier(sql_table))
+        params = None
+        if dao_ids is not None:
+            query += sql.SQL(" WHERE ") + sql.SQL(self.DAO_FILTERS.get(sql_table, "dao_id = ANY(%s)"))
+            params = ([str(dao_id) for dao_id in dao_ids],)
+        return self.query_to_df(query, params, batch_size)
+
+    def query_to_df(self, query, params=None, batch_size=10000):
+        """
+        Runs a SELECT query and streams its rows into a pandas DataFrame.
+
+        Rows are read from a server-side cursor and each batch is converted into typed column arrays as soon
+        as it is fetched, so the result is never held as Python tuples. NUMERIC columns are read as floats.
+
+        Args:
+            query (str or psycopg2.sql.Composable): The SELECT query to run.
+            params (tuple, optional): The query parameters.
+            batch_size (int, optional): The number of rows fetched per round trip.
+
+        Returns:
+            pandas.DataFrame: A DataFrame containing the query results.
+        """
+        names = []
+        chunks = None
+        n_records = 0
+        for names, columns in self._fetch_columns(query, params, batch_size):
+            if chunks is None:
+                chunks = [[] for _ in names]
+            if not columns:
+                continue
+            for position, column in enumerate(columns):
+                chunks[position].append(column)
+            n_records += len(columns[0])
+            print(f"Fetched {n_records} records so far...")
+        print(f"Total records fetched: {n_records}")
+
+        # Columns are concatenated one at a time, so only one column is held twice
+        df = pd.DataFrame(index=pd.RangeIndex(n_records))
+        for position, name in enumerate(names):
+            df[name] = pd.concat(chunks[position], ignore_index=True) if chunks[position] else pd.Series(dtype=object)
+            chunks[position] = None
+        return df
+
+    def iter_query(self, query, params=None, batch_size=100000):
+        """
+        Runs a SELECT query and yields its rows in batches, so a result larger than memory can be processed.
+
+        Args:
+            query (str or psycopg2.sql.Composable): The SELECT query to run.
+            params (tuple, optional): The query parameters.
+            batch_size (int, optional): The number of rows per batch.
+
+        Yields:
+            pandas.DataFrame: Up to batch_size rows of the result, typed as in query_to_df.
+        """
+        for names, columns in self._fetch_columns(query, params, batch_size):
+            if columns:
+                yield pd.DataFrame(dict(zip(names, columns)))
+
+    def _fetch_columns(self, query, params, batch_size):
+        """
+        Runs a query on a server-side cursor and yields the column names and typed columns of each fetched batch.
+
+        The names are yielded once with no columns if the query returns no rows.
         """
         connection = psycopg2.connect(
             dbname=self.config['database'],
@@ -75,21 +194,142 @@ class DatabaseHandler:
             host=self.config['host'],
             port=self.config['port']
         )
-        cursor = connection.cursor()
-        cursor.execute("SET search_path TO public;")
-        query = f"""SELECT * FROM {sql_table};"""
-        cursor.execute(query)
-        records = cursor.fetchall()
-        columns = [desc[0] for desc in cursor.description]
-        df = pd.DataFrame(records, columns=columns)
-        cursor.close()
-        connection.close()
-        return df
+        try:
+            psycopg2.extensions.register_type(NUMERIC_AS_FLOAT, connection)
+            cursor = connection.cursor()
+            cursor.execute("SET search_path TO public;")
+            cursor.close()
+            cursor = connection.cursor(name="large_query_cursor")
+            cursor.execute(query, params)
+
+            fetched = False
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                names = [desc[0] for desc in cursor.description]
+                if not batch:
+                    break
+                fetched = True
+                yield names, [self._column_array(values, cursor.description[position].type_code) for position, values in enumerate(zip(*batch))]
+            if not fetched:
+                yield names, []
+            cursor.close()
+        finally:
+            connection.close()
 
+    @classmethod
+    def _column_array(cls, values, type_code):
+        """Converts one column of a fetched batch into a typed Series, numeric columns of NULLs become NaN floats."""
+        column = pd.Series(values)
+        if type_code in cls.NUMERIC_TYPE_CODES and column.dtype == object:
+            column = column.astype(np.float64)
+        return column
 
     def df_to_sql(self, df, table_name, if_exists='append'):
         df.to_sql(table_name, self.engine, schema='public', if_exists=if_exists, index=False)
 
+    def ensure_unique_index(self, table_name, key_columns):
+        """
+        Creates the unique index copy_upsert merges on, if it does not exist yet.
+
+        Args:
+            table_name (str): The name of the SQL table.
+            key_columns (list): The columns identifying a row.
+
+        Raises:
+            ValueError: If the table already holds rows with the same key.
+        """
+        index_name = f"{table_name}_{'_'.join(key_columns)}_key"
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {}.{} ({});").format(
+                sql.Identifier(index_name), sql.Identifier('public'), sql.Identifier(table_name),
+                sql.SQL(', ').join(sql.Identifier(column) for column in key_columns)
+            ))
+            connection.commit()
+        except psycopg2.errors.UniqueViolation as e:
+            connection.rollback()
+            raise ValueError(f"{table_name} holds rows with the same {', '.join(key_columns)}, remove the duplicates before ingesting into it") from e
+        finally:
+            connection.close()
+
+    def copy_upsert(self, df, table_name, key_columns):
+        """
+        Inserts the rows of a DataFrame whose key is not in a SQL table yet, in a single transaction using COPY FROM STDIN.
+
+        Rows are copied into a temporary staging table with the target table's column types, so values are parsed
+        as e.g. timestamps by COPY itself, and merged into the target table
+        with INSERT ... ON CONFLICT DO NOTHING, so rows already stored, by this or a concurrent run, are skipped
+        without reading the table first. The unique index on the key is created on first use.
+
+        Args:
+            df (pandas.DataFrame): The rows to insert, with columns named after the table's columns.
+            table_name (str): The name of the SQL table.
+            key_columns (list): The columns identifying a row, e.g. ['platform', 'vote_id'].
+
+        Returns:
+            tuple: The number of rows inserted and the number of rows skipped.
+        """
+        if df.empty:
+            return 0, 0
+        if (table_name, tuple(key_columns)) not in self._unique_indexes:
+            self.ensure_unique_index(table_name, key_columns)
+            self._unique_indexes.add((table_name, tuple(key_columns)))
+
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            staging = sql.Identifier(f"{table_name}_staging")
+            columns = sql.SQL(', ').join(sql.Identifier(column) for column in df.columns)
+            cursor.execute(sql.SQL("CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {}.{} WITH NO DATA;").format(
+                staging, columns, sql.Identifier('public'), sql.Identifier(table_name)
+            ))
+
+            # Lists, like the choices of a proposal, are stored as array literals, as to_sql stored them
+            df = df.apply(lambda column: column.map(lambda value: array_literal(value) if isinstance(value, (list, tuple)) else value) if column.dtype == object else column)
+            buffer = io.StringIO()
+            df.to_csv(buffer, index=False, header=False, na_rep=self.COPY_NULL)
+            buffer.seek(0)
+            cursor.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL {});").format(staging, columns, sql.Literal(self.COPY_NULL)), buffer)
+            cursor.execute(sql.SQL("INSERT INTO {}.{} ({}) SELECT {} FROM {} ON CONFLICT ({}) DO NOTHING;").format(
+                sql.Identifier('public'), sql.Identifier(table_name), columns, columns, staging,
+                sql.SQL(', ').join(sql.Identifier(column) for column in key_columns)
+            ))
+            inserted = cursor.rowcount
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        return inserted, len(df) - inserted
+
+    def refresh_materialized_views(self, views=ANALYTICS_VIEWS):
+        """
+        Refreshes materialized views without blocking reads of them, skipping views that do not exist.
+
+        Args:
+            views (iterable, optional): Names of the views, the DAO and proposal stats views by default.
+
+        Returns:
+            list: The views refreshed.
+        """
+        connection = self.engine.raw_connection()
+        refreshed = []
+        try:
+            cursor = connection.cursor()
+            for view in views:
+                cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (f"public.{view}",))
+                if not cursor.fetchone()[0]:
+                    continue
+                cursor.execute(sql.SQL("REFRESH MATERIALIZED VIEW CONCURRENTLY {}.{};").format(sql.Identifier('public'), sql.Identifier(view)))
+                connection.commit()
+                refreshed.append(view)
+                print(f"Refreshed {view}")
+        finally:
+            connection.close()
+        return refreshed
+
     def get_schema(self, table_name):
         query = f"""SELECT 
                     column_name, 
@@ -0,0 +1,365 @@
+"""
+migrations.py
+
+This module upgrades the database schema through numbered migrations, recorded in the schema_migrations table.
+
+Each migration runs in its own transaction and checks the current schema before changing it, so running it again,
+or on a database that was already changed by hand, does nothing. A new database is created by the first migration
+with rdb.create_tables, an existing one is brought up to date from wherever it is.
+
+Key features:
+- Unique keys on proposals and votes, removing duplicate rows stored before
+- Indexes on votes(proposal_id), votes(voter_address) and proposals(dao_id, end_date)
+- Proposal dates stored as timestamptz instead of text
+- Optional list partitioning of votes by platform
+- Materialized views computing the DAO and proposal stats in the database, with the HHI of the voting power
+- Per DAO aggregates the DAO stats are refreshed from, for the DAOs with new votes only
+
+Example usage:
+    python migrations.py
+    python migrations.py --partition_votes
+"""
+
+import argparse
+import psycopg2
+from psycopg2 import sql
+
+from rdb import create_tables, db_params
+
+DATE_COLUMNS = ('start_date', 'end_date', 'created')
+# Partitions of the votes table by platform, votes of other platforms go to the default partition
+VOTE_PARTITIONS = {'votes_snapshot': 'Snapshot', 'votes_tally': 'Tally'}
+
+
+def table_exists(cur, table_name):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (f"public.{table_name}",))
+    return cur.fetchone()[0]
+
+
+def column_type(cur, table_name, column):
+    cur.execute(
+        "SELECT data_type FROM information_schema.columns WHERE table_schema = 'public' AND table_name = %s AND column_name = %s;",
+        (table_name, column)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def is_partitioned(cur, table_name):
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s));", (f"public.{table_name}",))
+    return cur.fetchone()[0]
+
+
+def create_schema(cur):
+    """Creates the tables of rdb.create_tables, unless the database already has them."""
+    if not table_exists(cur, 'proposals'):
+        create_tables(cur)
+
+
+def add_unique_keys(cur):
+    """Adds the unique keys the extractors upsert on, keeping the first stored row of each key."""
+    cur.execute("""
+        DELETE FROM proposals a USING proposals b
+        WHERE a.proposal_id = b.proposal_id AND a.id > b.id;
+    """)
+    print(f"Removed {cur.rowcount} duplicate proposals")
+    cur.execute("""
+        DELETE FROM votes a USING votes b
+        WHERE a.platform IS NOT DISTINCT FROM b.platform AND a.vote_id = b.vote_id AND a.id > b.id;
+    """)
+    print(f"Removed {cur.rowcount} duplicate votes")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS proposals_proposal_id_key ON proposals (proposal_id);")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS votes_platform_vote_id_key ON votes (platform, vote_id);")
+    # The key of earlier versions, which a partitioned votes table cannot have
+    cur.execute("DROP INDEX IF EXISTS votes_vote_id_key;")
+
+
+def convert_dates(cur):
+    """Stores the proposal dates as timestamptz, text dates are read in the database's time zone."""
+    for column in DATE_COLUMNS:
+        if column_type(cur, 'proposals', column) in ('character varying', 'text'):
+            cur.execute(sql.SQL("ALTER TABLE proposals ALTER COLUMN {0} TYPE TIMESTAMPTZ USING NULLIF(TRIM({0}), '')::TIMESTAMPTZ;").format(sql.Identifier(column)))
+            print(f"Converted proposals.{column} to timestamptz")
+
+
+def add_indexes(cur):
+    """Indexes the columns votes and proposals are filtered and joined on."""
+    cur.execute("CREATE INDEX IF NOT EXISTS votes_proposal_id_idx ON votes (proposal_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS votes_voter_address_idx ON votes (voter_address);")
+    cur.execute("CREATE INDEX IF NOT EXISTS proposals_dao_id_end_date_idx ON proposals (dao_id, end_date);")
+
+
+def partition_votes(cur):
+    """
+    Moves the votes into a table list partitioned by platform.
+
+    The unique keys of a partitioned table must include the platform, so the primary key on id is replaced by a
+    unique index on (id, platform), which still allows votes without a platform. Vote IDs keep coming from the same
+    sequence.
+    """
+    if is_partitioned(cur, 'votes'):
+        return
+    # Views on the votes would keep the old table from being dropped, they are created again afterwards
+    views = [view for view in ANALYTICS_VIEW_DEFINITIONS if table_exists(cur, view)]
+    for view in views:
+        cur.execute(sql.SQL("DROP MATERIALIZED VIEW {};").format(sql.Identifier(view)))
+    cur.execute("ALTER TABLE votes RENAME TO votes_unpartitioned;")
+    cur.execute("CREATE TABLE votes (LIKE votes_unpartitioned INCLUDING DEFAULTS) PARTITION BY LIST (platform);")
+    for partition, platform in VOTE_PARTITIONS.items():
+        cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF votes FOR VALUES IN ({});").format(sql.Identifier(partition), sql.Literal(platform)))
+    cur.execute("CREATE TABLE votes_default PARTITION OF votes DEFAULT;")
+    cur.execute("INSERT INTO votes SELECT * FROM votes_unpartitioned;")
+    print(f"Moved {cur.rowcount} votes into partitions")
+    # The sequence would be dropped with the table that owns it
+    cur.execute("ALTER SEQUENCE votes_id_seq OWNED BY votes.id;")
+    cur.execute("DROP TABLE votes_unpartitioned;")
+    cur.execute("CREATE UNIQUE INDEX votes_id_platform_key ON votes (id, platform);")
+    cur.execute("CREATE UNIQUE INDEX votes_platform_vote_id_key ON votes (platform, vote_id);")
+    add_indexes(cur)
+    if views:
+        create_analytics_views(cur)
+
+
+# Votes with the DAO of their proposal and voting power as a float, shared by the DAO level views
+DAO_VOTES_SQL = """
+    dao_votes AS (
+        SELECT p.dao_id, v.proposal_id, v.voter_address, v.voting_power::DOUBLE PRECISION AS voting_power
+        FROM votes v
+        JOIN proposals p ON p.proposal_id = v.proposal_id
+        WHERE p.dao_id IS NOT NULL
+    ),
+    voter_power AS (
+        SELECT dao_id, voter_address, MAX(voting_power) AS voting_power, COUNT(*) AS vote_count
+        FROM dao_votes
+        WHERE voter_address IS NOT NULL
+        GROUP BY dao_id, voter_address
+    )
+"""
+
+# Definitions of the views, each with the unique index REFRESH MATERIALIZED VIEW CONCURRENTLY needs.
+# They compute the same measures as dao_metrics.DaoMetrics and data_analytics.AnalyticsGenerator.
+ANALYTICS_VIEW_DEFINITIONS = {
+    'dao_stats_mv': ("""
+        WITH """ + DAO_VOTES_SQL + """,
+        ranked AS (
+            SELECT dao_id, voting_power,
+                SUM(voting_power) OVER (PARTITION BY dao_id ORDER BY voting_power ROWS UNBOUNDED PRECEDING) AS cumulative_asc,
+                SUM(voting_power) OVER (PARTITION BY dao_id ORDER BY voting_power DESC ROWS UNBOUNDED PRECEDING) AS cumulative_desc,
+                SUM(voting_power) OVER (PARTITION BY dao_id) AS total_vp,
+                COUNT(*) OVER (PARTITION BY dao_id) AS n_voters
+            FROM voter_power
+            WHERE voting_power IS NOT NULL
+        ),
+        concentration AS (
+            -- Gini index as 1 - 2 * the trapezoid area under the Lorenz curve, Nakamoto coefficient as the
+            -- number of largest voters needed to pass half of the voting power
+            SELECT dao_id,
+                CASE WHEN MAX(n_voters) = 1 THEN 1.0
+                     ELSE 1 - 2 * (SUM(cumulative_asc / NULLIF(total_vp, 0)) - (MIN(cumulative_asc) / NULLIF(MAX(total_vp), 0) + 1) / 2) / (MAX(n_voters) - 1)
+                END AS gini_index,
+                COUNT(*) FILTER (WHERE cumulative_desc - voting_power < 0.5 * total_vp) AS nakamoto_coefficient,
+                -SUM(voting_power / NULLIF(total_vp, 0) * LN(voting_power / NULLIF(total_vp, 0) + 1e-10) / LN(2)) AS min_entropy,
+                SUM(POWER(voting_power / NULLIF(total_vp, 0), 2)) AS hhi
+            FROM ranked
+            GROUP BY dao_id
+        ),
+        participation AS (
+            SELECT dao_id, AVG(voters) AS avg_proposal_voters
+            FROM (SELECT dao_id, proposal_id, COUNT(DISTINCT voter_address) AS voters FROM dao_votes GROUP BY dao_id, proposal_id) proposal_voters
+            GROUP BY dao_id
+        ),
+        totals AS (
+            SELECT dao_id, COUNT(*) AS total_votes_cast, COUNT(DISTINCT voter_address) AS unique_voters, COUNT(DISTINCT proposal_id) AS total_proposals
+            FROM dao_votes
+            GROUP BY dao_id
+        ),
+        voter_averages AS (
+            SELECT dao_id, AVG(vote_count) AS avg_votes_voter, AVG(voting_power) AS avg_vp_voter
+            FROM voter_power
+            GROUP BY dao_id
+        )
+        SELECT
+            ROW_NUMBER() OVER (ORDER BY t.dao_id) AS id,
+            t.dao_id AS protocol,
+            (SELECT d.dao_name FROM dao d WHERE d.dao_id = t.dao_id ORDER BY d.id LIMIT 1) AS dao_name,
+            t.unique_voters::DOUBLE PRECISION AS unique_voters,
+            t.total_proposals::DOUBLE PRECISION AS total_proposals,
+            t.total_votes_cast::DOUBLE PRECISION AS total_votes_cast,
+            t.total_votes_cast::DOUBLE PRECISION / t.total_proposals AS avg_votes_on_proposal,
+            a.avg_votes_voter::DOUBLE PRECISION AS avg_votes_voter,
+            a.avg_vp_voter,
+            pa.avg_proposal_voters::DOUBLE PRECISION / NULLIF(t.unique_voters, 0) AS avg_voter_participation,
+            c.gini_index,
+            c.nakamoto_coefficient,
+            c.min_entropy,
+            c.hhi
+        FROM totals t
+        JOIN voter_averages a ON a.dao_id = t.dao_id
+        JOIN participation pa ON pa.dao_id = t.dao_id
+        LEFT JOIN concentration c ON c.dao_id = t.dao_id
+    """, ['protocol']),
+    'dao_percentile_mv': ("""
+        WITH """ + DAO_VOTES_SQL + """,
+        measures AS (
+            SELECT dao_id, 'voting_power' AS measure, voting_power AS value FROM voter_power
+            UNION ALL
+            SELECT dao_id, 'vote_counts' AS measure, vote_count::DOUBLE PRECISION AS value FROM voter_power
+        ),
+        summary AS (
+            SELECT dao_id, measure, AVG(value) AS mean, STDDEV_SAMP(value) AS std,
+                PERCENTILE_CONT(ARRAY[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]::DOUBLE PRECISION[]) WITHIN GROUP (ORDER BY value) AS percentile_values
+            FROM measures
+            GROUP BY dao_id, measure
+        )
+        SELECT
+            ROW_NUMBER() OVER (ORDER BY s.dao_id, s.measure = 'vote_counts', p.percentile) AS id,
+            s.dao_id AS protocol, s.measure, s.mean, s.std, p.percentile, p.value
+        FROM summary s
+        CROSS JOIN LATERAL UNNEST(ARRAY[10, 20, 30, 40, 50, 60, 70, 80, 90]::DOUBLE PRECISION[], s.percentile_values) AS p(percentile, value)
+    """, ['protocol', 'measure', 'percentile']),
+    'proposal_stats_mv': ("""
+        SELECT
+            ROW_NUMBER() OVER (ORDER BY s.proposal_id, s.choice, m.measure) AS id,
+            s.proposal_id, s.choice, m.measure, m.value
+        FROM (
+            SELECT proposal_id, choice,
+                COUNT(DISTINCT voter_address) AS sum_choice,
+                COALESCE(SUM(voting_power), 0) AS sum_voting_power,
+                COALESCE(AVG(voting_power), 0) AS avg_voting_power
+            FROM votes
+            WHERE choice IS NOT NULL
+            GROUP BY proposal_id, choice
+        ) s
+        CROSS JOIN LATERAL (VALUES
+            ('sum_choice', s.sum_choice::NUMERIC),
+            ('sum_voting_power', s.sum_voting_power),
+            ('avg_voting_power', s.avg_voting_power)
+        ) AS m(measure, value)
+    """, ['proposal_id', 'choice', 'measure']),
+}
+
+
+def create_analytics_views(cur):
+    """Creates the materialized views of the DAO and proposal stats, computed from the current votes."""
+    for view, (query, key_columns) in ANALYTICS_VIEW_DEFINITIONS.items():
+        cur.execute(sql.SQL("CREATE MATERIALIZED VIEW IF NOT EXISTS {} AS {};").format(sql.Identifier(view), sql.SQL(query)))
+        cur.execute(sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({});").format(
+            sql.Identifier(f"{view}_key"), sql.Identifier(view), sql.SQL(', ').join(sql.Identifier(column) for column in key_columns)
+        ))
+
+
+def add_hhi_to_dao_stats(cur):
+    """Creates the DAO stats view again with the HHI column, views cannot gain a column in place."""
+    if not table_exists(cur, 'dao_stats_mv'):
+        return
+    cur.execute("SELECT 1 FROM pg_attribute WHERE attrelid = 'public.dao_stats_mv'::regclass AND attname = 'hhi';")
+    if cur.fetchone():
+        return
+    cur.execute("DROP MATERIALIZED VIEW dao_stats_mv;")
+    create_analytics_views(cur)
+
+
+def create_dao_state(cur):
+    """Creates the per DAO aggregates the DAO stats are refreshed from incrementally, see dao_state.py."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS dao_state (
+            dao_id VARCHAR(255) PRIMARY KEY,
+            dao_name VARCHAR(255),
+            votes_cast BIGINT NOT NULL,
+            null_voter BOOLEAN NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS dao_voter_state (
+            dao_id VARCHAR(255),
+            voter_address VARCHAR(255),
+            voting_power DOUBLE PRECISION,
+            vote_count BIGINT NOT NULL,
+            PRIMARY KEY (dao_id, voter_address)
+        );
+        CREATE TABLE IF NOT EXISTS dao_proposal_state (
+            proposal_id VARCHAR(255) PRIMARY KEY,
+            dao_id VARCHAR(255) NOT NULL,
+            voters BIGINT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS dao_proposal_state_dao_id_idx ON dao_proposal_state (dao_id);
+        CREATE TABLE IF NOT EXISTS analytics_watermarks (
+            name VARCHAR(255) PRIMARY KEY,
+            last_vote_id BIGINT NOT NULL,
+            updated_at TIMESTAMPTZ DEFAULT now()
+        );
+    """)
+
+
+# Migrations by version, in the order they are applied. Optional ones are only applied when asked for.
+MIGRATIONS = [
+    (1, "Create the tables", create_schema, False),
+    (2, "Unique keys on proposals and votes", add_unique_keys, False),
+    (3, "Proposal dates as timestamptz", convert_dates, False),
+    (4, "Indexes on votes and proposals", add_indexes, False),
+    (5, "Partition votes by platform", partition_votes, True),
+    (6, "Materialized views of the DAO and proposal stats", create_analytics_views, False),
+    (7, "HHI of the voting power in the DAO stats view", add_hhi_to_dao_stats, False),
+    (8, "Per DAO aggregates for incremental DAO stats", create_dao_state, False),
+]
+
+
+def applied_versions(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMPTZ DEFAULT now()
+        );
+    """)
+    cur.execute("SELECT version FROM schema_migrations;")
+    return {row[0] for row in cur.fetchall()}
+
+
+def migrate(conn, optional=()):
+    """
+    Applies the migrations the database has not had yet, each one in its own transaction.
+
+    Args:
+        conn (psycopg2.extensions.connection): Connection to the database.
+        optional (iterable, optional): Versions of the optional migrations to apply as well.
+
+    Returns:
+        list: The versions applied.
+    """
+    cur = conn.cursor()
+    cur.execute("SET search_path TO public;")
+    applied = applied_versions(cur)
+    conn.commit()
+
+    newly_applied = []
+    for version, description, migration, is_optional in MIGRATIONS:
+        if version in applied or (is_optional and version not in optional):
+            continue
+        print(f"Applying migration {version}: {description}")
+        try:
+            migration(cur)
+            cur.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s);", (version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        newly_applied.append(version)
+
+    if not newly_applied:
+        print("Database schema is up to date")
+    cur.close()
+    return newly_applied
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Upgrade the database schema")
+    parser.add_argument('--partition_votes', action='store_true', help='Also partition the votes table by platform')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    conn = psycopg2.connect(**db_params)
+    try:
+        migrate(conn, optional=[5] if args.partition_votes else [])
+    finally:
+        conn.close()
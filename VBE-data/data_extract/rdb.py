@@ -60,6 +60,8 @@ def create_tables(cur):
         proposer VARCHAR(255),
         discussion TEXT
     );
+    -- Unique keys the extractors' COPY upserts merge on
+    CREATE UNIQUE INDEX proposals_proposal_id_key ON proposals (proposal_id);
 
     CREATE TABLE dao (
         id SERIAL PRIMARY KEY,
@@ -89,6 +91,7 @@ def create_tables(cur):
         reason TEXT,
         discussion VARCHAR(2000)
     );
+    CREATE UNIQUE INDEX votes_platform_vote_id_key ON votes (platform, vote_id);
 
     CREATE TABLE proposal_stats (
         id SERIAL PRIMARY KEY,
@@ -0,0 +1,151 @@
+"""
+response_archive.py
+
+This module records the raw responses of the Snapshot, Tally and Boardroom APIs, so tables can be rebuilt from them
+without the network.
+
+Each response is stored as one line of gzip compressed NDJSON, keyed by the API, the query and its variables. Every
+line is its own gzip member, so a file reads as ordinary gzip NDJSON while a replay decompresses only the lines it
+needs, found through an index file next to it. Recording a request again on a later run replaces it on replay.
+
+Key features:
+- Recording of the responses of successful requests, one archive file per API and run
+- Replay of recorded responses, a request that was never recorded raises ArchiveMiss
+
+Example usage:
+    archive = ResponseArchive('../data_archive')
+    api = SnapshotAPI(archive=archive)
+    ...
+    api = SnapshotAPI(archive=ResponseArchive('../data_archive', replay=True))
+"""
+
+import glob
+import gzip
+import hashlib
+import json
+import os
+import threading
+import zlib
+from datetime import datetime
+
+DEFAULT_ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_archive')
+
+
+class ArchiveMiss(Exception):
+    """Raised when replaying a request that was never recorded."""
+
+
+class ResponseArchive:
+    """
+    Raw API responses, recorded or replayed.
+
+    Attributes:
+        archive_dir (str): Directory of the archive files, one subdirectory per API.
+        replay (bool): Whether responses are read from the archive instead of recorded to it.
+    """
+    def __init__(self, archive_dir=DEFAULT_ARCHIVE_DIR, replay=False):
+        self.archive_dir = archive_dir
+        self.replay = replay
+        self._lock = threading.Lock()
+        self._files = {}
+        self._index = None
+        self._run_id = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+
+    @staticmethod
+    def key(source, query, variables):
+        """
+        Returns the key a request is archived under.
+
+        Args:
+            source (str): The API, e.g. 'snapshot'.
+            query (str): The query, or the endpoint of a REST API.
+            variables (dict): The query variables or request parameters, without credentials.
+
+        Returns:
+            str: The SHA-256 of the request.
+        """
+        payload = json.dumps([source, query, variables], sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def record(self, source, query, variables, response):
+        """
+        Appends a response to this run's archive file of the API.
+
+        Args:
+            source (str): The API, e.g. 'snapshot'.
+            query (str): The query, or the endpoint of a REST API.
+            variables (dict): The query variables or request parameters, without credentials.
+            response: The decoded JSON response.
+        """
+        key = self.key(source, query, variables)
+        line = json.dumps({
+            'key': key,
+            'source': source,
+            'query': query,
+            'variables': variables,
+            'recorded_at': datetime.now().isoformat(),
+            'response': response,
+        }, default=str) + '\n'
+        member = gzip.compress(line.encode())
+
+        with self._lock:
+            if source not in self._files:
+                os.makedirs(os.path.join(self.archive_dir, source), exist_ok=True)
+                path = os.path.join(self.archive_dir, source, f"{self._run_id}.ndjson.gz")
+                self._files[source] = (open(path, 'ab'), open(path + '.index', 'a'))
+            data_file, index_file = self._files[source]
+            offset = data_file.tell()
+            data_file.write(member)
+            data_file.flush()
+            # The index line is written last, so it only ever points at a complete member
+            index_file.write(json.dumps({'key': key, 'offset': offset, 'length': len(member)}) + '\n')
+            index_file.flush()
+
+    def lookup(self, source, query, variables):
+        """
+        Reads the response recorded last for a request.
+
+        Args:
+            source (str): The API, e.g. 'snapshot'.
+            query (str): The query, or the endpoint of a REST API.
+            variables (dict): The query variables or request parameters, without credentials.
+
+        Returns:
+            The decoded JSON response.
+        """
+        with self._lock:
+            if self._index is None:
+                self._index = self._load_index()
+        location = self._index.get(self.key(source, query, variables))
+        if location is None:
+            raise ArchiveMiss(f"No {source} response archived for {json.dumps(variables, default=str)}")
+
+        path, offset, length = location
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            member = f.read(length)
+        return json.loads(zlib.decompress(member, wbits=31))['response']
+
+    def _load_index(self):
+        """Maps each recorded key to its member, later runs replacing earlier ones."""
+        index = {}
+        for index_path in sorted(glob.glob(os.path.join(self.archive_dir, '*', '*.ndjson.gz.index'))):
+            data_path = index_path[:-len('.index')]
+            with open(index_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line of a run that stopped while writing it
+                        continue
+                    index[entry['key']] = (data_path, entry['offset'], entry['length'])
+        print(f"Replaying {len(index)} archived responses from {self.archive_dir}")
+        return index
+
+    def close(self):
+        """Closes the files recorded to."""
+        with self._lock:
+            for data_file, index_file in self._files.values():
+                data_file.close()
+                index_file.close()
+            self._files = {}
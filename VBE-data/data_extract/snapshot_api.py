@@ -8,18 +8,28 @@ The SnapshotAPI class encapsulates methods for fetching information about DAOs,
 Key features:
 - Fetching DAO information
 - Retrieving proposal details
-- Collecting voting data for proposals
+- Collecting voting data for proposals, several proposals at once within the API's rate limit
 - Creating structured DataFrames from the fetched data
+- Resuming interrupted runs from the checkpoint saved after each page of votes
 
 Note: Ensure that the required environment variables (SNAPSHOT_API_KEY) are set before using this module.
 """
 
+import argparse
+import functools
 import re
 import sys, os
+import threading
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../VBE-library/vbe'))
 
 import database as db
+from vote_data import VoteDataLoader
+from concurrent_fetch import RateLimiter, fetch_concurrently, retry_delay
+from response_archive import ArchiveMiss, ResponseArchive, DEFAULT_ARCHIVE_DIR
+from checkpoint import CheckpointStore, output_name, DEFAULT_PATH as DEFAULT_CHECKPOINT_PATH
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import datetime
 import pandas as pd
@@ -37,14 +47,33 @@ class SnapshotAPI:
     Attributes:
         GRAPHQL_ENDPOINT (str): The URL of the GraphQL endpoint for the Snapshot API.
         HEADERS (dict): The headers to be used in API requests.
+        MAX_RETRIES (int): Number of times a rate limited request is retried.
+        MAX_SKIP (int): Largest skip the API accepts.
+        endpoint (str): The GraphQL endpoint queried, GRAPHQL_ENDPOINT unless another server is given.
+        workers (int): Number of proposals whose votes are fetched at once.
+        rate_limiter (RateLimiter): Paces the requests of every thread.
+        archive (ResponseArchive): Archive the responses are recorded to or replayed from, None to only query the API.
     """
     GRAPHQL_ENDPOINT = "https://hub.snapshot.org/graphql"
     HEADERS = {'x-api-key': os.getenv('SNAPSHOT_API_KEY')}
+    MAX_RETRIES = 5
+    MAX_SKIP = 5000
 
-    def __init__(self):
+    def __init__(self, endpoint=None, requests_per_second=4.0, workers=4, archive=None):
         """
         Initializes the SnapshotAPI class and sets up the GraphQL queries.
+
+        Args:
+            endpoint (str, optional): The GraphQL endpoint to query, e.g. a local stub server. Defaults to GRAPHQL_ENDPOINT.
+            requests_per_second (float, optional): Requests sent per second over all threads.
+            workers (int, optional): Number of proposals whose votes are fetched at once.
+            archive (ResponseArchive, optional): Archive to record the responses to, or to replay them from without the network.
         """
+        self.endpoint = endpoint or self.GRAPHQL_ENDPOINT
+        self.workers = workers
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.archive = archive
+        self._local = threading.local()
         self.dao_query = """
         query GetDao($dao: String!) {
           space(id: $dao) {
@@ -70,16 +99,19 @@ class SnapshotAPI:
             }
           }
         """
+        # Closed proposals are paged by their end time, a proposal that closes later ends after those already fetched
         self.proposals_query = """
-        query GetProposals($space: String!) {
+        query GetProposals($space: String!, $end: Int, $skip: Int, $limit: Int) {
           proposals(
-            first: 300,
+            first: $limit,
+            skip: $skip
             where: {
               space_in: [$space],
-              state: "closed"
+              state: "closed",
+              end_gte: $end
             },
-            orderBy: "created",
-            orderDirection: desc
+            orderBy: "end",
+            orderDirection: asc
           ) {
             id
             title
@@ -100,20 +132,22 @@ class SnapshotAPI:
           }
         }
         """
+        # Votes are paged by their creation time, skip only steps over votes created in the same second
         self.votes_query = """
-        query GetVotes($proposal: String!, $offset: Int, $limit: Int, $min_vp: Float) {
+        query GetVotes($proposal: String!, $created: Int, $skip: Int, $limit: Int) {
           votes(
             first: $limit,
-            skip: $offset
+            skip: $skip
             where: {
               proposal: $proposal
-              vp_lte: $min_vp
+              created_gte: $created
             }
-            orderBy: "vp",
-            orderDirection: desc
+            orderBy: "created",
+            orderDirection: asc
           ) {
             voter
             id
+            created
             choice
             vp
             proposal {
@@ -138,14 +172,37 @@ class SnapshotAPI:
             dict: The data returned from the API response.
         """
         # print(f"Running query: {query}, with variables: {variables}")
-        request = requests.post(self.GRAPHQL_ENDPOINT, json={'query': query, 'variables': variables}, headers=self.HEADERS)
-        time.sleep(0.25) # API rate limiting
+        if self.archive is not None and self.archive.replay:
+            return self.archive.lookup('snapshot', query, variables)['data']
+
+        for attempt in range(self.MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            request = self._session().post(self.endpoint, json={'query': query, 'variables': variables}, headers=self.HEADERS)
+            if request.status_code != 429 or attempt == self.MAX_RETRIES:
+                break
+            # Rate limited, every thread waits before sending another request
+            delay = retry_delay(request, attempt)
+            print(f"Rate limited, retrying in {delay:.1f}s")
+            self.rate_limiter.pause(delay)
+
         if request.status_code == 200:
-            data = request.json()['data']
+            response = request.json()
+            if self.archive is not None:
+                self.archive.record('snapshot', query, variables, response)
+            data = response['data']
             return data
         else:
             raise Exception(f"Query failed with status code {request.status_code}")
 
+    def _session(self):
+        """Returns this thread's HTTP session, which keeps its connection to the API alive between requests."""
+        if not hasattr(self._local, 'session'):
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            self._local.session = session
+        return self._local.session
+
     def get_all_daos(self, dao_list):
         """
         Retrieves information about all DAOs in the provided list.
@@ -177,47 +234,168 @@ class SnapshotAPI:
         Returns:
             list: A list of dictionaries containing the proposal data.
         """
-        return self.run_query(self.proposals_query, {'space': space})['proposals']
+        return [proposal for page, _ in self.iter_proposal_pages(space) for proposal in page]
 
-    def get_all_votes(self, proposal_id):
+    def iter_proposal_pages(self, space, cursor=None, page_size=300):
         """
-        Retrieves all votes for a given proposal.
+        Retrieves the closed proposals of a DAO one page at a time, in order of their end time.
 
         Args:
-            proposal_id (str): The ID of the proposal.
+            space (str): The ID of the DAO.
+            cursor (dict, optional): A cursor yielded before, only proposals after its page are retrieved.
+            page_size (int, optional): Number of proposals requested at a time.
 
-        Returns:
-            list: A list of dictionaries containing the vote data.
+        Yields:
+            tuple: The next proposals and the cursor after them, to retrieve only newer proposals on the next run.
+        """
+        for proposals, next_cursor, _ in self._iter_keyset_pages(self.proposals_query, 'proposals', 'end', {'space': space}, page_size, cursor):
+            yield proposals, next_cursor
+
+    @staticmethod
+    def boundary_query(query, key):
         """
-        votes_response = []
-        seen_voters = set()
-        min_vp = None
-        skip = 0
-        limit = 1000
+        Derives from a query paged by _iter_keyset_pages the query of the items at a single timestamp, ordered by ID
+        and after the ID $after_id.
+        """
+        replacements = [
+            ('$skip: Int, $limit: Int)', '$after_id: String, $limit: Int)'),
+            ('\n            skip: $skip', ''),
+            (f'{key}_gte: ${key}', f'{key}: ${key},\n              id_gt: $after_id'),
+            (f'orderBy: "{key}"', 'orderBy: "id"'),
+        ]
+        for old, new in replacements:
+            if query.count(old) != 1:
+                raise ValueError(f"The query is not paged by {key}, {old} not found once")
+            query = query.replace(old, new)
+        return query
+
+    def _iter_keyset_pages(self, query, field, key, variables, page_size, cursor):
+        """
+        Pages a query ordered by an integer timestamp, starting each page at the timestamp of the last item fetched.
+
+        Items sharing the timestamp the last page ended in are skipped by the query's skip and dropped by ID, so every
+        request costs the same however many items came before it. When more items share a timestamp than the API can
+        skip, the rest of them are paged by ID with the query from boundary_query, then paging goes on from the next
+        timestamp. The query is expected to filter on key_gte: $key.
 
+        Args:
+            query (str): The GraphQL query.
+            field (str): The field of the response holding the items.
+            key (str): The timestamp the items are ordered by.
+            variables (dict): The other variables of the query.
+            page_size (int): Number of items requested at a time.
+            cursor (dict): A cursor yielded before, to resume after its page, or None to start at the first item.
+
+        Yields:
+            tuple: The next items, each once, the cursor after them and whether this was the last page.
+        """
+        position = cursor['position'] if cursor else 0
+        # Items at the timestamp the last page ended in, the next page starts at that timestamp again
+        boundary_ids = set(cursor['boundary_ids']) if cursor else set()
+        # ID of the last item paged by ID at that timestamp, None while items are paged by timestamp
+        after_id = cursor.get('after_id') if cursor else None
+
+        replay = self.archive is not None and self.archive.replay
         while True:
-            votes = self.run_query(self.votes_query, {'proposal': proposal_id, 'skip': skip, 'limit': limit, 'min_vp': min_vp})['votes']
-            if not votes:
+            by_id = after_id is not None or len(boundary_ids) > self.MAX_SKIP
+            try:
+                if by_id:
+                    items = self.run_query(self.boundary_query(query, key), {**variables, key: position, 'after_id': after_id or '', 'limit': page_size})[field]
+                else:
+                    items = self.run_query(query, {**variables, key: position, 'skip': len(boundary_ids), 'limit': page_size})[field]
+            except ArchiveMiss:
+                if not replay:
+                    raise
+                # When replaying, the first page that was never recorded ends the items
+                yield [], {'position': position, 'boundary_ids': sorted(boundary_ids), 'after_id': after_id}, True
                 break
-            
-            new_votes = 0
-            for vote in votes:
-                voter = vote['voter']
-                if voter not in seen_voters:
-                    votes_response.append(vote)
-                    seen_voters.add(voter)
-                    new_votes += 1
-            if new_votes == 0:
+            new_items = [item for item in items if item['id'] not in boundary_ids]
+            short = len(items) < page_size
+
+            if by_id:
+                # The items of the timestamp paged by ID only need the IDs seen before paging by ID to drop repeats
+                if short:
+                    position, boundary_ids, after_id = position + 1, set(), None
+                else:
+                    after_id = items[-1]['id']
+                last = False
+            else:
+                last = short
+                if not new_items and not last:
+                    raise Exception(f"{field.capitalize()} at {key} {position} are not returned in a stable order")
+                if items and items[-1][key] != position:
+                    position = items[-1][key]
+                    boundary_ids = set()
+                boundary_ids.update(item['id'] for item in items if item[key] == position)
+            # A later run may have recorded newer pages after a short one, so a replay goes on while pages bring new items
+            if replay and last and new_items:
+                last = False
+            yield new_items, {'position': position, 'boundary_ids': sorted(boundary_ids), 'after_id': after_id}, last
+            if last:
                 break
 
-            min_vp = votes_response[-1]['vp']
-            skip += 1000
-            # print(f"{len(seen_voters)} voters, min vp: {min_vp}")
+    def iter_vote_pages(self, proposal_id, page_size=1000, cursor=None):
+        """
+        Retrieves the votes of a proposal one page at a time, in creation order.
 
-            if len(votes) < 1000:
-                break
+        Each page starts at the creation time of the last vote already fetched instead of an offset, so
+        every request costs the same however many votes came before it. Only the IDs of votes created
+        in that last second are kept to skip them on the next page, so memory does not grow with the proposal.
 
-        return votes_response
+        Args:
+            proposal_id (str): The ID of the proposal.
+            page_size (int, optional): Number of votes requested at a time.
+            cursor (dict, optional): A cursor yielded before, to resume after its page.
+
+        Yields:
+            tuple: The next votes of the proposal, each vote once, and the cursor to resume after them,
+                None with the last page, which can be empty.
+        """
+        for votes, next_cursor, last in self._iter_keyset_pages(self.votes_query, 'votes', 'created', {'proposal': proposal_id}, page_size, cursor):
+            yield votes, None if last else next_cursor
+
+    def get_all_votes(self, proposal_id, on_page=None, cursor=None):
+        """
+        Retrieves all votes for a given proposal.
+
+        Args:
+            proposal_id (str): The ID of the proposal.
+            on_page (callable, optional): Called with each page of votes and the cursor after it as they arrive,
+                the votes are then not kept.
+            cursor (dict, optional): A cursor passed to on_page before, to resume after its page.
+
+        Returns:
+            list: A list of dictionaries containing the vote data, or the number of votes when on_page is given.
+        """
+        if on_page is None:
+            return [vote for page, _ in self.iter_vote_pages(proposal_id, cursor=cursor) for vote in page]
+
+        vote_count = 0
+        for page, next_cursor in self.iter_vote_pages(proposal_id, cursor=cursor):
+            on_page(page, next_cursor)
+            vote_count += len(page)
+        return vote_count
+
+    def get_votes_concurrently(self, proposal_ids, on_page=None, cursors=None):
+        """
+        Retrieves the votes of several proposals at once.
+
+        Args:
+            proposal_ids (iterable): The IDs of the proposals.
+            on_page (callable, optional): Called from the fetch threads with the proposal ID, each page of votes
+                and the cursor after it, None after the last page.
+            cursors (dict, optional): Cursor to resume each proposal from, by proposal ID.
+
+        Yields:
+            tuple: A proposal ID and the list of its votes, or their number when on_page is given, as soon as all of its votes are fetched.
+        """
+        cursors = cursors or {}
+
+        def fetch(proposal_id):
+            page_callback = None if on_page is None else lambda page, cursor: on_page(proposal_id, page, cursor)
+            return self.get_all_votes(proposal_id, page_callback, cursors.get(proposal_id))
+
+        yield from fetch_concurrently(fetch, proposal_ids, self.workers)
 
 class DataProcessor:
     """
@@ -373,27 +551,34 @@ def write_to_csv(df, filename):
     df.to_csv(output_path, mode='a', index=False, header=not file_exists)    
     # print(f"Data {'appended to' if file_exists else 'written to'} {output_path}")
 
-def load_df_from_csv(csv_path):
-    if os.path.exists(csv_path):
-        return pd.read_csv(csv_path)
-    else:
-        return pd.DataFrame()
+def get_args():
+    parser = argparse.ArgumentParser(description='Extract DAOs, proposals and votes from Snapshot')
+    parser.add_argument('--workers', type=int, default=4, help='Number of proposals whose votes are fetched at once')
+    parser.add_argument('--requests_per_second', type=float, default=4.0, help='Requests sent to the Snapshot API per second')
+    parser.add_argument('--endpoint', default=None, help='GraphQL endpoint to query instead of the Snapshot hub, e.g. a local stub server')
+    parser.add_argument('--checkpoints', default=DEFAULT_CHECKPOINT_PATH, help='SQLite file the progress is saved to, to resume an interrupted run')
+    parser.add_argument('--archive', nargs='?', const=DEFAULT_ARCHIVE_DIR, default=None, help='Directory the raw API responses are recorded to, to rebuild the tables later without the network')
+    parser.add_argument('--replay', action='store_true', help='Replay the responses recorded to --archive instead of querying the API')
+    parser.add_argument('--reindex', action='store_true', help='Index the proposals with votes in the output again, after it was changed by another program')
+    args = parser.parse_args()
+    if args.replay and not args.archive:
+        parser.error("--replay needs the --archive directory to replay from")
+    return args
 
 def main():
+    args = get_args()
     write_csv = input("Save outputs to CSV instead of writing to the database? (not recommended for large data pulls) (Y/N): ").strip().upper()
 
     sql_handler = db.DatabaseHandler()
-    data_fetcher = SnapshotAPI()
+    archive = ResponseArchive(args.archive, replay=args.replay) if args.archive else None
+    data_fetcher = SnapshotAPI(args.endpoint, args.requests_per_second, args.workers, archive)
     data_processor = DataProcessor()
 
-    if write_csv.upper() != "Y":
-        voter_db_df = sql_handler.db_to_df('votes')
-        proposal_db_df = sql_handler.db_to_df('proposals')
-        dao_db_df = sql_handler.db_to_df('dao')
-    else:
-        voter_db_df = load_df_from_csv('../data_output/votes.csv')
-        proposal_db_df = load_df_from_csv('../data_output/proposals.csv')
-        dao_db_df = load_df_from_csv('../data_output/dao.csv')
+    # Only the IDs already stored are loaded, proposals with votes are looked up in the checkpoint index
+    loader = VoteDataLoader(sql_handler if write_csv.upper() != "Y" else None, data_dir='../data_output')
+    # Stored proposals are skipped by the database itself, only the CSV output is filtered here
+    proposal_db_df = loader.load_table('ingestion', 'proposals') if write_csv.upper() == "Y" else None
+    dao_db_df = loader.load_table('ingestion', 'dao')
 
     # Read dao_input.csv as DAO List
     dao_list = pd.read_csv('../data_setup/dao_input.csv')
@@ -413,43 +598,67 @@ def main():
             print("Writing new DAOs to SQL")
             sql_handler.df_to_sql(dao_df_new, 'dao', 'append')
 
+    # Votes written to the CSV after the last checkpoint of an interrupted run are removed before resuming it, votes
+    # stored in the database are skipped when their page is fetched again
+    votes_csv = os.path.join("../data_output", "votes.csv")
+    if write_csv.upper() == "Y":
+        checkpoints = CheckpointStore('Snapshot', args.checkpoints, output_name(csv_path=votes_csv))
+        checkpoints.rollback(csv_path=votes_csv)
+    else:
+        checkpoints = CheckpointStore('Snapshot', args.checkpoints, output_name(sql_handler))
+    # The votes are only read the first time an output is used, to build the index of proposals they belong to
+    checkpoints.index_ingested(lambda: loader.load_table('ingestion', 'votes', distinct=True)['proposal_id'], args.reindex)
+    write_lock = threading.Lock()
+
+    def write_votes(dao_id, proposal_id, votes, cursor):
+        voter_df = data_processor.add_voter_table(votes)
+        voter_df = data_processor.process_choice_column(voter_df)
+        # Pages arrive from several fetch threads, each one is written and checkpointed before the next
+        with write_lock:
+            rows = len(voter_df)
+            if not voter_df.empty:
+                if write_csv.upper() == "Y":
+                    write_to_csv(voter_df, f"votes.csv")
+                else:
+                    # Votes stored before, e.g. by a concurrent run, are skipped and not counted in the checkpoint
+                    rows, skipped = sql_handler.copy_upsert(voter_df, 'votes', ['platform', 'vote_id'])
+            checkpoints.save_page(proposal_id, dao_id, cursor, rows, votes_csv if write_csv.upper() == "Y" else None)
+
     # Process proposals by DAO and write to data
     for dao_id in dao_list:
         print("Processing ", dao_id)
         if dao_id == "stgdao.eth":
             print("Skipping", dao_id)
             continue
-        proposals = data_fetcher.get_proposals(dao_id)
-        viable_proposals = [proposal for proposal in proposals if len(proposal['choices']) <= 3]
-        proposal_df = data_processor.add_proposal_table(dao_id, viable_proposals)
-        
-        unseen_proposals = proposal_df if proposal_db_df.empty else proposal_df[~proposal_df['proposal_id'].isin(proposal_db_df['proposal_id'])]
+        # Only proposals after the DAO's watermark are fetched, all of them the first time
+        for proposals, cursor in data_fetcher.iter_proposal_pages(dao_id, checkpoints.watermark(dao_id)):
+            viable_proposals = [proposal for proposal in proposals if len(proposal['choices']) <= 3]
+            proposal_df = data_processor.add_proposal_table(dao_id, viable_proposals)
 
-        # If proposal id is not in the database, write to data
-        if not unseen_proposals.empty:
-            print("Writing new proposals to SQL for", dao_id)
+            # If proposal id is not in the output, write it
             if write_csv.upper() == "Y":
-                write_to_csv(unseen_proposals, f"proposals.csv")
-            else:
-                print("Writing new proposals to SQL for", dao_id)
-                sql_handler.df_to_sql(unseen_proposals, 'proposals', 'append')
-        
-        unseen_votes = proposal_df if voter_db_df.empty else proposal_df[~proposal_df['proposal_id'].isin(voter_db_df['proposal_id'])]
-
-        # Process votes in the proposal
-        for proposal in unseen_votes['proposal_id']:
-            if proposal == "0x44b9630efed11ff179b69646989d1ef61f05a143164773021844b6aa06878c2a": # error, hangs at 215664 votes
-                continue
-
-            print("Processing votes for proposal", proposal)
-            votes = data_fetcher.get_all_votes(proposal)
-            voter_df = data_processor.add_voter_table(votes)
-            voter_df = data_processor.process_choice_column(voter_df)
-
-            if write_csv.upper() == "Y":
-                write_to_csv(voter_df, f"votes.csv")
-            else:
-                sql_handler.df_to_sql(voter_df, 'votes', 'append')
+                unseen_proposals = proposal_df if proposal_db_df.empty else proposal_df[~proposal_df['proposal_id'].isin(proposal_db_df['proposal_id'])]
+                if not unseen_proposals.empty:
+                    print("Writing new proposals to CSV for", dao_id)
+                    write_to_csv(unseen_proposals, f"proposals.csv")
+            elif not proposal_df.empty:
+                inserted, skipped = sql_handler.copy_upsert(proposal_df, 'proposals', ['proposal_id'])
+                print(f"Wrote {inserted} new proposals to SQL for {dao_id}, {skipped} already stored")
+            # A page written again after an interruption is skipped by the check above
+            checkpoints.save_discovered(dao_id, proposal_df['proposal_id'], cursor)
+
+        # Proposals without votes in the output are fetched, interrupted ones from their last checkpoint
+        pending = checkpoints.pending_proposals(dao_id)
+        checkpoints.start_dao(dao_id, len(pending))
+
+        # Several proposals are fetched at once, each page of votes is written as soon as it arrives
+        for proposal, vote_count in data_fetcher.get_votes_concurrently(list(pending), functools.partial(write_votes, dao_id), pending):
+            print(f"Processed {vote_count} votes for proposal", proposal)
+        checkpoints.finish_dao(dao_id)
+
+    # The stats views in the database are brought up to date with the new votes
+    if write_csv.upper() != "Y":
+        sql_handler.refresh_materialized_views()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,494 @@
+"""
+streaming_analytics.py
+
+This module computes the DAO and proposal stats of data_analytics.py from batches of votes, so the votes never have to
+be held in memory at once.
+
+The votes are streamed sorted by DAO and voter, so all votes of a voter in a DAO are consecutive. A batch is split
+before the votes of its last voter, which are carried over to the next batch, and reduced to one row per voter. These
+rows are added to aggregates of a bounded size per DAO and per proposal choice:
+- Counts and sums, exact: votes cast, voters, proposals, voters of each proposal and choice, sums of voting power.
+  Distinct voters are counted exactly because a voter's votes are never split between batches.
+- Mean and variance of the voting power and vote count per voter, combined with Chan's formula, exact
+- Sums of v^2 and v * log2(v) of the voting power per voter, for the HHI and min entropy, exact
+- A log-bucketed histogram (as in DDSketch) of the voting power and vote count per voter, for the deciles, the Gini
+  index and the Nakamoto coefficient
+
+Error bounds against data_analytics.py without --streaming, alpha being the relative accuracy (0.01 by default):
+- Deciles are within a relative error of alpha.
+- The Gini index is within about alpha.
+- The Nakamoto coefficient is within a relative error of about 2 * alpha.
+- The min entropy is within 1.5e-10 per voter, the exact mode adds 1e-10 to every share before taking its log.
+- Every other measure is exact, up to floating point rounding.
+
+Aggregates of disjoint sets of DAOs are combined with merge(), so parallel workers can each stream some of the DAOs.
+
+Key features:
+- Bounded memory: the aggregates grow with the number of DAOs and proposals, not with the number of votes
+- Mergeable aggregates, across batches and across workers
+- The same interface as data_analytics.AnalyticsGenerator
+
+Example usage:
+    batches = loader.iter_joined_votes('analytics', order_by=('dao_id', 'voter_address'))
+    analytics = StreamingAnalytics().consume(batches)
+    dao_stats_df, dao_percentile_df = analytics.generate_dao_level_analytics()
+"""
+
+import numpy as np
+import pandas as pd
+
+from dao_metrics import PERCENTILES, PROPOSAL_MEASURES, percentile_table, proposal_table, segment_starts, segment_sum
+
+# Number of partial aggregates kept before they are combined
+COMPACT_PARTS = 32
+
+
+class LogHistogram:
+    """
+    Histogram of values per group, in buckets growing geometrically, as in DDSketch.
+
+    Bucket k holds the values in (gamma^(k-1), gamma^k] with gamma = (1 + alpha) / (1 - alpha), so every value in a
+    bucket is within a relative error alpha of the bucket's value 2 * gamma^k / (gamma + 1). Values of zero or below
+    are kept in a bucket of their own. Each bucket also keeps the exact sum of its values. Histograms are merged by
+    adding up their buckets.
+
+    Attributes:
+        relative_accuracy (float): alpha, the relative error of a value read from a bucket.
+        gamma (float): Ratio between the upper bounds of consecutive buckets.
+    """
+    ZERO_BUCKET = np.iinfo(np.int64).min
+
+    def __init__(self, relative_accuracy=0.01):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f"The relative accuracy must be between 0 and 1, got {relative_accuracy}")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._parts = []
+
+    def add(self, groups, values):
+        """
+        Adds values to the histograms of their groups, missing values are left out.
+
+        Args:
+            groups (numpy.ndarray): Group of each value.
+            values (numpy.ndarray): The values.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        values = values[valid]
+        positive = values > 0
+        buckets = np.full(len(values), self.ZERO_BUCKET, dtype=np.int64)
+        buckets[positive] = np.ceil(np.log(values[positive]) / np.log(self.gamma)).astype(np.int64)
+        part = pd.DataFrame({'group': np.asarray(groups)[valid], 'bucket': buckets, 'count': 1, 'sum': values})
+        self._parts.append(part.groupby(['group', 'bucket'], sort=False, as_index=False).sum())
+        if len(self._parts) > COMPACT_PARTS:
+            self._compact()
+
+    def merge(self, other):
+        """
+        Adds the buckets of another histogram.
+
+        Args:
+            other (LogHistogram): A histogram with the same relative accuracy.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError(f"Cannot merge histograms of relative accuracy {self.relative_accuracy} and {other.relative_accuracy}")
+        self._parts.extend(other._parts)
+        self._compact()
+
+    def _compact(self):
+        """Combines the partial histograms into one, sorted by group and bucket."""
+        if not self._parts:
+            return
+        table = pd.concat(self._parts, ignore_index=True)
+        self._parts = [table.groupby(['group', 'bucket'], as_index=False)[['count', 'sum']].sum()]
+
+    def _segments(self, groups):
+        """
+        Returns the buckets of the given groups, sorted by group in the given order and by bucket.
+
+        Returns:
+            tuple: Bucket index, count and sum of each bucket, and the start and number of buckets of each group.
+        """
+        self._compact()
+        table = self._parts[0] if self._parts else pd.DataFrame({'group': [], 'bucket': [], 'count': [], 'sum': []})
+        codes = pd.Index(groups).get_indexer(table['group'])
+        known = codes >= 0
+        order = np.lexsort((table['bucket'].to_numpy()[known], codes[known]))
+        bucket = table['bucket'].to_numpy(dtype=np.int64)[known][order]
+        count = table['count'].to_numpy(dtype=np.float64)[known][order]
+        total = table['sum'].to_numpy(dtype=np.float64)[known][order]
+        starts, n_buckets = segment_starts(codes[known][order], len(groups))
+        return bucket, count, total, starts, n_buckets
+
+    def _bucket_values(self, bucket, count, total):
+        """Value read from each bucket: its only value, the mean of the zero bucket, or the bucket's value."""
+        with np.errstate(over='ignore'):
+            values = 2 * np.power(self.gamma, bucket.astype(np.float64)) / (self.gamma + 1)
+        values = np.where(bucket == self.ZERO_BUCKET, total / np.maximum(count, 1), values)
+        return np.where(count == 1, total, values)
+
+    def quantiles(self, groups, quantiles):
+        """
+        Returns quantiles of each group's values, with linear interpolation between the values of two ranks as
+        pandas computes them. Each value is within a relative error alpha of the exact one.
+
+        Args:
+            groups (list): The groups, in the order of the result.
+            quantiles (numpy.ndarray): Quantiles as fractions.
+
+        Returns:
+            numpy.ndarray: One row per group and one column per quantile, NaN for a group without values.
+        """
+        bucket, count, total, starts, n_buckets = self._segments(groups)
+        values = self._bucket_values(bucket, count, total)
+        cumulative = np.cumsum(count)
+        n = segment_sum(count, starts, n_buckets)
+        # Values of the groups before each group
+        before = np.zeros(len(groups))
+        before[n_buckets > 0] = cumulative[starts[n_buckets > 0]] - count[starts[n_buckets > 0]]
+
+        result = np.full((len(groups), len(quantiles)), np.nan)
+        present = n > 0
+        if not present.any():
+            return result
+        size = n[present][:, None]
+        position = quantiles[None, :] * (size - 1)
+        low = np.floor(position)
+        high = np.minimum(low + 1, size - 1)
+        fraction = position - low
+        # Rank r of a group is in the first bucket whose cumulative count is above it
+        below = values[np.searchsorted(cumulative, before[present][:, None] + low, side='right')]
+        above = values[np.searchsorted(cumulative, before[present][:, None] + high, side='right')]
+        result[present] = below + (above - below) * fraction
+        return result
+
+    def concentration(self, groups):
+        """
+        Computes the Gini index and Nakamoto coefficient of each group's values, as dao_metrics.DaoMetrics does,
+        taking the values in a bucket to be equal to their mean.
+
+        Args:
+            groups (list): The groups, in the order of the result.
+
+        Returns:
+            tuple: Gini index and Nakamoto coefficient of each group, NaN for a group without values.
+        """
+        bucket, count, total, starts, n_buckets = self._segments(groups)
+        group_of_bucket = np.repeat(np.arange(len(groups)), n_buckets)
+        n = segment_sum(count, starts, n_buckets)
+        group_total = segment_sum(total, starts, n_buckets)
+        # Sum of the values in the group's buckets below each bucket
+        below = pd.Series(total).groupby(group_of_bucket).cumsum().to_numpy() - total
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / count
+            # Sum over the bucket's values of the cumulative sum up to each of them
+            lorenz_sum = segment_sum(count * below + mean * count * (count + 1) / 2, starts, n_buckets) / group_total
+            smallest = np.full(len(groups), np.nan)
+            smallest[n_buckets > 0] = mean[starts[n_buckets > 0]] / group_total[n_buckets > 0]
+            gini_index = np.where(n == 1, 1.0, 1 - 2 * (lorenz_sum - (smallest + 1) / 2) / (n - 1))
+
+            # Values whose cumulative sum in ascending order is above half of the total
+            remainder = 0.5 * group_total[group_of_bucket] - below
+            not_above = np.clip(np.floor(remainder / mean), 0, count)
+            above_half = np.where(np.isnan(not_above), 0, count - not_above)
+            nakamoto = segment_sum(above_half, starts, n_buckets)
+
+        missing = n == 0
+        return np.where(missing, np.nan, gini_index), np.where(missing, np.nan, nakamoto)
+
+
+def first_rows(codes, n_codes):
+    """Returns the row where each code first appears, codes below 0 are skipped."""
+    rows = np.flatnonzero(codes >= 0)
+    present, first = np.unique(codes[rows], return_index=True)
+    result = np.zeros(n_codes, dtype=np.int64)
+    result[present] = rows[first]
+    return result
+
+
+def combine_moments(parts, key, measures):
+    """
+    Combines per part counts, means and sums of squared deviations into those of each key, with Chan's formula.
+
+    Args:
+        parts (pandas.DataFrame): One row per part, with '<measure>_n', '<measure>_mean' and '<measure>_m2' columns.
+        key (str): Column of the key the parts are combined by.
+        measures (list): The measures to combine.
+
+    Returns:
+        pandas.DataFrame: The combined columns, indexed by key in the order keys first appear.
+    """
+    combined = {}
+    for measure in measures:
+        n = parts[f'{measure}_n'].to_numpy(dtype=np.float64)
+        mean = np.where(n > 0, parts[f'{measure}_mean'].to_numpy(dtype=np.float64), 0.0)
+        m2 = np.where(n > 0, parts[f'{measure}_m2'].to_numpy(dtype=np.float64), 0.0)
+        grouped = pd.DataFrame({key: parts[key].to_numpy(), 'n': n, 'weighted': n * mean}).groupby(key, sort=False)
+        total_n = grouped['n'].transform('sum').to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            key_mean = grouped['weighted'].transform('sum').to_numpy() / total_n
+        spread = pd.DataFrame({key: parts[key].to_numpy(), 'm2': m2 + n * np.nan_to_num(mean - key_mean) ** 2}).groupby(key, sort=False)['m2'].sum()
+        sums = grouped[['n', 'weighted']].sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            combined[f'{measure}_n'] = sums['n']
+            combined[f'{measure}_mean'] = sums['weighted'] / sums['n']
+            combined[f'{measure}_m2'] = spread
+    return pd.DataFrame(combined)
+
+
+class StreamingAnalytics:
+    """
+    DAO and proposal stats, aggregated from batches of votes sorted by DAO and voter.
+
+    Attributes:
+        relative_accuracy (float): Relative accuracy of the histograms the deciles, Gini index and Nakamoto
+            coefficient are read from.
+        voting_power (LogHistogram): Largest voting power of each voter, by DAO.
+        vote_counts (LogHistogram): Number of votes of each voter, by DAO.
+        n_votes (int): Number of votes added.
+    """
+    # Sums of the DAO aggregates, combined by adding them up
+    DAO_SUMS = ['votes_cast', 'null_voter', 'power_sum', 'power_square_sum', 'power_log_sum']
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.voting_power = LogHistogram(relative_accuracy)
+        self.vote_counts = LogHistogram(relative_accuracy)
+        self.n_votes = 0
+        self._daos = []
+        self._proposals = []
+        self._choices = []
+
+    def consume(self, batches):
+        """
+        Adds batches of votes sorted by DAO and voter, carrying the votes of each batch's last voter over to the
+        next one.
+
+        Args:
+            batches (iterable): DataFrames of joined votes, see update().
+
+        Returns:
+            StreamingAnalytics: self, with every batch added.
+        """
+        carried = None
+        for batch in batches:
+            if carried is not None and len(carried) > 0:
+                batch = pd.concat([carried, batch], ignore_index=True)
+            last = batch.iloc[-1]
+            same_dao = (batch['dao_id'] == last['dao_id']) | (batch['dao_id'].isna() & pd.isna(last['dao_id']))
+            same_voter = (batch['voter_address'] == last['voter_address']) | (batch['voter_address'].isna() & pd.isna(last['voter_address']))
+            last_voter = (same_dao & same_voter).to_numpy()
+            self.update(batch[~last_voter])
+            carried = batch[last_voter]
+            print(f"Processed {self.n_votes} votes")
+        if carried is not None and len(carried) > 0:
+            self.update(carried)
+        self._compact()
+        print(f"Processed {self.n_votes} votes in total")
+        return self
+
+    def update(self, votes):
+        """
+        Adds votes to the aggregates. Every voter's votes in a DAO must be added in a single call.
+
+        Args:
+            votes (pandas.DataFrame): Votes with 'dao_id', 'dao_name', 'proposal_id', 'choice', 'voter_address'
+                and 'voting_power' columns.
+        """
+        if len(votes) == 0:
+            return
+        self.n_votes += len(votes)
+        dao_codes, dao_ids = pd.factorize(votes['dao_id'])
+        proposal_codes, proposal_ids = pd.factorize(votes['proposal_id'])
+        choice_codes, _ = pd.factorize(votes['choice'], use_na_sentinel=False)
+        voter_codes, voters = pd.factorize(votes['voter_address'])
+        voting_power = pd.to_numeric(votes['voting_power'], errors='coerce').to_numpy(dtype=np.float64)
+        has_voter = voter_codes >= 0
+        n_voters = max(len(voters), 1)
+
+        # Each voter is counted once per proposal and per choice, all their votes are in this batch
+        on_proposal = proposal_codes >= 0
+        choice_keys = proposal_codes[on_proposal].astype(np.int64) * (choice_codes.max() + 1) + choice_codes[on_proposal]
+        choice_index, choice_keys = pd.factorize(choice_keys)
+        counted = has_voter[on_proposal]
+        proposal_voters = np.unique(proposal_codes[on_proposal][counted].astype(np.int64) * n_voters + voter_codes[on_proposal][counted]) // n_voters
+        choice_voters = np.unique(choice_index[counted].astype(np.int64) * n_voters + voter_codes[on_proposal][counted]) // n_voters
+        first_proposal_votes = first_rows(proposal_codes[on_proposal], len(proposal_ids))
+        first_choice_votes = first_rows(choice_index, len(choice_keys))
+        power = voting_power[on_proposal]
+        self._proposals.append(pd.DataFrame({
+            'proposal_id': proposal_ids,
+            'dao_id': votes['dao_id'].to_numpy()[on_proposal][first_proposal_votes],
+            'voters': np.bincount(proposal_voters, minlength=len(proposal_ids)),
+        }))
+        self._choices.append(pd.DataFrame({
+            'proposal_id': votes['proposal_id'].to_numpy()[on_proposal][first_choice_votes],
+            'choice': votes['choice'].to_numpy()[on_proposal][first_choice_votes],
+            'voters': np.bincount(choice_voters, minlength=len(choice_keys)),
+            'power_sum': np.bincount(choice_index, np.nan_to_num(power), minlength=len(choice_keys)),
+            'power_count': np.bincount(choice_index, ~np.isnan(power), minlength=len(choice_keys)),
+        }))
+
+        # One row per DAO and voter, with the voter's vote count and largest voting power
+        in_dao = dao_codes >= 0
+        voter_keys = dao_codes[in_dao & has_voter].astype(np.int64) * n_voters + voter_codes[in_dao & has_voter]
+        voter_index, voter_keys = pd.factorize(voter_keys)
+        voter_dao = voter_keys // n_voters
+        vote_count = np.bincount(voter_index, minlength=len(voter_keys)).astype(np.float64)
+        voter_power = pd.Series(voting_power[in_dao & has_voter]).groupby(voter_index).max().to_numpy()
+
+        n_daos = len(dao_ids)
+        valid = ~np.isnan(voter_power)
+        power_dao = voter_dao[valid]
+        power = voter_power[valid]
+        count_n = np.bincount(voter_dao, minlength=n_daos).astype(np.float64)
+        power_n = np.bincount(power_dao, minlength=n_daos).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            count_mean = np.bincount(voter_dao, vote_count, minlength=n_daos) / count_n
+            power_mean = np.bincount(power_dao, power, minlength=n_daos) / power_n
+            power_log = np.where(power > 0, power * np.log2(power), 0.0)
+        self._daos.append(pd.DataFrame({
+            'dao_id': dao_ids,
+            'dao_name': votes['dao_name'].to_numpy()[first_rows(dao_codes, n_daos)],
+            'votes_cast': np.bincount(dao_codes[in_dao], minlength=n_daos),
+            'null_voter': np.bincount(dao_codes[in_dao & ~has_voter], minlength=n_daos) > 0,
+            'power_sum': np.bincount(power_dao, power, minlength=n_daos),
+            'power_square_sum': np.bincount(power_dao, power ** 2, minlength=n_daos),
+            'power_log_sum': np.bincount(power_dao, power_log, minlength=n_daos),
+            'count_n': count_n,
+            'count_mean': count_mean,
+            'count_m2': np.bincount(voter_dao, (vote_count - count_mean[voter_dao]) ** 2, minlength=n_daos),
+            'power_n': power_n,
+            'power_mean': power_mean,
+            'power_m2': np.bincount(power_dao, (power - power_mean[power_dao]) ** 2, minlength=n_daos),
+        }))
+
+        voter_dao_ids = dao_ids.to_numpy()[voter_dao]
+        self.voting_power.add(voter_dao_ids, voter_power)
+        self.vote_counts.add(voter_dao_ids, vote_count)
+        if len(self._daos) > COMPACT_PARTS:
+            self._compact()
+
+    def merge(self, other):
+        """
+        Adds the aggregates of another StreamingAnalytics, which must have been built from votes of other DAOs.
+
+        Args:
+            other (StreamingAnalytics): Aggregates of other DAOs, with the same relative accuracy.
+
+        Returns:
+            StreamingAnalytics: self, with the other aggregates added.
+        """
+        self.voting_power.merge(other.voting_power)
+        self.vote_counts.merge(other.vote_counts)
+        self.n_votes += other.n_votes
+        self._daos.extend(other._daos)
+        self._proposals.extend(other._proposals)
+        self._choices.extend(other._choices)
+        self._compact()
+        return self
+
+    def _compact(self):
+        """Combines the partial aggregates of each DAO, proposal and choice."""
+        if self._daos:
+            parts = pd.concat(self._daos, ignore_index=True)
+            grouped = parts.groupby('dao_id', sort=False)
+            daos = grouped.agg(dao_name=('dao_name', 'first'), **{column: (column, 'sum') for column in self.DAO_SUMS})
+            daos = daos.join(combine_moments(parts, 'dao_id', ['count', 'power']))
+            self._daos = [daos.reset_index()]
+        if self._proposals:
+            parts = pd.concat(self._proposals, ignore_index=True)
+            self._proposals = [parts.groupby('proposal_id', sort=False).agg(dao_id=('dao_id', 'first'), voters=('voters', 'sum')).reset_index()]
+        if self._choices:
+            parts = pd.concat(self._choices, ignore_index=True)
+            self._choices = [parts.groupby(['proposal_id', 'choice'], sort=False, dropna=False)[['voters', 'power_sum', 'power_count']].sum().reset_index()]
+
+    def generate_dao_level_analytics(self):
+        """
+        Computes the DAO level stats and percentiles, as data_analytics.AnalyticsGenerator does, with the DAOs
+        sorted by id.
+
+        Returns:
+            tuple: The dao_stats and dao_percentile DataFrames.
+        """
+        self._compact()
+        if not self._daos:
+            return self._empty_dao_level_analytics()
+        daos = self._daos[0].sort_values('dao_id', kind='stable').set_index('dao_id')
+        proposals = self._proposals[0].groupby('dao_id').agg(total_proposals=('proposal_id', 'size'), proposal_voters=('voters', 'sum'))
+        proposals = proposals.reindex(daos.index, fill_value=0)
+        dao_ids = daos.index.to_numpy()
+        print("DAO list:", list(dao_ids))
+
+        unique_voters = daos['count_n'].to_numpy() + daos['null_voter'].to_numpy(dtype=np.float64)
+        total_proposals = proposals['total_proposals'].to_numpy(dtype=np.float64)
+        votes_cast = daos['votes_cast'].to_numpy(dtype=np.float64)
+        power_total = daos['power_sum'].to_numpy()
+        gini_index, nakamoto = self.voting_power.concentration(dao_ids)
+        missing = daos['power_n'].to_numpy() == 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            min_entropy = np.log2(power_total) - daos['power_log_sum'].to_numpy() / power_total
+            hhi = daos['power_square_sum'].to_numpy() / power_total ** 2
+            stats_df = pd.DataFrame({
+                'id': np.arange(1, len(daos) + 1),
+                'protocol': dao_ids,
+                'dao_name': daos['dao_name'].to_numpy(),
+                'unique_voters': unique_voters,
+                'total_proposals': total_proposals,
+                'total_votes_cast': votes_cast,
+                'avg_votes_on_proposal': votes_cast / total_proposals,
+                'avg_votes_voter': daos['count_mean'].to_numpy(),
+                'avg_vp_voter': daos['power_mean'].to_numpy(),
+                'avg_voter_participation': proposals['proposal_voters'].to_numpy(dtype=np.float64) / total_proposals / unique_voters,
+                'gini_index': gini_index,
+                'nakamoto_coefficient': pd.Series(np.nan_to_num(nakamoto), dtype='Int64').mask(missing),
+                'min_entropy': np.where(missing, np.nan, min_entropy),
+                'hhi': np.where(missing, np.nan, hhi),
+            })
+
+        summaries = {}
+        for measure, prefix, histogram in (('voting_power', 'power', self.voting_power), ('vote_counts', 'count', self.vote_counts)):
+            n = daos[f'{prefix}_n'].to_numpy(dtype=np.float64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                std = np.sqrt(daos[f'{prefix}_m2'].to_numpy() / (n - 1))
+            summaries[measure] = (daos[f'{prefix}_mean'].to_numpy(), std, histogram.quantiles(dao_ids, PERCENTILES))
+        return stats_df, percentile_table(dao_ids, summaries)
+
+    def _empty_dao_level_analytics(self):
+        empty = np.array([], dtype=object)
+        stats_df = pd.DataFrame(columns=['id', 'protocol', 'dao_name', 'unique_voters', 'total_proposals', 'total_votes_cast', 'avg_votes_on_proposal', 'avg_votes_voter', 'avg_vp_voter', 'avg_voter_participation', 'gini_index', 'nakamoto_coefficient', 'min_entropy', 'hhi'])
+        summary = (np.array([]), np.array([]), np.empty((0, len(PERCENTILES))))
+        return stats_df, percentile_table(empty, {'voting_power': summary, 'vote_counts': summary})
+
+    def generate_proposal_level_analytics(self, proposal_stats_df):
+        """
+        Computes the votes and voting power of every choice of every proposal, as
+        data_analytics.AnalyticsGenerator does, with the proposals in the order they were streamed.
+
+        Args:
+            proposal_stats_df (pandas.DataFrame): The stored proposal stats, whose proposals are left out.
+
+        Returns:
+            pandas.DataFrame: One row per proposal, choice and measure.
+        """
+        self._compact()
+        if not self._choices:
+            return proposal_table(pd.DataFrame({'proposal_id': [], 'choice': [], **{measure: [] for measure in PROPOSAL_MEASURES}}))
+        choices = self._choices[0]
+        if len(proposal_stats_df) > 0:
+            choices = choices[~choices['proposal_id'].isin(proposal_stats_df['proposal_id'])]
+        # Choices of a proposal follow each other, proposals in the order they were streamed
+        proposal_order = pd.Series(np.arange(len(self._proposals[0])), index=self._proposals[0]['proposal_id'].to_numpy())
+        choices = choices.iloc[np.argsort(choices['proposal_id'].map(proposal_order).to_numpy(), kind='stable')]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats = pd.DataFrame({
+                'proposal_id': choices['proposal_id'].to_numpy(),
+                'choice': choices['choice'].to_numpy(),
+                'sum_choice': choices['voters'].to_numpy(dtype=np.float64),
+                'sum_voting_power': choices['power_sum'].to_numpy(dtype=np.float64),
+                'avg_voting_power': np.nan_to_num(choices['power_sum'].to_numpy(dtype=np.float64) / choices['power_count'].to_numpy(dtype=np.float64)),
+            })
+        stats.loc[stats['choice'].isna(), PROPOSAL_MEASURES] = 0
+        print(f"Computed stats of {stats['proposal_id'].nunique()} proposals")
+        return proposal_table(stats)
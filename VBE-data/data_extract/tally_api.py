@@ -8,20 +8,29 @@ The TallyAPI class encapsulates methods for fetching information about DAOs, pro
 Key features:
 - Fetching DAO information
 - Retrieving proposal details
-- Collecting voting data for proposals
+- Collecting voting data for proposals, several proposals at once within the API's rate limit
 - Creating structured DataFrames from the fetched data
+- Resuming interrupted runs from the checkpoint saved after each page of votes
 
 Note: Ensure that the required environment variables (TALLY_API_URL, TALLY_API_KEY) are set before using this module.
 """
 
+import argparse
 import csv
+import functools
 import re
 import sys, os
+import threading
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../VBE-library/vbe'))
 
 import database as db
+from vote_data import VoteDataLoader
+from concurrent_fetch import RateLimiter, fetch_concurrently, retry_delay
+from response_archive import ArchiveMiss, ResponseArchive, DEFAULT_ARCHIVE_DIR
+from checkpoint import CheckpointStore, output_name, DEFAULT_PATH as DEFAULT_CHECKPOINT_PATH
 import requests
-import time
+from requests.adapters import HTTPAdapter
 import pandas as pd
 from datetime import datetime
 import json
@@ -31,15 +40,33 @@ from dotenv import load_dotenv
 load_dotenv()
 
 class TallyAPI:
-    def __init__(self):
+    # Number of times a rate limited request is retried
+    MAX_RETRIES = 5
+    # Statuses of proposals whose votes can still change, the others are final
+    OPEN_STATUSES = {'draft', 'submitted', 'pending', 'active', 'extended', 'queued'}
+
+    def __init__(self, requests_per_second=5.0, workers=4, archive=None):
         """
         Initializes the TallyAPI class with the necessary API URL and headers.
+
+        Args:
+            requests_per_second (float, optional): Requests sent per second over all threads.
+            workers (int, optional): Number of proposals whose votes are fetched at once.
+            archive (ResponseArchive, optional): Archive to record the responses to, or to replay them from without the network.
         """
         self.tally_api_url = os.getenv('TALLY_API_URL')
         self.tally_headers = {
             "Api-key": os.getenv('TALLY_API_KEY'),
             "Content-Type": "application/json"
         }
+        self.workers = workers
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.archive = archive
+        # One session shared by every thread, its connection pool keeps a connection alive per thread
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.organization_query = """
         query Organization($input: OrganizationInput!) {
           organization(input: $input) {
@@ -131,6 +158,47 @@ class TallyAPI:
         }
         """
 
+    def post(self, query, variables):
+        """
+        Sends a GraphQL query through the shared session, within the rate limit.
+
+        A 429 response pauses every thread for the Retry-After delay before the query is sent again.
+
+        Args:
+            query (str): The GraphQL query.
+            variables (dict): The query variables.
+
+        Returns:
+            requests.Response: The response, still a 429 if the query was rate limited MAX_RETRIES times.
+        """
+        if self.archive is not None and self.archive.replay:
+            return self._replay(query, variables)
+
+        for attempt in range(self.MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            response = self.session.post(self.tally_api_url, headers=self.tally_headers, json={"query": query, "variables": variables})
+            if response.status_code == 200 and self.archive is not None:
+                try:
+                    self.archive.record('tally', query, variables, response.json())
+                except json.JSONDecodeError:
+                    pass
+            if response.status_code != 429 or attempt == self.MAX_RETRIES:
+                return response
+            retry_after = retry_delay(response, attempt)
+            print(f"Rate limited. Waiting for {retry_after} seconds...")
+            self.rate_limiter.pause(retry_after)
+
+    def _replay(self, query, variables):
+        """Builds the response to a query from the archive, a 404 if it was never recorded."""
+        response = requests.Response()
+        try:
+            response._content = json.dumps(self.archive.lookup('tally', query, variables)).encode()
+            response.status_code = 200
+        except ArchiveMiss as e:
+            response._content = str(e).encode()
+            response.status_code = 404
+        return response
+
     def fetch_daos(self, dao_slugs):
         """
         Fetches DAO data from the Tally API based on the provided slugs.
@@ -146,11 +214,7 @@ class TallyAPI:
             variables = {"input": {"slug": slug}}
 
             try:
-                response = requests.post(
-                    self.tally_api_url,
-                    headers=self.tally_headers,
-                    json={"query": self.organization_query, "variables": variables}
-                )
+                response = self.post(self.organization_query, variables)
                 
                 if response.status_code == 200:
                     data = response.json()
@@ -159,14 +223,6 @@ class TallyAPI:
                         all_daos.append(dao)
                     else:
                         print(f"No data found for DAO with slug: {slug}")
-                elif response.status_code == 429:
-                    retry_after = int(response.headers.get('Retry-After', 5))
-                    print(f"Rate limited. Waiting for {retry_after} seconds...")
-                    time.sleep(retry_after)
-                    # Retry this slug
-                    dao = self.fetch_daos([slug])
-                    if dao:
-                        all_daos.extend(dao)
                 else:
                     print(f"Query failed for {slug} with status code {response.status_code}")
                     print("Response content:", response.content.decode())
@@ -188,64 +244,160 @@ class TallyAPI:
         """
         all_proposals = []
         for org_id in org_ids:
-            proposal_variables = {
-                "input": {
-                    "filters": {
-                        "organizationId": org_id,
-                        "includeArchived": True,
-                    },
-                    "page": {},
-                    "sort": {
-                        "isDescending": False,
-                        "sortBy": "id"
-                    }
+            for proposals, _ in self.iter_proposal_pages(org_id):
+                all_proposals.extend(proposals)
+        return all_proposals
+
+    def iter_proposal_pages(self, org_id, cursor=None):
+        """
+        Fetches the proposals of an organization one page at a time, oldest first.
+
+        Args:
+            org_id (str): The organization ID of the DAO.
+            cursor (str, optional): A cursor yielded before, only proposals after its page are fetched.
+
+        Yields:
+            tuple: The next proposals and the cursor after them, to fetch only newer proposals on the next run.
+        """
+        proposal_variables = {
+            "input": {
+                "filters": {
+                    "organizationId": org_id,
+                    "includeArchived": True,
+                },
+                "page": {"afterCursor": cursor} if cursor else {},
+                "sort": {
+                    "isDescending": False,
+                    "sortBy": "id"
                 }
             }
+        }
 
-            while True:
-                try:
-                    response = requests.post(
-                        self.tally_api_url,
-                        headers=self.tally_headers,
-                        json={"query": self.proposal_query, "variables": proposal_variables}
-                    )
-                    
-                    if response.status_code == 200:
+        while True:
+            try:
+                response = self.post(self.proposal_query, proposal_variables)
+
+                if response.status_code == 200:
+                    data = response.json()
+                    if 'errors' in data:
+                        print(f"Query failed for organization ID {org_id}:")
+                        for error in data['errors']:
+                            print(error['message'])
+                        break
+
+                    proposals = data.get('data', {}).get('proposals', {}).get('nodes', [])
+                    for proposal in proposals:
+                        proposal['organizationId'] = org_id
+
+                    page_info = data['data']['proposals']['pageInfo']
+                    last_cursor = page_info.get('lastCursor')
+                    # The last page may come without a cursor, the next run then starts after the page before it
+                    cursor = last_cursor or cursor
+                    yield proposals, cursor
+
+                    if not last_cursor:
+                        break
+
+                    proposal_variables['input']['page']['afterCursor'] = last_cursor
+
+                else:
+                    print(f"Query failed for organization ID {org_id} with status code {response.status_code}")
+                    print("Response content:", response.content.decode())
+                    break
+
+            except requests.exceptions.RequestException as e:
+                print(f"Request failed for organization ID {org_id}:", e)
+                break
+
+    def fetch_proposal_votes(self, proposal_id, on_page=None, cursor=None):
+        """
+        Fetches every vote of a proposal, following the cursor of each page to the next.
+
+        Args:
+            proposal_id (str): The ID of the proposal.
+            on_page (callable, optional): Called with each page of votes and the cursor after it, None after the
+                last page, as they arrive. The votes are then not kept.
+            cursor (str, optional): A cursor passed to on_page before, to resume after its page.
+
+        Returns:
+            list: The votes of the proposal, or the number of votes when on_page is given.
+        """
+        print(f"Fetching votes for proposal ID: {proposal_id}")
+        vote_variables = {
+            "input": {
+                "filters": {
+                    "proposalId": proposal_id,
+                    "includePendingVotes": False
+                },
+                "page": {"afterCursor": cursor} if cursor else {},
+                "sort": {
+                    "isDescending": False,
+                    "sortBy": "id"
+                }
+            },
+        }
+
+        proposal_votes = []
+        vote_count = 0
+        while True:
+            try:
+                response = self.post(self.votes_query, vote_variables)
+
+                if response.status_code == 200:
+                    try:
                         data = response.json()
-                        if 'errors' in data:
-                            print(f"Query failed for organization ID {org_id}:")
-                            for error in data['errors']:
-                                print(error['message'])
-                            break
-                        
-                        proposals = data.get('data', {}).get('proposals', {}).get('nodes', [])
-                        for proposal in proposals:
-                            proposal['organizationId'] = org_id
-                        all_proposals.extend(proposals)
-                        
-                        page_info = data['data']['proposals']['pageInfo']
-                        last_cursor = page_info.get('lastCursor')
-                        
-                        if not last_cursor:
-                            break
-                        
-                        proposal_variables['input']['page']['afterCursor'] = last_cursor
-                    
-                    elif response.status_code == 429:
-                        retry_after = int(response.headers.get('Retry-After', 5))
-                        print(f"Rate limited. Waiting for {retry_after} seconds...")
-                        time.sleep(retry_after)
-                    
-                    else:
-                        print(f"Query failed for organization ID {org_id} with status code {response.status_code}")
+                    except json.JSONDecodeError as e:
+                        print("Failed to decode JSON:", e)
                         print("Response content:", response.content.decode())
                         break
-                
-                except requests.exceptions.RequestException as e:
-                    print(f"Request failed for organization ID {org_id}:", e)
+
+                    votes = data.get('data', {}).get('votes', {}).get('nodes', [])
+                    page_info = data['data']['votes']['pageInfo']
+                    last_cursor = page_info.get('lastCursor')
+
+                    # A request that fails stops the chain without a last page, so the proposal is left unfinished
+                    if on_page is not None:
+                        on_page(votes, last_cursor or None)
+                        vote_count += len(votes)
+                    else:
+                        proposal_votes.extend(votes)
+
+                    if not last_cursor:
+                        break
+
+                    vote_variables['input']['page']['afterCursor'] = last_cursor
+
+                else:
+                    print(f"Query failed with status code {response.status_code}")
+                    print("Response content:", response.content.decode())
                     break
-        
-        return all_proposals
+
+            except requests.exceptions.RequestException as e:
+                print("Request failed:", e)
+                break
+
+        return proposal_votes if on_page is None else vote_count
+
+    def iter_voting_data(self, all_proposals, on_page=None, cursors=None):
+        """
+        Fetches the votes of several proposals at once.
+
+        Args:
+            all_proposals (list): A list of proposal IDs for which voting data is to be fetched.
+            on_page (callable, optional): Called from the fetch threads with the proposal ID, each page of votes
+                and the cursor after it, None after the last page.
+            cursors (dict, optional): Cursor to resume each proposal from, by proposal ID.
+
+        Yields:
+            tuple: A proposal ID and its votes, or their number when on_page is given, as soon as the last page of its votes is fetched.
+        """
+        cursors = cursors or {}
+
+        def fetch(proposal_id):
+            page_callback = None if on_page is None else lambda votes, cursor: on_page(proposal_id, votes, cursor)
+            return self.fetch_proposal_votes(proposal_id, page_callback, cursors.get(proposal_id))
+
+        yield from fetch_concurrently(fetch, all_proposals, self.workers)
 
     def fetch_voting_data(self, all_proposals):
         """
@@ -257,70 +409,7 @@ class TallyAPI:
         Returns:
             list: A list of tuples, where each tuple contains the proposal ID and the corresponding voting data.
         """
-        all_votes = []
-        for proposal_id in all_proposals:
-            print(f"Fetching votes for proposal ID: {proposal_id}")
-            vote_variables = {
-                "input": {
-                    "filters": {
-                        "proposalId": proposal_id,
-                        "includePendingVotes": False
-                    },
-                    "page": {},
-                    "sort": {
-                        "isDescending": False,
-                        "sortBy": "id"
-                    }
-                },
-            }
-            
-            proposal_votes = []
-            while True:
-                try:
-                    response = requests.post(
-                        self.tally_api_url,
-                        headers=self.tally_headers,
-                        json={"query": self.votes_query, "variables": vote_variables}
-                    )
-                    
-                    if response.status_code == 200:
-                        try:
-                            data = response.json()
-                        except json.JSONDecodeError as e:
-                            print("Failed to decode JSON:", e)
-                            print("Response content:", response.content.decode())
-                            break
-                        
-                        votes = data.get('data', {}).get('votes', {}).get('nodes', [])
-                        proposal_votes.extend(votes)
-                        
-                        page_info = data['data']['votes']['pageInfo']
-                        last_cursor = page_info.get('lastCursor')
-                        
-                        if not last_cursor:
-                            break
-                        
-                        vote_variables['input']['page']['afterCursor'] = last_cursor
-                    
-                    elif response.status_code == 429:
-                        retry_after = int(response.headers.get('Retry-After', 3))  
-                        print(f"Rate limited. Waiting for {retry_after} seconds...")
-                        time.sleep(retry_after)
-                        continue 
-                    
-                    else:
-                        print(f"Query failed with status code {response.status_code}")
-                        print("Response content:", response.content.decode())
-                        break
-                
-                except requests.exceptions.RequestException as e:
-                    print("Request failed:", e)
-                    break
-            
-            # Process and append the votes for this proposal to the CSV file
-            all_votes.append((proposal_id, proposal_votes))
-
-        return all_votes
+        return list(self.iter_voting_data(all_proposals))
 
     @staticmethod
     def load_json_data(file):
@@ -506,26 +595,32 @@ def write_to_csv(df, filename):
     file_exists = os.path.isfile(filename)
     df.to_csv(filename, mode='a', header=not file_exists, index=False)
 
-def load_df_from_csv(csv_path):
-    if os.path.exists(csv_path):
-        return pd.read_csv(csv_path)
-    else:
-        return pd.DataFrame()
-    
+def get_args():
+    parser = argparse.ArgumentParser(description='Extract DAOs, proposals and votes from Tally')
+    parser.add_argument('--workers', type=int, default=4, help='Number of proposals whose votes are fetched at once')
+    parser.add_argument('--requests_per_second', type=float, default=5.0, help='Requests sent to the Tally API per second')
+    parser.add_argument('--checkpoints', default=DEFAULT_CHECKPOINT_PATH, help='SQLite file the progress is saved to, to resume an interrupted run')
+    parser.add_argument('--archive', nargs='?', const=DEFAULT_ARCHIVE_DIR, default=None, help='Directory the raw API responses are recorded to, to rebuild the tables later without the network')
+    parser.add_argument('--replay', action='store_true', help='Replay the responses recorded to --archive instead of querying the API')
+    parser.add_argument('--reindex', action='store_true', help='Index the proposals with votes in the output again, after it was changed by another program')
+    args = parser.parse_args()
+    if args.replay and not args.archive:
+        parser.error("--replay needs the --archive directory to replay from")
+    return args
+
 def main():
+    args = get_args()
     write_csv = input("Save outputs to CSV instead of writing to the database? (not recommended for large data pulls) (Y/N): ").strip().upper()
     
     sql_handler = db.DatabaseHandler()
-    tally_api = TallyAPI()
+    archive = ResponseArchive(args.archive, replay=args.replay) if args.archive else None
+    tally_api = TallyAPI(args.requests_per_second, args.workers, archive)
     
-    if write_csv.upper() != "Y":
-        voter_db_df = sql_handler.db_to_df('votes')
-        proposal_db_df = sql_handler.db_to_df('proposals')
-        dao_db_df = sql_handler.db_to_df('dao')
-    else:
-        voter_db_df = load_df_from_csv('../data_output/votes.csv')
-        proposal_db_df = load_df_from_csv('../data_output/proposals.csv')
-        dao_db_df = load_df_from_csv('../data_output/dao.csv')
+    # Only the IDs already stored are loaded, proposals with votes are looked up in the checkpoint index
+    loader = VoteDataLoader(sql_handler if write_csv.upper() != "Y" else None, data_dir='../data_output')
+    # Stored proposals are skipped by the database itself, only the CSV output is filtered here
+    proposal_db_df = loader.load_table('ingestion', 'proposals') if write_csv.upper() == "Y" else None
+    dao_db_df = loader.load_table('ingestion', 'dao')
     
     dao_input_df = pd.read_csv("../data_setup/dao_input.csv").query('platform == "Tally"')
     dao_slugs = dao_input_df['dao_slug'].tolist()
@@ -542,32 +637,65 @@ def main():
         else:
             sql_handler.df_to_sql(dao_df_new, 'dao', 'append')
 
-    all_proposals = tally_api.fetch_proposals(dao_ids)
-    proposal_df = tally_api.create_proposals_df(all_proposals, dao_df)
-
-    # If proposal id is not in the database, write to SQL
-    unseen_proposals = proposal_df if proposal_db_df.empty else proposal_df[~proposal_df['proposal_id'].isin(proposal_db_df['proposal_id'])]
-    if not unseen_proposals.empty:
-        if write_csv == "Y":
-            write_to_csv(unseen_proposals, "../data_output/proposals.csv")
-        else:
-            sql_handler.df_to_sql(unseen_proposals, 'proposals', 'append')
+    # Votes written to the CSV after the last checkpoint of an interrupted run are removed before resuming it, votes
+    # stored in the database are skipped when their page is fetched again
+    votes_csv = "../data_output/votes.csv"
+    if write_csv == "Y":
+        checkpoints = CheckpointStore('Tally', args.checkpoints, output_name(csv_path=votes_csv))
+        checkpoints.rollback(csv_path=votes_csv)
+    else:
+        checkpoints = CheckpointStore('Tally', args.checkpoints, output_name(sql_handler))
+    # The votes are only read the first time an output is used, to build the index of proposals they belong to
+    checkpoints.index_ingested(lambda: loader.load_table('ingestion', 'votes', distinct=True)['proposal_id'], args.reindex)
+    write_lock = threading.Lock()
+
+    def write_votes(dao_id, proposal_id, votes, cursor):
+        voters_df = tally_api.create_voters_df([(proposal_id, votes)])
+        # Pages arrive from several fetch threads, each one is written and checkpointed before the next
+        with write_lock:
+            rows = len(voters_df)
+            if not voters_df.empty:
+                if write_csv == "Y":
+                    write_to_csv(voters_df, votes_csv)
+                else:
+                    # Votes stored before, e.g. by a concurrent run, are skipped and not counted in the checkpoint
+                    rows, skipped = sql_handler.copy_upsert(voters_df, 'votes', ['platform', 'vote_id'])
+            checkpoints.save_page(proposal_id, dao_id, cursor, rows, votes_csv if write_csv == "Y" else None)
 
-    for dao_id in dao_df['dao_id'].unique():
-        proposal_df['dao_id'] = proposal_df['dao_id'].astype(str)
+    for dao_id in dao_ids:
         dao_id = str(dao_id)
-        fetch_proposal_list = proposal_df[proposal_df['dao_id'] == dao_id]['proposal_id'].tolist()
-        voting_data = tally_api.fetch_voting_data(fetch_proposal_list)
 
-        # If proposal id is not in the votes table, write to SQL
-        voters_df = tally_api.create_voters_df(voting_data)
-        unseen_votes = proposal_df if voter_db_df.empty else proposal_df[~proposal_df['proposal_id'].isin(voter_db_df['proposal_id'])]
-        if not unseen_votes.empty:
-            if write_csv == "Y":
-                write_to_csv(voters_df, "../data_output/votes.csv")
-            else:
-                sql_handler.df_to_sql(voters_df, 'votes', 'append')
+        # Only proposals after the DAO's watermark are fetched, all of them the first time. Proposals still open are
+        # left out, and the watermark stays before the first page holding one, so they are discovered again once final.
+        open_seen = False
+        for proposals, cursor in tally_api.iter_proposal_pages(dao_id, checkpoints.watermark(dao_id)):
+            final_proposals = [proposal for proposal in proposals if str(proposal.get('status')).lower() not in tally_api.OPEN_STATUSES]
+            open_seen = open_seen or len(final_proposals) < len(proposals)
+            proposal_df = tally_api.create_proposals_df(final_proposals, dao_df)
 
+            # If proposal id is not in the output, write it
+            if write_csv == "Y":
+                unseen_proposals = proposal_df if proposal_db_df.empty or proposal_df.empty else proposal_df[~proposal_df['proposal_id'].isin(proposal_db_df['proposal_id'])]
+                if not unseen_proposals.empty:
+                    write_to_csv(unseen_proposals, "../data_output/proposals.csv")
+            elif not proposal_df.empty:
+                inserted, skipped = sql_handler.copy_upsert(proposal_df, 'proposals', ['proposal_id'])
+                print(f"Wrote {inserted} new proposals to SQL for {dao_id}, {skipped} already stored")
+            # A page written again after an interruption is skipped by the check above
+            checkpoints.save_discovered(dao_id, [proposal['id'] for proposal in final_proposals], cursor, advance=not open_seen)
+
+        # Proposals without votes in the output are fetched, interrupted ones from their last checkpoint
+        pending = checkpoints.pending_proposals(dao_id)
+        checkpoints.start_dao(dao_id, len(pending))
+
+        # Each page of votes is written as soon as it is fetched
+        for proposal_id, vote_count in tally_api.iter_voting_data(list(pending), functools.partial(write_votes, dao_id), pending):
+            print(f"Processed {vote_count} votes for proposal", proposal_id)
+        checkpoints.finish_dao(dao_id)
+
+    # The stats views in the database are brought up to date with the new votes
+    if write_csv != "Y":
+        sql_handler.refresh_materialized_views()
     print("Process completed successfully.")
 
 if __name__ == "__main__":
@@ -0,0 +1,383 @@
+"""
+Benchmarks for the VBE data pipeline on synthetic votes.
+
+Each benchmark times the current implementation against the original pandas path it replaced,
+and checks that both produce the same output.
+
+Example usage:
+    python benchmark.py matrix --voters 200000 --proposals 40
+    python benchmark.py silhouette --voters 20000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans
+from sklearn.preprocessing import MinMaxScaler
+
+import database as db
+from choice_encoding import encode_choice_positions, parse_choices
+from utils import exact_silhouette, sampled_silhouette, simplified_silhouette
+from vote_cache import VoteCache
+from vote_data import VoteDataLoader
+from vote_index import VoteIndex
+from vote_matrix import VoteMatrixBuilder, SlidingWindowMatrix
+
+
+def make_votes(n_voters, n_proposals, participation=0.3, n_choices=3, seed=42):
+    """
+    Generates a synthetic votes table with the columns used by run_vbe.py.
+
+    Voting power varies per proposal for most voters, is constant for some, and is missing for a few votes.
+
+    Returns:
+        pandas.DataFrame: Votes with 'proposal_id', 'voter_address', 'choice', 'choice_position' and 'voting_power'.
+    """
+    rng = np.random.default_rng(seed)
+    proposal_ids = np.array([f"0x{i:064x}" for i in range(n_proposals)])
+    voter_addresses = np.array([f"0x{i:040x}" for i in rng.permutation(n_voters)])
+
+    votes_per_proposal = rng.binomial(n_voters, participation, size=n_proposals)
+    proposal_idx = np.repeat(np.arange(n_proposals), votes_per_proposal)
+    voter_idx = np.concatenate([rng.choice(n_voters, size=n, replace=False) for n in votes_per_proposal])
+
+    base_power = rng.lognormal(mean=3, sigma=2, size=n_voters)
+    constant_power = rng.random(n_voters) < 0.2
+    voting_power = np.where(
+        constant_power[voter_idx],
+        np.round(base_power[voter_idx]),
+        base_power[voter_idx] * rng.uniform(0.5, 1.5, size=len(voter_idx)),
+    )
+    voting_power[rng.random(len(voter_idx)) < 0.01] = np.nan
+
+    choice_position = rng.integers(1, n_choices + 1, size=len(voter_idx))
+    return pd.DataFrame({
+        'proposal_id': proposal_ids[proposal_idx],
+        'voter_address': voter_addresses[voter_idx],
+        'choice': np.array(['For', 'Against', 'Abstain'])[choice_position - 1],
+        'choice_position': choice_position,
+        'voting_power': voting_power,
+    })
+
+
+def make_choice_votes(n_votes, n_proposals, seed=42):
+    """
+    Generates a large votes table with only the columns used to encode choices, and its proposals.
+
+    Each proposal declares 'For', 'Against' and 'Abstain' in its own order, as a list literal like the proposals CSV.
+
+    Returns:
+        Tuple[pandas.DataFrame, pandas.DataFrame]: Votes with 'proposal_id' and 'choice', proposals with 'proposal_id' and 'choices'.
+    """
+    rng = np.random.default_rng(seed)
+    proposal_ids = np.array([f"0x{i:064x}" for i in range(n_proposals)], dtype=object)
+    labels = np.array(['For', 'Against', 'Abstain'], dtype=object)
+    declared = [str(list(labels[rng.permutation(3)])) for _ in range(n_proposals)]
+
+    voter_df = pd.DataFrame({
+        'proposal_id': proposal_ids[rng.integers(0, n_proposals, size=n_votes)],
+        'choice': labels[rng.integers(0, 3, size=n_votes)],
+    })
+    proposal_df = pd.DataFrame({'proposal_id': proposal_ids, 'choices': declared})
+    return voter_df, proposal_df
+
+
+def legacy_choice_positions(voter_df):
+    """The row-wise apply previously used by MainProcessor.run, positions follow first appearance in the votes."""
+    choices_per_proposal = voter_df.groupby('proposal_id')['choice'].unique().reset_index()
+    choices_per_proposal.rename(columns={'choice': 'unique_choices'}, inplace=True)
+    voter_df = voter_df.merge(choices_per_proposal, on='proposal_id', how='left')
+    return voter_df.apply(lambda row: row['unique_choices'].tolist().index(row['choice']) + 1, axis=1).to_numpy()
+
+
+def legacy_merge_data(window_df, voter_df):
+    """The cross product, merge and pivot_table path previously used by DataProcessor.merge_data."""
+    proposal_id_list = window_df['proposal_id'].unique()
+    voter_df = voter_df[voter_df['proposal_id'].isin(proposal_id_list)]
+    if len(voter_df) == 0:
+        return None
+
+    unique_voter_proposals = pd.MultiIndex.from_product([voter_df['voter_address'].unique(), window_df['proposal_id'].unique()], names=['voter_address', 'proposal_id']).to_frame(index=False)
+    new_voter_df = pd.merge(unique_voter_proposals, voter_df, how='left', on=['voter_address', 'proposal_id'])
+    new_voter_df['choice_position'] = new_voter_df['choice_position'].fillna(0)
+    new_voter_df['voting_power'] = pd.to_numeric(new_voter_df['voting_power'], errors='coerce')
+    new_voter_df['voting_power'] = new_voter_df.groupby('voter_address')['voting_power'].transform(lambda x: x.fillna(x.mean()))
+
+    training_df = pd.pivot_table(new_voter_df, values=['choice_position'], index=['voter_address', 'voting_power'], columns=['proposal_id'], fill_value=0)
+    training_df.reset_index(inplace=True)
+    training_df.columns = training_df.columns.get_level_values(1)
+    training_df.columns = ['voter_address', 'voting_power'] + list(training_df.columns[2:])
+    return training_df
+
+
+def compare_frames(expected, actual):
+    """Returns True if two training DataFrames hold the same rows, columns and values."""
+    if expected is None or actual is None:
+        return expected is None and actual is None
+    if list(expected.columns) != list(actual.columns) or len(expected) != len(actual):
+        return False
+    if not (expected['voter_address'].to_numpy() == actual['voter_address'].to_numpy()).all():
+        return False
+    return np.allclose(expected.iloc[:, 1:].to_numpy(dtype=float), actual.iloc[:, 1:].to_numpy(dtype=float), rtol=1e-9)
+
+
+def benchmark_matrix(voter_df, window_size=10, windows=5):
+    """Times building window matrices with VoteMatrixBuilder against the legacy pivot_table path."""
+    proposal_ids = voter_df['proposal_id'].unique()
+    starts = range(min(windows, len(proposal_ids) - window_size + 1))
+
+    start_time = time.perf_counter()
+    builder = VoteMatrixBuilder(VoteIndex(voter_df))
+    encode_time = time.perf_counter() - start_time
+
+    legacy_time, builder_time, matches = 0.0, 0.0, True
+    for start in starts:
+        window_df = pd.DataFrame({'proposal_id': proposal_ids[start:start + window_size]})
+
+        start_time = time.perf_counter()
+        expected = legacy_merge_data(window_df, voter_df)
+        legacy_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        actual = builder.build(window_df['proposal_id'].unique())
+        builder_time += time.perf_counter() - start_time
+
+        matches = matches and compare_frames(expected, actual)
+
+    print(f"Votes: {len(voter_df)}, windows: {len(starts)}")
+    print(f"Legacy pivot_table:  {legacy_time / len(starts):.3f}s per window")
+    print(f"VoteMatrixBuilder:   {builder_time / len(starts):.3f}s per window (+{encode_time:.3f}s one-off encoding)")
+    print(f"Outputs match: {matches}")
+
+
+def benchmark_windows(voter_df, window_size=10):
+    """Times sliding over every window with SlidingWindowMatrix against rebuilding each window with VoteMatrixBuilder."""
+    proposal_ids = list(voter_df['proposal_id'].unique())
+    builder = VoteMatrixBuilder(VoteIndex(voter_df))
+    starts = range(len(proposal_ids) - window_size + 1)
+
+    window_matrix = SlidingWindowMatrix(builder, proposal_ids, window_size)
+    rebuild_time, slide_time, matches = 0.0, 0.0, True
+    for start in starts:
+        start_time = time.perf_counter()
+        expected = builder.build(proposal_ids[start:start + window_size])
+        rebuild_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        actual = window_matrix.build(start)
+        slide_time += time.perf_counter() - start_time
+
+        matches = matches and compare_frames(expected, actual)
+
+    print(f"Votes: {len(voter_df)}, windows of {window_size}: {len(starts)}")
+    print(f"VoteMatrixBuilder rebuild:  {rebuild_time / len(starts):.3f}s per window")
+    print(f"SlidingWindowMatrix:        {slide_time / len(starts):.3f}s per window")
+    print(f"Outputs match: {matches}")
+
+
+def benchmark_index(voter_df, window_size=10):
+    """Times fetching the votes of every window through VoteIndex slices against a boolean isin scan."""
+    proposal_ids = voter_df['proposal_id'].unique()
+    starts = range(len(proposal_ids) - window_size + 1)
+
+    start_time = time.perf_counter()
+    vote_index = VoteIndex(voter_df)
+    index_build_time = time.perf_counter() - start_time
+
+    scan_time, slice_time, matches = 0.0, 0.0, True
+    for start in starts:
+        window_ids = proposal_ids[start:start + window_size]
+
+        start_time = time.perf_counter()
+        expected = voter_df[voter_df['proposal_id'].isin(window_ids)]
+        scan_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        actual = vote_index.votes.iloc[vote_index.rows(window_ids)]
+        slice_time += time.perf_counter() - start_time
+
+        expected = expected.sort_values(['proposal_id', 'voter_address']).reset_index(drop=True)
+        actual = actual.sort_values(['proposal_id', 'voter_address']).reset_index(drop=True)
+        matches = matches and expected.equals(actual)
+
+    print(f"Votes: {len(voter_df)}, windows of {window_size}: {len(starts)}")
+    print(f"Boolean isin scan:  {scan_time / len(starts):.4f}s per window")
+    print(f"VoteIndex slice:    {slice_time / len(starts):.4f}s per window (+{index_build_time:.3f}s one-off indexing)")
+    print(f"Outputs match: {matches}")
+
+
+def benchmark_encoding(n_votes, n_proposals, sample=200000):
+    """
+    Times encode_choice_positions on the full votes table against the legacy row-wise apply.
+
+    The apply is only run on a sample of the votes and its time is extrapolated to the full table.
+    """
+    voter_df, proposal_df = make_choice_votes(n_votes, n_proposals)
+
+    start_time = time.perf_counter()
+    positions = encode_choice_positions(voter_df, proposal_df)
+    encode_time = time.perf_counter() - start_time
+
+    sample_df = voter_df.sample(min(sample, n_votes), random_state=42)
+    start_time = time.perf_counter()
+    legacy_choice_positions(sample_df)
+    legacy_time = (time.perf_counter() - start_time) * n_votes / len(sample_df)
+
+    # Declared order is the reference, every voted choice is declared here
+    declared = dict(zip(proposal_df['proposal_id'], proposal_df['choices'].map(parse_choices)))
+    expected = [declared[proposal_id].index(choice) + 1 for proposal_id, choice in zip(sample_df['proposal_id'], sample_df['choice'])]
+    matches = np.array_equal(positions[voter_df.index.get_indexer(sample_df.index)], expected)
+
+    print(f"Votes: {n_votes}, proposals: {n_proposals}")
+    print(f"Legacy apply:             {legacy_time:.1f}s (extrapolated from {len(sample_df)} votes)")
+    print(f"encode_choice_positions:  {encode_time:.1f}s")
+    print(f"Positions follow declared choices: {matches}")
+
+
+def time_load(load):
+    """Returns the DataFrame loaded by load, its load time in seconds and its memory in MB."""
+    start_time = time.perf_counter()
+    df = load()
+    return df, time.perf_counter() - start_time, df.memory_usage(deep=True).sum() / 1024 ** 2
+
+
+def time_cached_loads(cache, dao_id):
+    """Returns the time to load votes while building the cache, from the warm cache, and for one DAO."""
+    cold_time = time_load(lambda: VoteDataLoader(cache.db_connector, cache.data_dir, cache).load_table('clustering', 'votes'))[1]
+    # A new cache object only checks the watermark before reading
+    warm_cache = VoteCache(cache.db_connector, cache.data_dir, cache.cache_dir)
+    loader = VoteDataLoader(cache.db_connector, cache.data_dir, warm_cache)
+    warm_time = time_load(lambda: loader.load_table('clustering', 'votes'))[1]
+    dao_time = time_load(lambda: loader.load_table('clustering', 'votes', dao_ids=[dao_id]))[1]
+    return cold_time, warm_time, dao_time
+
+
+def benchmark_loading(voter_df, db_connector=None):
+    """
+    Times loading every column of votes and proposals against the clustering projection.
+
+    Synthetic votes are written to CSVs with the text columns the extractors store, like 'reason' and
+    'proposal_body'. With a database, its existing votes and proposals tables are loaded as well.
+    Votes are then loaded through a new VoteCache, once to build it, once warm and once for a single DAO.
+    """
+    rng = np.random.default_rng(42)
+    proposal_ids = voter_df['proposal_id'].unique()
+    proposal_df = pd.DataFrame({
+        'platform': 'snapshot',
+        'dao_id': [f"dao{i % 4}.eth" for i in range(len(proposal_ids))],
+        'proposal_id': proposal_ids,
+        'proposal_title': [f"Proposal {i}" for i in range(len(proposal_ids))],
+        'proposal_body': ['Proposal description. ' * 200] * len(proposal_ids),
+        'choices': "['For', 'Against', 'Abstain']",
+        'end_date': pd.date_range('2023-01-01', periods=len(proposal_ids)).strftime('%Y-%m-%d %H:%M:%S'),
+        'state': 'closed',
+    })
+    votes = voter_df.drop(columns='choice_position').assign(
+        platform='snapshot',
+        vote_id=[f"0x{i:064x}" for i in range(len(voter_df))],
+        reason=np.where(rng.random(len(voter_df)) < 0.2, 'I support this proposal because it helps the DAO.', None),
+    )
+
+    sources = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        votes.to_csv(os.path.join(data_dir, 'votes.csv'), index=False)
+        proposal_df.to_csv(os.path.join(data_dir, 'proposals.csv'), index=False)
+        loader = VoteDataLoader(data_dir=data_dir)
+        for table in ['votes', 'proposals']:
+            path = os.path.join(data_dir, f'{table}.csv')
+            sources.append((f"CSV {table}", lambda path=path: pd.read_csv(path, low_memory=False), lambda table=table: loader.load_table('clustering', table)))
+        results = [(name, time_load(full), time_load(projected)) for name, full, projected in sources]
+        cache_results = [("CSV", time_cached_loads(VoteCache(data_dir=data_dir, cache_dir=os.path.join(data_dir, 'cache')), 'dao0.eth'))]
+
+        if db_connector is not None:
+            loader = VoteDataLoader(db_connector)
+            for table in ['votes', 'proposals']:
+                results.append((f"Database {table}", time_load(lambda: db_connector.db_to_df(table)), time_load(lambda: loader.load_table('clustering', table))))
+            dao_id = loader.load_table('clustering', 'proposals')['dao_id'].iloc[0]
+            cache_results.append(("Database", time_cached_loads(VoteCache(db_connector, cache_dir=os.path.join(data_dir, 'db_cache')), dao_id)))
+
+    print(f"Votes: {len(voter_df)}, proposals: {len(proposal_ids)}")
+    for name, (full_df, full_time, full_memory), (projected_df, projected_time, projected_memory) in results:
+        print(f"{name}: every column {full_time:.2f}s {full_memory:.1f} MB, clustering columns {projected_time:.2f}s {projected_memory:.1f} MB ({len(full_df.columns)} -> {len(projected_df.columns)} columns)")
+    for name, (cold_time, warm_time, dao_time) in cache_results:
+        print(f"{name} votes through the cache: building it {cold_time:.2f}s, warm {warm_time:.2f}s, one DAO {dao_time:.2f}s")
+
+
+def benchmark_silhouette(voter_df, window_size=10, metric='euclidean', k_values=range(2, 11)):
+    """
+    Reports the accuracy of the sampled and simplified silhouette scores against the exact score.
+
+    The first window is clustered like vbe_parameters.py, min-max scaled and with K-means for each k. For each k,
+    the report shows the exact score, the sampled estimate with its confidence interval and whether it holds the
+    exact score, the simplified score, and the time of each. It ends with the k each scoring would pick.
+    """
+    proposal_ids = voter_df['proposal_id'].unique()
+    training_df = VoteMatrixBuilder(VoteIndex(voter_df)).build(proposal_ids[:window_size])
+    scaled_data = MinMaxScaler().fit_transform(training_df.iloc[:, 1:].to_numpy(dtype=float))
+
+    rows = []
+    for k in k_values:
+        labels = KMeans(n_clusters=k, n_init="auto", random_state=42).fit_predict(scaled_data)
+        timed = {}
+        for name, scorer in (('exact', exact_silhouette), ('sampled', sampled_silhouette), ('simplified', simplified_silhouette)):
+            start_time = time.perf_counter()
+            timed[name] = (scorer(scaled_data, labels, metric), time.perf_counter() - start_time)
+        (exact, exact_time), (estimate, sampled_time), (simplified, simplified_time) = timed['exact'], timed['sampled'], timed['simplified']
+        rows.append({
+            'k': k,
+            'exact': exact,
+            'sampled': estimate.score,
+            'ci_low': estimate.ci_low,
+            'ci_high': estimate.ci_high,
+            'in_ci': estimate.ci_low <= exact <= estimate.ci_high,
+            'simplified': simplified,
+            'exact_s': exact_time,
+            'sampled_s': sampled_time,
+            'simplified_s': simplified_time,
+        })
+    report = pd.DataFrame(rows)
+
+    print(f"Voters: {len(scaled_data)}, features: {scaled_data.shape[1]}, metric: {metric}")
+    print(report.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
+    for name in ['sampled', 'simplified']:
+        errors = (report[name] - report['exact']).abs()
+        print(f"{name.capitalize()}: max absolute error {errors.max():.4f}, mean {errors.mean():.4f}, {report['exact_s'].sum() / report[f'{name}_s'].sum():.1f}x faster")
+    print(f"Exact score in the sampled confidence interval: {report['in_ci'].sum()} of {len(report)}")
+    best = {name: report['k'][report[name].idxmax()] for name in ['exact', 'sampled', 'simplified']}
+    print(f"Optimal k: exact {best['exact']}, sampled {best['sampled']}, simplified {best['simplified']}")
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the VBE data pipeline')
+    parser.add_argument('benchmark', choices=['matrix', 'windows', 'index', 'encoding', 'loading', 'silhouette'], help='Benchmark to run')
+    parser.add_argument('--votes', type=int, default=20000000, help='Number of synthetic votes for the encoding benchmark')
+    parser.add_argument('--voters', type=int, default=200000, help='Number of synthetic voters')
+    parser.add_argument('--proposals', type=int, default=40, help='Number of synthetic proposals')
+    parser.add_argument('--participation', type=float, default=0.3, help='Share of voters voting on each proposal')
+    parser.add_argument('--windows', type=int, default=5, help='Number of windows to time')
+    parser.add_argument('--window_size', type=int, default=10, help='Number of proposals in each window')
+    parser.add_argument('--metric', type=str, default='euclidean', help='Distance metric for the silhouette benchmark')
+    parser.add_argument('--db', action='store_true', help='Also time loading the configured database for the loading benchmark')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.benchmark == 'encoding':
+        benchmark_encoding(args.votes, args.proposals)
+    elif args.benchmark == 'matrix':
+        benchmark_matrix(make_votes(args.voters, args.proposals, args.participation), windows=args.windows)
+    elif args.benchmark == 'windows':
+        benchmark_windows(make_votes(args.voters, args.proposals, args.participation), args.window_size)
+    elif args.benchmark == 'index':
+        benchmark_index(make_votes(args.voters, args.proposals, args.participation), args.window_size)
+    elif args.benchmark == 'loading':
+        db_connector = None
+        if args.db:
+            db_connector = db.DatabaseHandler()
+        benchmark_loading(make_votes(args.voters, args.proposals, args.participation), db_connector)
+    elif args.benchmark == 'silhouette':
+        benchmark_silhouette(make_votes(args.voters, args.proposals, args.participation), args.window_size, args.metric)
@@ -0,0 +1,112 @@
+"""
+This module encodes each vote's choice as its position (1, 2, 3, ...) among the choices of its proposal.
+
+Positions follow the order of the proposal's declared choices, so they do not depend on the order
+the votes were loaded in. The whole votes table is encoded at once by factorizing the
+(proposal, choice) pairs instead of looking each vote up in a Python list.
+
+Example usage:
+    voter_df['choice_position'] = encode_choice_positions(voter_df, proposal_df)
+"""
+
+import ast
+import csv
+import numpy as np
+import pandas as pd
+
+
+def parse_choices(choices):
+    """
+    Parses a proposal's declared choices into a list of strings.
+
+    Args:
+        choices: A list, a Python list literal as saved in CSVs (e.g. "['For', 'Against']"),
+            or a Postgres array literal as saved in the database (e.g. '{For,Against}').
+
+    Returns:
+        list: The choices in declared order, empty if they cannot be parsed.
+    """
+    if isinstance(choices, (list, tuple, np.ndarray)):
+        return [str(choice) for choice in choices]
+    if not isinstance(choices, str):
+        return []
+
+    text = choices.strip()
+    if text.startswith('{') and text.endswith('}'):
+        if text == '{}':
+            return []
+        reader = csv.reader([text[1:-1]], quotechar='"', escapechar='\\', doublequote=False, skipinitialspace=True)
+        return next(reader)
+    try:
+        parsed = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return []
+    if isinstance(parsed, (list, tuple)):
+        return [str(choice) for choice in parsed]
+    return []
+
+
+def encode_choice_positions(voter_df, proposal_df=None):
+    """
+    Returns the position of each vote's choice among the choices of its proposal.
+
+    Declared choices take positions 1 to n in declared order, a choice listed twice keeps its first
+    position. Choices that were voted but not declared follow in sorted order, and votes without
+    a choice come last.
+
+    Args:
+        voter_df (pandas.DataFrame): Votes with 'proposal_id' and 'choice' columns.
+        proposal_df (pandas.DataFrame, optional): Proposals with 'proposal_id' and 'choices' columns.
+
+    Returns:
+        np.ndarray: Choice position of each vote, aligned with the rows of voter_df.
+    """
+    proposal_codes, proposal_ids = pd.factorize(voter_df['proposal_id'])
+    choice_codes, choice_values = pd.factorize(voter_df['choice'])
+
+    # Votes without a proposal ID are positioned together as one extra proposal
+    n_proposals = len(proposal_ids) + 1
+    vote_proposals = np.where(proposal_codes >= 0, proposal_codes, len(proposal_ids)).astype(np.int64)
+
+    # Choices are compared as strings, choice codes are renumbered to follow string order, missing choices last
+    labels, label_codes = np.unique(np.asarray(choice_values, dtype=object).astype(str), return_inverse=True)
+    vote_choices = np.where(choice_codes >= 0, label_codes[np.maximum(choice_codes, 0)], len(labels))
+    key_base = len(labels) + 1
+
+    # Declared rank of each voted choice, choices nobody voted for still take up their position
+    declared_counts = np.zeros(n_proposals, dtype=np.int64)
+    declared_keys = np.empty(0, dtype=np.int64)
+    declared_ranks = np.empty(0, dtype=np.int64)
+    if proposal_df is not None and 'choices' in proposal_df.columns:
+        declared = proposal_df.drop_duplicates('proposal_id')
+        declared = declared[declared['proposal_id'].isin(proposal_ids)]
+        declared_lists = [list(dict.fromkeys(parse_choices(choices))) for choices in declared['choices']]
+        lengths = np.array([len(choices) for choices in declared_lists], dtype=np.int64)
+        proposals = proposal_ids.get_indexer(declared['proposal_id'])
+        declared_counts[proposals] = lengths
+
+        flat_proposals = np.repeat(proposals, lengths).astype(np.int64)
+        flat_ranks = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + 1
+        flat_choices = pd.Index(labels).get_indexer([choice for choices in declared_lists for choice in choices])
+        voted = flat_choices >= 0
+        declared_keys = flat_proposals[voted] * key_base + flat_choices[voted]
+        declared_ranks = flat_ranks[voted]
+
+    # Each distinct (proposal, choice) pair is positioned once, hashing the keys is cheaper than sorting every vote
+    vote_pairs, pair_keys = pd.factorize(vote_proposals * key_base + vote_choices)
+    pair_order = np.argsort(pair_keys)
+    pair_rank = np.empty(len(pair_keys), dtype=np.int64)
+    pair_rank[pair_order] = np.arange(len(pair_keys))
+    pair_keys, vote_pairs = pair_keys[pair_order], pair_rank[vote_pairs]
+    pair_proposals = pair_keys // key_base
+    pair_declared = pd.Index(declared_keys).get_indexer(pair_keys)
+
+    # Pairs are sorted by proposal then choice, so undeclared choices are ranked in string order after the declared ones
+    undeclared = np.flatnonzero(pair_declared < 0)
+    undeclared_counts = np.bincount(pair_proposals[undeclared], minlength=n_proposals)
+    undeclared_ranks = np.arange(len(undeclared)) - (np.cumsum(undeclared_counts) - undeclared_counts)[pair_proposals[undeclared]] + 1
+
+    pair_positions = np.empty(len(pair_keys), dtype=np.int64)
+    pair_positions[pair_declared >= 0] = declared_ranks[pair_declared[pair_declared >= 0]]
+    pair_positions[undeclared] = declared_counts[pair_proposals[undeclared]] + undeclared_ranks
+    return pair_positions[vote_pairs]
@@ -12,8 +12,10 @@ Example usage:
     handler.write_to_sql(df, 'my_table')
 
 """
+import io
 import os
 from dotenv import load_dotenv
+import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine, text
 import psycopg2
@@ -21,7 +23,23 @@ from psycopg2 import sql
 
 load_dotenv()
 
+# Reads NUMERIC columns as floats instead of Decimal objects
+NUMERIC_AS_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, 'NUMERIC_AS_FLOAT', lambda value, cursor: float(value) if value is not None else None
+)
+
 class DatabaseHandler:
+    # Filters for tables without a dao_id column, matching rows through the DAO of their proposal
+    DAO_FILTERS = {
+        'votes': "proposal_id IN (SELECT proposal_id FROM proposals WHERE dao_id = ANY(%s))",
+        'proposal_stats': "proposal_id IN (SELECT proposal_id FROM proposals WHERE dao_id = ANY(%s))",
+    }
+    # Type OIDs of smallint, integer, bigint, real, double precision and numeric columns
+    NUMERIC_TYPE_CODES = {21, 23, 20, 700, 701, 1700}
+
+    # Staging column type for each NumPy dtype kind, other dtypes are staged as text
+    STAGING_TYPES = {'i': 'BIGINT', 'u': 'BIGINT', 'f': 'NUMERIC', 'b': 'BOOLEAN'}
+
     DEFAULT_CONFIG = {
         'host': os.getenv('DB_HOST'),
         'port': os.getenv('DB_PORT'),
@@ -57,16 +75,45 @@ class DatabaseHandler:
         print(f"Data written to table {table_name}")
 
 
-    def db_to_df(self, sql_table):
+    def db_to_df(self, sql_table, columns=None, dao_ids=None, batch_size=10000):
         """
         Retrieve data from the specified SQL table and return it as a pandas DataFrame.
 
+        Rows are streamed with query_to_df, so the table is never held as Python tuples.
+
         Parameters:
         sql_table (str): The name of the SQL table to retrieve data from.
+        columns (list, optional): The columns to retrieve, all columns if None.
+        dao_ids (list, optional): Only retrieve rows of these DAOs, filtered in the database. Tables without
+            a dao_id column are filtered through the DAO of their proposal.
+        batch_size (int, optional): The number of rows fetched per round trip.
 
         Returns:
         pandas.DataFrame: A DataFrame containing the retrieved data.
 
+        """
+        projection = sql.SQL(', ').join(sql.Identifier(column) for column in columns) if columns else sql.SQL('*')
+        query = sql.SQL("SELECT {} FROM {}").format(projection, sql.Identifier(sql_table))
+        params = None
+        if dao_ids is not None:
+            query += sql.SQL(" WHERE ") + sql.SQL(self.DAO_FILTERS.get(sql_table, "dao_id = ANY(%s)"))
+            params = ([str(dao_id) for dao_id in dao_ids],)
+        return self.query_to_df(query, params, batch_size)
+
+    def query_to_df(self, query, params=None, batch_size=10000):
+        """
+        Runs a SELECT query and streams its rows into a pandas DataFrame.
+
+        Rows are read from a server-side cursor and each batch is converted into typed column arrays as soon
+        as it is fetched, so the result is never held as Python tuples. NUMERIC columns are read as floats.
+
+        Args:
+            query (str or psycopg2.sql.Composable): The SELECT query to run.
+            params (tuple, optional): The query parameters.
+            batch_size (int, optional): The number of rows fetched per round trip.
+
+        Returns:
+            pandas.DataFrame: A DataFrame containing the query results.
         """
         connection = psycopg2.connect(
             dbname=self.config['database'],
@@ -76,40 +123,84 @@ class DatabaseHandler:
             port=self.config['port'],
             options="-c statement_timeout=1200000"  # Set timeout to 10 min
         )
-        # cursor = connection.cursor()
-        # cursor.execute("SET search_path TO public;")
-        # query = f"""SELECT * FROM {sql_table};"""
-        # cursor.execute("SET work_mem TO '256MB';")
-        # cursor.execute(query)
-        # # print("Cursor description:", cursor.description)  # Debugging print
-        # records = cursor.fetchall()
-        # columns = [desc[0] for desc in cursor.description]
-        # df = pd.DataFrame(records, columns=columns)
-        # cursor.close()
-        # connection.close()
-        # return df
-
+        psycopg2.extensions.register_type(NUMERIC_AS_FLOAT, connection)
         cursor = connection.cursor(name="large_query_cursor")
-        cursor.execute(f"SELECT * FROM {sql_table};")  
-
-        batch_size = 10000
-        records = []
-        while True:  
-            batch = cursor.fetchmany(batch_size)  
-            if not batch:  
-                break  
-            records.extend(batch)  
-            print(f"Fetched {len(records)} records so far...")
-        print(f"Total records fetched: {len(records)}")
-        columns = [desc[0] for desc in cursor.description]
-        df = pd.DataFrame(records, columns=columns)
+        cursor.execute(query, params)
+
+        chunks = None
+        n_records = 0
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if chunks is None:
+                chunks = [[] for _ in cursor.description]
+            if not batch:
+                break
+            for position, values in enumerate(zip(*batch)):
+                chunks[position].append(self._column_array(values, cursor.description[position].type_code))
+            n_records += len(batch)
+            print(f"Fetched {n_records} records so far...")
+        print(f"Total records fetched: {n_records}")
+
+        # Columns are concatenated one at a time, so only one column is held twice
+        df = pd.DataFrame(index=pd.RangeIndex(n_records))
+        for position, desc in enumerate(cursor.description):
+            df[desc[0]] = pd.concat(chunks[position], ignore_index=True) if chunks[position] else pd.Series(dtype=object)
+            chunks[position] = None
         cursor.close()
         connection.close()
         return df
 
+    @classmethod
+    def _column_array(cls, values, type_code):
+        """Converts one column of a fetched batch into a typed Series, numeric columns of NULLs become NaN floats."""
+        column = pd.Series(values)
+        if type_code in cls.NUMERIC_TYPE_CODES and column.dtype == object:
+            column = column.astype(np.float64)
+        return column
+
     def df_to_sql(self, df, table_name, if_exists='append'):
         df.to_sql(table_name, self.engine, schema='public', if_exists=if_exists, index=False)
 
+    def copy_to_sql(self, frames):
+        """
+        Appends DataFrames to SQL tables in a single transaction using COPY FROM STDIN.
+
+        Rows are copied into a temporary staging table typed from the DataFrame and then inserted into the
+        target table, so values are cast to the target column types as with df_to_sql. Tables that do not
+        exist yet are created from the DataFrame, as df_to_sql would.
+
+        Args:
+            frames (dict): DataFrames to append, by table name.
+        """
+        for table_name, df in frames.items():
+            df.head(0).to_sql(table_name, self.engine, schema='public', if_exists='append', index=False)
+
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for table_name, df in frames.items():
+                staging = sql.Identifier(f"{table_name}_staging")
+                columns = sql.SQL(', ').join(sql.Identifier(column) for column in df.columns)
+                column_types = sql.SQL(', ').join(
+                    sql.SQL('{} {}').format(sql.Identifier(column), sql.SQL(self.STAGING_TYPES.get(df[column].dtype.kind, 'TEXT')))
+                    for column in df.columns
+                )
+                cursor.execute(sql.SQL("CREATE TEMP TABLE {} ({}) ON COMMIT DROP;").format(staging, column_types))
+
+                buffer = io.StringIO()
+                df.to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+                cursor.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv);").format(staging, columns), buffer)
+                cursor.execute(sql.SQL("INSERT INTO {}.{} ({}) SELECT {} FROM {};").format(
+                    sql.Identifier('public'), sql.Identifier(table_name), columns, columns, staging
+                ))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
     def get_schema(self, table_name):
         query = f"""SELECT 
                     column_name, 
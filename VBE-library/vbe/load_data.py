@@ -3,6 +3,8 @@ import pandas as pd
 import numpy as np
 from typing import List, Tuple, Set
 
+from choice_encoding import encode_choice_positions
+
 def featurize_df(df: pd.DataFrame) -> Tuple[np.ndarray, pd.DataFrame]:
     """
     Featurize the vote allocation DataFrame.
@@ -45,7 +47,7 @@ def load_data(path: str) -> Tuple[np.ndarray, pd.DataFrame]:
     data.drop(data.filter(regex='_y$').columns, axis=1, inplace=True)
 
     # Make a new column that represents the choice of the voter in integer (1, 2, 3, ...)
-    data['choice_position'] = data.apply(lambda row: row['choice'].index(row['choice']) + 1, axis=1)
+    data['choice_position'] = encode_choice_positions(data, proposal_df)
 
     # Make sure all voters are represented even if they don't vote on a proposal
     unique_voter_proposals = pd.MultiIndex.from_product([data['voter_address'].unique(), data['proposal_id'].unique()], names=['voter_address', 'proposal_id']).to_frame(index=False)
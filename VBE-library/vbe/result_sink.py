@@ -0,0 +1,93 @@
+"""
+This module contains the ResultSink class, which buffers result rows in memory and writes them in bulk,
+instead of opening one insert or CSV append per window and table.
+
+Example usage:
+    with ResultSink(db_connector, flush_rows=100000) as sink:
+        sink.append('vbe_dao', vbe_dao)
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+class ResultSink:
+    """
+    Buffers rows per table in columnar form and flushes them in bulk.
+
+    In database mode every buffered table is written in a single transaction with COPY, in CSV mode
+    each table is appended to its CSV file with one write. Rows are flushed once flush_rows rows are
+    buffered, and when the sink is closed, including when the run stops with an error.
+
+    Attributes:
+        db_connector (DatabaseHandler): Database to write to, or None to write CSV files.
+        output_dir (str): Directory of the CSV files, named after their table.
+        flush_rows (int): Number of buffered rows, over all tables, that triggers a flush.
+    """
+    def __init__(self, db_connector=None, output_dir='../data_output', flush_rows=100000):
+        self.db_connector = db_connector
+        self.output_dir = output_dir
+        self.flush_rows = flush_rows
+        self._columns = {}
+        self._buffers = {}
+        self._buffered_rows = 0
+
+    def append(self, table_name, df):
+        """
+        Buffers the rows of a DataFrame for a table. Every DataFrame of a table must have the same columns.
+
+        Args:
+            table_name (str): The table, or CSV file name, the rows belong to.
+            df (pandas.DataFrame): The rows to add.
+        """
+        if len(df) == 0:
+            return
+        if table_name not in self._buffers:
+            self._columns[table_name] = list(df.columns)
+            self._buffers[table_name] = {column: [] for column in df.columns}
+        buffer = self._buffers[table_name]
+        for column in self._columns[table_name]:
+            buffer[column].append(df[column].to_numpy())
+        self._buffered_rows += len(df)
+
+        if self._buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def _frame(self, table_name):
+        buffer = self._buffers[table_name]
+        return pd.DataFrame({column: np.concatenate(buffer[column]) for column in self._columns[table_name]})
+
+    def flush(self):
+        """Writes every buffered row and empties the buffers."""
+        frames = {
+            table_name: self._frame(table_name)
+            for table_name, buffer in self._buffers.items()
+            if buffer[self._columns[table_name][0]]
+        }
+        if not frames:
+            return
+
+        if self.db_connector is not None:
+            self.db_connector.copy_to_sql(frames)
+        else:
+            for table_name, df in frames.items():
+                path = os.path.join(self.output_dir, f'{table_name}.csv')
+                if not os.path.exists(path):
+                    df.to_csv(path, index=False)
+                else:
+                    df.to_csv(path, mode='a', header=False, index=False)
+        print(f"Saved {sum(len(df) for df in frames.values())} rows to {', '.join(frames)}")
+
+        self._buffers = {table_name: {column: [] for column in self._columns[table_name]} for table_name in self._buffers}
+        self._buffered_rows = 0
+
+    def close(self):
+        """Flushes the remaining rows."""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
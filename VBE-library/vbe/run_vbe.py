@@ -2,15 +2,25 @@
 This module performs clustering analysis on DAO proposal, voting data, and category clusters.
 """
 
+import argparse
 import ast
-import os
 import re
+import zlib
+from multiprocessing import Pool
 import pandas as pd
 import numpy as np
+from threadpoolctl import threadpool_limits
 from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import KMeans
 from sklearn.decomposition import PCA
 import database as db
+from choice_encoding import encode_choice_positions
+from result_sink import ResultSink
+from shared_arrays import SharedArrays, attach_arrays
+from vote_cache import VoteCache
+from vote_data import VoteDataLoader
+from vote_index import VoteIndex
+from vote_matrix import VoteMatrixBuilder, SlidingWindowMatrix
 
 class DataProcessor:
     @staticmethod
@@ -20,43 +30,18 @@ class DataProcessor:
         return dao_df.drop_duplicates()
     
     @staticmethod
-    def merge_data(window_df, voter_df):
+    def merge_data(window_df, window_matrix, start):
         if len(window_df['proposal_id'].unique()) != 10:
             print("Stopping, proposal window smaller than 10")
             return None
 
         proposal_id_list = window_df['proposal_id'].unique()
         # print("Proposal ID List: ", proposal_id_list)
-        mask = voter_df['proposal_id'].isin(proposal_id_list)
-        voter_df = voter_df[mask]
-        if len(voter_df) == 0:
+        # Voters are represented on every proposal in the window, skipped proposals are 0
+        training_df = window_matrix.build(start)
+        if training_df is None:
             print("Stopping, no votes for proposals in window", proposal_id_list)
             return None
-        # voter_df.to_csv('../data_output/sample_choice_DELETE.csv', index=False)
-        
-        # Make sure all voters are represented even if they don't vote on a proposal
-        unique_voter_proposals = pd.MultiIndex.from_product([voter_df['voter_address'].unique(), window_df['proposal_id'].unique()], names=['voter_address', 'proposal_id']).to_frame(index=False)
-        new_voter_df = pd.merge(unique_voter_proposals, voter_df, how='left', on=['voter_address', 'proposal_id'])
-        new_voter_df['choice_position'] = new_voter_df['choice_position'].fillna(0)
-        new_voter_df['voting_power'] = pd.to_numeric(new_voter_df['voting_power'], errors='coerce')
-        # new_voter_df.to_csv('../data_output/sample_choice_DELETE.csv', index=False)
-
-        grouped = new_voter_df.groupby('voter_address')['voting_power']
-
-        def fill_voting_power(series):
-            mean_value = series.mean(skipna=True)  
-            return series.fillna(mean_value)
-        
-        transformed_voting_power = grouped.transform(fill_voting_power)
-        new_voter_df['voting_power'] = transformed_voting_power
-        new_voter_df['voting_power'] = new_voter_df.groupby('voter_address')['voting_power'].transform(lambda x: x.fillna(x.mean()))
-
-        training_df = pd.pivot_table(new_voter_df, values=['choice_position'], index=['voter_address', 'voting_power'], columns=['proposal_id'], fill_value=0)
-        training_df.reset_index(inplace=True)
-        training_df.columns = training_df.columns.get_level_values(1)
-        # training_df.to_csv('../data_output/sample_choice_DELETE2.csv', index=False)
-
-        training_df.columns = ['voter_address', 'voting_power'] + list(training_df.columns[2:])
 
         return training_df
 
@@ -82,8 +67,9 @@ class Clusterer:
         return results_df, cluster_centroids, labels_count, model
 
     @staticmethod
-    def graph_pca(X_train, cluster_labels, scaled_data):
-        pca = PCA(n_components=2)
+    def graph_pca(X_train, cluster_labels, scaled_data, seed=None):
+        # The randomized PCA solver and the sampling are both seeded, so a window's output does not depend on the windows before it
+        pca = PCA(n_components=2, random_state=seed)
         X_pca = pca.fit_transform(scaled_data)
         loadings = pca.components_.T * np.sqrt(pca.explained_variance_)
 
@@ -93,7 +79,7 @@ class Clusterer:
             # print(f"PC1 Loading = {pc1_loading:.4f}, PC2 Loading = {pc2_loading:.4f}")
 
         sample_size = int(0.003 * X_pca.shape[0])
-        sampled_indices = np.random.choice(X_pca.shape[0], sample_size, replace=False)
+        sampled_indices = np.random.default_rng(seed).choice(X_pca.shape[0], sample_size, replace=False)
         X_pca_sampled = X_pca[sampled_indices]
 
         return X_pca_sampled, sampled_indices
@@ -101,18 +87,19 @@ class Clusterer:
 class DataSaver:
     def __init__(self, engine):
         self.engine = engine
-    def save_dao_vbe(self, dao, window_df, labels_count, window, dao_df, csv_flag):
+
+    @staticmethod
+    def dao_vbe_frame(dao, labels_count, window):
         # Calculate min entropy
         if len(labels_count) < 3:
             print(f"Skipping saving for this window: only {len(labels_count)} clusters found.")
-        else:
-            cluster_counts = [labels_count[i] for i in range(3)]
+            return None
+        cluster_counts = [labels_count[i] for i in range(3)]
         vbe = [max(labels_count)/sum(labels_count)]
-        # cluster_counts = [labels_count[i] for i in range(3)]
         cluster_pcts = [count/sum(labels_count) for count in cluster_counts]
         vbe_value = - np.log2(max(cluster_pcts)) if max(cluster_pcts) > 0 else 0
 
-        vbe_dao = pd.DataFrame({
+        return pd.DataFrame({
             'dao_id': [dao],
             'vbe_window': [window],
             'vbe': vbe,
@@ -124,17 +111,9 @@ class DataSaver:
             'cluster_1_pct': [cluster_pcts[1]],
             'cluster_2_pct': [cluster_pcts[2]],
         })
-        # Save to SQL, replace table if it's the first time, else append
-        if csv_flag != "Y":
-            vbe_dao.to_sql('vbe_dao', self.engine, schema='public', if_exists='append', index=False)
-        else:
-            if not os.path.exists('../data_output/vbe_dao.csv'):
-                vbe_dao.to_csv('../data_output/vbe_dao.csv', index=False)
-            else:
-                vbe_dao.to_csv('../data_output/vbe_dao.csv', mode='a', header=False, index=False)
-        # vbe_dao.to_sql('vbe_dao', self.engine, schema='public', if_exists='append', index=False)
-
-    def save_pca(self, X_train, cluster_labels, X_pca_sampled, window, dao_df, model, sampled_indices, csv_flag):
+
+    @staticmethod
+    def pca_frame(X_train, X_pca_sampled, window, dao_df, model, sampled_indices):
         PCA_X, PCA_Y = [], []
         label = model.fit_predict(X_train)[sampled_indices]
 
@@ -146,25 +125,16 @@ class DataSaver:
         dao_id = [dao_df['dao_id'].iloc[0]] * len(PCA_X)
         windows = [window] * len(PCA_X)
 
-        vbe_pca = pd.DataFrame({
+        return pd.DataFrame({
             'dao_id': dao_id,
             'vbe_window': windows,
             'pca_x': PCA_X,
             'pca_y': PCA_Y,
             'label': label,
         })
-        
-        # Save to SQL, replace table if it's the first time, else append
-        if csv_flag != "Y":
-            vbe_pca.to_sql('vbe_pca', self.engine, schema='public', if_exists='append', index=False)
-        else:
-            if not os.path.exists('../data_output/vbe_pca.csv'):
-                vbe_pca.to_csv('../data_output/vbe_pca.csv', index=False)
-            else:
-                vbe_pca.to_csv('../data_output/vbe_pca.csv', mode='a', header=False, index=False)
-        # vbe_pca.to_sql('vbe_pca', self.engine, schema='public', if_exists='append', index=False)
-
-    def save_cluster_weights(self, cluster_centroids, window_df, window, dao, csv_flag):
+
+    @staticmethod
+    def cluster_weights_frame(cluster_centroids, window_df, window, dao):
         data = []
         for cluster_index, cluster_data in enumerate(cluster_centroids):
             if len(window_df) == 10:
@@ -178,15 +148,43 @@ class DataSaver:
                         'weights': cluster_data[proposal_index]
                     })
 
-        cluster_explain = pd.DataFrame(data)
-        if csv_flag != "Y":
-            cluster_explain.to_sql('cluster_weight', self.engine, schema='public', if_exists='append', index=False)
-        else:
-            if not os.path.exists('../data_output/cluster_weight.csv'):
-                cluster_explain.to_csv('../data_output/cluster_weight.csv', index=False)
-            else:
-                cluster_explain.to_csv('../data_output/cluster_weight.csv', mode='a', header=False, index=False)
-        # cluster_explain.to_sql('cluster_weight', self.engine, schema='public', if_exists='append', index=False)
+        return pd.DataFrame(data)
+
+def window_seed(dao, window):
+    """Seed for the random sampling of a window, the same on every run and in every worker process."""
+    return zlib.crc32(f"{dao}:{window}".encode())
+
+# Encoded votes of a pool worker, mapped from the shared memory of the parent process
+_worker_builder = None
+
+def init_worker(array_specs, proposal_ids, dao_ids, voter_addresses):
+    """Maps the encoded votes shared by the parent process. Each worker clusters on a single thread."""
+    global _worker_builder
+    threadpool_limits(1)
+    arrays = attach_arrays(array_specs)
+    vote_index = VoteIndex.from_arrays(proposal_ids, arrays['offsets'], dao_ids, arrays['dao_offsets'])
+    _worker_builder = VoteMatrixBuilder.from_arrays(
+        vote_index, arrays['voter_codes'], voter_addresses, arrays['choice_positions'], arrays['voting_power']
+    )
+
+def process_window_chunk(task, matrix_builder=None):
+    """
+    Processes a chunk of windows created by MainProcessor.window_tasks, in this process or in a pool worker.
+
+    Returns:
+        list: The result of MainProcessor.process_window for each window of the chunk, in order.
+    """
+    dao, chunk_df, windows = task
+    if matrix_builder is None:
+        matrix_builder = _worker_builder
+    # Windows slide one proposal at a time, so each one reuses the previous window's matrix
+    window_matrix = SlidingWindowMatrix(matrix_builder, chunk_df['proposal_id'], 10)
+
+    results = []
+    for start, window in windows:
+        print("Processing window #: ", window)
+        results.append(MainProcessor.process_window(dao, chunk_df, window_matrix, start, window))
+    return results
 
 class MainProcessor:
     def __init__(self):
@@ -195,70 +193,142 @@ class MainProcessor:
         self.clusterer = Clusterer()
         self.data_saver = DataSaver(self.db_connector.engine)
 
-    def process_proposals_in_windows(self, dao, dao_df, voter_df, csv_flag):
+    @staticmethod
+    def window_tasks(dao, dao_df, n_chunks=1):
+        """
+        Splits the windows of a DAO into contiguous chunks that can be processed independently.
+
+        Args:
+            dao (str): The DAO ID.
+            dao_df (pandas.DataFrame): Proposals of the DAO.
+            n_chunks (int): Number of chunks to split the windows into.
+
+        Returns:
+            list: (dao, chunk_df, windows) tasks, where chunk_df holds the proposals covered by the chunk and
+            windows holds the (start in chunk_df, window number) of each of its windows, in order.
+        """
         dao_df_sorted = dao_df.sort_values(by='end_date', ascending=False)
         # Remove if status "active", "pending", "queued"
         states_to_exclude = ['active', 'queued', 'pending']
         dao_df_sorted = dao_df_sorted[~dao_df_sorted['state'].isin(states_to_exclude)]
         total_rows = len(dao_df_sorted)
         end = total_rows - 9
-        windows = 0
-
-        for start in range(end):
-            window = end - start
-            if window == 121 and dao == 'gnosis.eth':
-                continue
-            print("Processing window #: ", window)
-
-            window_df = dao_df_sorted.iloc[start:start + 10]
-            training_df = self.data_processor.merge_data(window_df, voter_df)
-            if training_df is None:
-                continue
-            X_train = training_df[training_df.columns[2:]]
-            scaler = StandardScaler()
-            scaled_data = scaler.fit_transform(X_train)
 
-            # print("Clustering data")
-            results_df, cluster_centroids, cluster_labels, model = self.clusterer.cluster_data(training_df, X_train, scaled_data)
-            if results_df is None:
-                continue
-            X_pca_sampled, sampled_indices = self.clusterer.graph_pca(X_train, cluster_labels, scaled_data)
+        tasks = []
+        chunk_size = max(-(-end // n_chunks), 1)
+        for chunk_start in range(0, end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end)
+            windows = []
+            for start in range(chunk_start, chunk_end):
+                window = end - start
+                if window == 121 and dao == 'gnosis.eth':
+                    continue
+                windows.append((start - chunk_start, window))
+            tasks.append((dao, dao_df_sorted.iloc[chunk_start:chunk_end + 9], windows))
+        return tasks
 
-            self.data_saver.save_dao_vbe(dao, window_df, cluster_labels, window, dao_df, csv_flag)
-            self.data_saver.save_pca(X_train, cluster_labels, X_pca_sampled, window, dao_df, model, sampled_indices, csv_flag)
-            self.data_saver.save_cluster_weights(cluster_centroids, window_df, window, dao, csv_flag)
+    @staticmethod
+    def process_window(dao, dao_df, window_matrix, start, window):
+        """
+        Clusters a single window of proposals.
+
+        Returns:
+            Tuple[pandas.DataFrame, pandas.DataFrame, pandas.DataFrame]: The vbe_dao, vbe_pca and cluster_weight
+            rows of the window, or None if the window is skipped.
+        """
+        window_df = dao_df.iloc[start:start + 10]
+        training_df = DataProcessor.merge_data(window_df, window_matrix, start)
+        if training_df is None:
+            return None
+        X_train = training_df[training_df.columns[2:]]
+        scaler = StandardScaler()
+        scaled_data = scaler.fit_transform(X_train)
 
-            windows += 1
+        # print("Clustering data")
+        results_df, cluster_centroids, cluster_labels, model = Clusterer.cluster_data(training_df, X_train, scaled_data)
+        if results_df is None:
+            return None
+        X_pca_sampled, sampled_indices = Clusterer.graph_pca(X_train, cluster_labels, scaled_data, window_seed(dao, window))
 
-        print(f"Total windows processed: {windows}")
+        return (
+            DataSaver.dao_vbe_frame(dao, cluster_labels, window),
+            DataSaver.pca_frame(X_train, X_pca_sampled, window, dao_df, model, sampled_indices),
+            DataSaver.cluster_weights_frame(cluster_centroids, window_df, window, dao),
+        )
 
-    def run(self):
+    def save_window_results(self, tasks, results, sink):
+        """Saves the results of each task to the sink in task order, this process is the only writer."""
+        windows, current_dao = 0, None
+        for (dao, _, _), chunk_results in zip(tasks, results):
+            if dao != current_dao and current_dao is not None:
+                print(f"Total windows processed: {windows}")
+                windows = 0
+            current_dao = dao
+            for frames in chunk_results:
+                if frames is None:
+                    continue
+                for frame, table_name in zip(frames, ['vbe_dao', 'vbe_pca', 'cluster_weight']):
+                    if frame is not None:
+                        sink.append(table_name, frame)
+                windows += 1
+        if current_dao is not None:
+            print(f"Total windows processed: {windows}")
+
+    def process_window_tasks(self, tasks, matrix_builder, csv_flag, workers=1, flush_rows=100000):
+        """
+        Processes window tasks in order, serially or on a pool of worker processes.
+
+        Workers map the encoded votes from shared memory instead of receiving them with every task.
+        Results are buffered and written every flush_rows rows, and whatever is buffered is written
+        if processing stops early.
+        """
+        with ResultSink(self.db_connector if csv_flag != "Y" else None, flush_rows=flush_rows) as sink:
+            if workers <= 1:
+                results = (process_window_chunk(task, matrix_builder) for task in tasks)
+                self.save_window_results(tasks, results, sink)
+                return
+
+            vote_index = matrix_builder.vote_index
+            shared_votes = SharedArrays({
+                'offsets': vote_index.offsets,
+                'dao_offsets': vote_index.dao_offsets,
+                'voter_codes': matrix_builder.voter_codes,
+                'choice_positions': matrix_builder.choice_positions,
+                'voting_power': matrix_builder.voting_power,
+            })
+            with shared_votes:
+                initargs = (shared_votes.specs, vote_index.proposal_ids, vote_index.dao_ids, matrix_builder.voter_addresses)
+                with Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+                    self.save_window_results(tasks, pool.imap(process_window_chunk, tasks), sink)
+
+    def run(self, workers=1, flush_rows=100000, dao_ids=None, use_cache=True):
         use_csv = input("Do you want to use CSVs for your data source? (Not recommended for large data processing) (Y/N):").strip().upper()
-    
-        if use_csv != "Y":
-            proposal_df = self.db_connector.db_to_df("proposals")
-            voter_df = self.db_connector.db_to_df("votes")
-        else:
-            proposal_df = pd.read_csv('../../VBE-data/data_output/proposals.csv')
-            voter_df = pd.read_csv('../../VBE-data/data_output/votes.csv', low_memory=False)
+
+        # Only the columns used for clustering are loaded, of the selected DAOs if any, from the local cache first
+        db_connector = self.db_connector if use_csv != "Y" else None
+        data_dir = '../../VBE-data/data_output'
+        cache = VoteCache(db_connector, data_dir) if use_cache else None
+        loader = VoteDataLoader(db_connector, data_dir, cache)
+        proposal_df = loader.load_table('clustering', 'proposals', dao_ids=dao_ids)
+        voter_df = loader.load_table('clustering', 'votes', dao_ids=dao_ids)
 
         # print("Unique values for choices", proposal_df['choices'].unique())
         voter_df['proposal_id'] = voter_df['proposal_id'].astype(str)
         proposal_df['proposal_id'] = proposal_df['proposal_id'].astype(str)
 
-        # Voter DF add choices manually - for each proposal in voter df, get all unique values for "choice" in a list
-        choices_per_proposal = voter_df.groupby('proposal_id')['choice'].unique().reset_index()
-        choices_per_proposal.rename(columns={'choice': 'unique_choices'}, inplace=True)
-        # Merge the result back into the original voter_df
-        voter_df = voter_df.merge(choices_per_proposal, on='proposal_id', how='left')
-
-        voter_df['choice_position'] = voter_df.apply(
-            lambda row: row['unique_choices'].tolist().index(row['choice']) + 1, axis=1
-        )
+        # Position of each vote's choice among its proposal's declared choices
+        voter_df['choice_position'] = encode_choice_positions(voter_df, proposal_df)
+        # Group the votes by DAO and proposal once, windows are then sliced out of the index
+        vote_index = VoteIndex(voter_df, proposal_df)
+        voter_df = vote_index.votes
+        # Encode voters once, windows are then assembled from the codes
+        matrix_builder = VoteMatrixBuilder(vote_index)
         
         # Check to see which dao_id are already in the vbe_dao table. If in table, skip
         dao_list = proposal_df['dao_id'].unique()
         
+        # Windows are split into independent tasks, a single DAO's windows are spread over every worker
+        tasks = []
         for dao in dao_list:
             # if dao in vbe_dao_existing['dao_id'].values:
             #     continue
@@ -268,7 +338,9 @@ class MainProcessor:
             # if dao_id contains string ".eth", continue
             if pd.isna(dao):
                 continue
-            self.process_proposals_in_windows(dao, prop_df, voter_df, use_csv)
+            tasks.extend(self.window_tasks(dao, prop_df, workers))
+
+        self.process_window_tasks(tasks, matrix_builder, use_csv, workers, flush_rows)
     
     def save_to_db(self):
         cluster_explain = pd.read_csv('data_output/cluster_weight.csv')
@@ -288,10 +360,19 @@ class MainProcessor:
         # dao_df = self.db_connector.db_to_df("dao_input")
         # print(dao_df['dao_id'].unique())
 
+def get_args():
+    parser = argparse.ArgumentParser(description='Calculate VBE for every window of every DAO')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes clustering windows')
+    parser.add_argument('--flush_rows', type=int, default=100000, help='Number of result rows buffered before they are written')
+    parser.add_argument('--dao_ids', nargs='+', default=None, help='Only calculate VBE for these DAOs')
+    parser.add_argument('--no_cache', action='store_true', help='Load proposals and votes from the source instead of the local Parquet cache')
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    args = get_args()
     pd.set_option('display.max_columns', None)
     processor = MainProcessor()
-    processor.run()
+    processor.run(args.workers, args.flush_rows, args.dao_ids, not args.no_cache)
     # processor.auxilliary()
     # processor.save_to_db()
     print("All VBE Completed, CSVs updated")    
@@ -0,0 +1,73 @@
+"""
+This module hands NumPy arrays to worker processes through shared memory, so large vote arrays are
+copied once when the pool starts instead of being pickled with every task.
+
+Example usage:
+    with SharedArrays({'voting_power': voting_power}) as shared:
+        pool = Pool(workers, initializer=init_worker, initargs=(shared.specs,))
+        ...
+
+    # In the worker
+    arrays = attach_arrays(specs)
+"""
+
+import numpy as np
+from multiprocessing import shared_memory
+
+# Shared memory blocks mapped by this process, kept open for as long as the process uses the arrays
+_attached = []
+
+
+class SharedArrays:
+    """
+    Copies NumPy arrays into shared memory blocks owned by this process.
+
+    Attributes:
+        specs (dict): Block name, shape and dtype of each array, small enough to pass to worker processes.
+    """
+    def __init__(self, arrays):
+        """
+        Args:
+            arrays (dict): NumPy arrays to share, by name.
+        """
+        self._blocks = []
+        self.specs = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self._blocks.append(block)
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        """Releases the shared memory blocks, once every worker is done with them."""
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach_arrays(specs):
+    """
+    Maps arrays shared by SharedArrays in another process, without copying them.
+
+    Args:
+        specs (dict): SharedArrays.specs of the owning process.
+
+    Returns:
+        dict: Read-only NumPy arrays by name.
+    """
+    arrays = {}
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _attached.append(block)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        arrays[name] = array
+    return arrays
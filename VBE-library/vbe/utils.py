@@ -6,6 +6,7 @@ import pandas as pd
 from sklearn.cluster import DBSCAN, AgglomerativeClustering, KMeans, SpectralClustering
 from sklearn.metrics import calinski_harabasz_score, davies_bouldin_score, silhouette_score
 from scipy.spatial.distance import cdist
+from scipy import stats
 
 from sklearn.mixture import GaussianMixture
 from sklearn.model_selection import train_test_split
@@ -13,6 +14,7 @@ import csv
 import random
 import datetime
 import uuid
+from collections import namedtuple
 from typing import List, Dict
 
 def save_clusters(data, labels, orig_data, filename="../data_output/cluster_data.csv"):
@@ -90,8 +92,106 @@ def save_to_csv(data, filename="../data_output/parameters.csv"):
 
     print(f"Data has been {'appended to' if file_exists else 'written to'} {filename}.\n")
 
-def return_optimal_kmeans(scaled_data, method, method_distance):
+# Data with more rows than this is scored on samples by the 'auto' silhouette scoring, the exact score is O(n²)
+EXACT_SILHOUETTE_MAX_ROWS = 10000
+
+SilhouetteEstimate = namedtuple('SilhouetteEstimate', ['score', 'ci_low', 'ci_high'])
+
+def exact_silhouette(scaled_data, labels, metric):
+    return silhouette_score(scaled_data, labels, metric=metric)
+
+def stratified_sample(labels, sample_size, rng):
+    """
+    Returns the row indices of a sample of sample_size rows with each cluster in proportion to its size.
+
+    Every cluster keeps at least two rows, or all of them when smaller, so each sampled row has a cluster to
+    compare itself with.
+    """
+    clusters, codes, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    allocation = np.minimum(counts, np.maximum(np.round(sample_size * counts / len(labels)).astype(np.int64), 2))
+    rows_by_cluster = np.split(np.argsort(codes, kind='stable'), np.cumsum(counts)[:-1])
+    return np.concatenate([rng.choice(rows, size=size, replace=False) for rows, size in zip(rows_by_cluster, allocation)])
+
+def sampled_silhouette(scaled_data, labels, metric, sample_size=5000, n_repeats=5, confidence=0.95, random_state=42):
+    """
+    Estimates the silhouette score as the mean of the exact scores of repeated stratified samples.
+
+    Each sample takes about sample_size rows, so a score costs O(n_repeats * sample_size²) instead of O(n²).
+
+    Args:
+        scaled_data (numpy.ndarray): The clustered rows.
+        labels (numpy.ndarray): Cluster of each row.
+        metric (str): Distance metric, as for sklearn's silhouette_score.
+        sample_size (int, optional): Rows per sample. Data no larger is scored exactly.
+        n_repeats (int, optional): Number of samples.
+        confidence (float, optional): Confidence level of the interval.
+        random_state (int, optional): Seed of the samples.
+
+    Returns:
+        SilhouetteEstimate: The estimate and the bounds of its Student t confidence interval.
+    """
+    labels = np.asarray(labels)
+    if len(labels) <= sample_size:
+        score = silhouette_score(scaled_data, labels, metric=metric)
+        return SilhouetteEstimate(score, score, score)
+
+    rng = np.random.default_rng(random_state)
+    scores = []
+    for _ in range(n_repeats):
+        rows = stratified_sample(labels, sample_size, rng)
+        scores.append(silhouette_score(scaled_data[rows], labels[rows], metric=metric))
+    score = np.mean(scores)
+    half_width = stats.t.ppf((1 + confidence) / 2, n_repeats - 1) * np.std(scores, ddof=1) / np.sqrt(n_repeats) if n_repeats > 1 else np.nan
+    return SilhouetteEstimate(score, score - half_width, score + half_width)
+
+def simplified_silhouette(scaled_data, labels, metric):
+    """
+    Computes the simplified silhouette score, which measures each row against the cluster centroids instead of
+    every other row, in O(n * k).
+
+    a is the distance of a row to its own centroid and b to the nearest other centroid. Rows of single row clusters
+    score 0, as in the silhouette score.
+    """
+    clusters, codes, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    if not 1 < len(clusters) < len(labels):
+        raise ValueError(f"Number of labels is {len(clusters)}. Valid values are 2 to n_samples - 1 (inclusive)")
+    centroids = np.stack([scaled_data[codes == code].mean(axis=0) for code in range(len(clusters))])
+    distances = cdist(scaled_data, centroids, metric)
+    rows = np.arange(len(codes))
+    own = distances[rows, codes]
+    distances[rows, codes] = np.inf
+    nearest = distances.min(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.nan_to_num((nearest - own) / np.maximum(own, nearest))
+    scores[counts[codes] == 1] = 0
+    return np.mean(scores)
+
+SILHOUETTE_SCORERS = {
+    'exact': exact_silhouette,
+    'sampled': lambda scaled_data, labels, metric: sampled_silhouette(scaled_data, labels, metric).score,
+    'simplified': simplified_silhouette,
+}
+
+def get_silhouette_scorer(scoring, n_rows):
+    """
+    Returns the function scoring a clustering of n_rows rows as scorer(scaled_data, labels, metric).
+
+    Args:
+        scoring (str or callable): 'exact', 'sampled', 'simplified', 'auto', which is exact up to
+            EXACT_SILHOUETTE_MAX_ROWS rows and sampled beyond, or a function with the signature of the scorer.
+        n_rows (int): Number of rows clustered.
+    """
+    if callable(scoring):
+        return scoring
+    if scoring == 'auto':
+        scoring = 'exact' if n_rows <= EXACT_SILHOUETTE_MAX_ROWS else 'sampled'
+    if scoring not in SILHOUETTE_SCORERS:
+        raise ValueError(f"Unknown silhouette scoring {scoring}, expected one of {['auto'] + list(SILHOUETTE_SCORERS)}")
+    return SILHOUETTE_SCORERS[scoring]
+
+def return_optimal_kmeans(scaled_data, method, method_distance, scoring='auto'):
     k_values = range(2, 11)
+    silhouette = get_silhouette_scorer(scoring, len(scaled_data))
     if method == 'Gap Statistic':
         gap_stats = compute_gap_statistic("kmeans", scaled_data, method_distance)
         return k_values[np.argmax(gap_stats)]
@@ -102,7 +202,7 @@ def return_optimal_kmeans(scaled_data, method, method_distance):
         for k in k_values:
             kmeans = KMeans(n_clusters=k, n_init="auto", random_state=42)
             labels = kmeans.fit_predict(scaled_data)
-            silhouette_scores.append(silhouette_score(scaled_data, labels, metric=method_distance))
+            silhouette_scores.append(silhouette(scaled_data, labels, method_distance))
             db_scores.append(davies_bouldin_score(scaled_data, labels))
             ch_scores.append(calinski_harabasz_score(scaled_data, labels))
     
@@ -155,11 +255,12 @@ def compute_gap_statistic(model, data, distance, n_references=5):
     
     return gap_stats
 
-def return_optimal_hierarchical(scaled_data, method, distance, method_distance, range=range(2,11)):
+def return_optimal_hierarchical(scaled_data, method, distance, method_distance, range=range(2,11), scoring='auto'):
     '''
     return optimal parameters for hierarchical clustering, including:
     number of clusters, linkage method, and distance metric
     '''
+    silhouette = get_silhouette_scorer(scoring, len(scaled_data))
     linkage_methods = ['ward', 'complete', 'average', 'single']
     if method == 'Gap Statistic':
         # Compute Gap Statistic
@@ -176,7 +277,7 @@ def return_optimal_hierarchical(scaled_data, method, distance, method_distance,
         for n in range:
             hc = AgglomerativeClustering(n_clusters=n, metric='cosine' if linkage != 'ward' else distance, linkage=linkage)
             labels = hc.fit_predict(scaled_data)
-            silhouette_scores[(n, linkage)] = silhouette_score(scaled_data, labels, metric=method_distance)
+            silhouette_scores[(n, linkage)] = silhouette(scaled_data, labels, method_distance)
             db_scores[(n, linkage)] = davies_bouldin_score(scaled_data, labels)
             ch_scores[(n, linkage)] = calinski_harabasz_score(scaled_data, labels)
 
@@ -190,8 +291,9 @@ def return_optimal_hierarchical(scaled_data, method, distance, method_distance,
 
     return optimal_params[0], optimal_params[1]
 
-def return_optimal_gmm(scaled_data, method, method_distance, range=range(2,11)):
+def return_optimal_gmm(scaled_data, method, method_distance, range=range(2,11), scoring='auto'):
     covariance_types = ['full', 'tied', 'diag', 'spherical']
+    silhouette_scorer = get_silhouette_scorer(scoring, len(scaled_data))
 
     results = {}
     X_train, X_test = train_test_split(scaled_data, test_size=0.2, random_state=42)
@@ -205,7 +307,7 @@ def return_optimal_gmm(scaled_data, method, method_distance, range=range(2,11)):
             aic = gmm.aic(X_test)
             log_likelihood = gmm.score(X_test)
             labels = gmm.predict(scaled_data)
-            silhouette = silhouette_score(scaled_data, labels, metric=method_distance)
+            silhouette = silhouette_scorer(scaled_data, labels, method_distance)
             
             results[(cov_type, n_components)] = (bic, aic, log_likelihood, silhouette)
     
@@ -225,8 +327,9 @@ def return_optimal_gmm(scaled_data, method, method_distance, range=range(2,11)):
 
     return best_n_components, best_cov_type
     
-def return_optimal_spectral(scaled_data, method, distance, method_distance, range=range(2,11)):
+def return_optimal_spectral(scaled_data, method, distance, method_distance, range=range(2,11), scoring='auto'):
     affinities = ['rbf', 'nearest_neighbors', 'cosine']
+    silhouette_scorer = get_silhouette_scorer(scoring, len(scaled_data))
 
     results = {}
 
@@ -235,7 +338,7 @@ def return_optimal_spectral(scaled_data, method, distance, method_distance, rang
             spectral = SpectralClustering(n_clusters=n_clusters, affinity='nearest_neighbors', random_state=42, n_neighbors=10)
             labels = spectral.fit_predict(scaled_data)
             
-            silhouette = silhouette_score(scaled_data, labels, metric=method_distance)
+            silhouette = silhouette_scorer(scaled_data, labels, method_distance)
             calinski = calinski_harabasz_score(scaled_data, labels)
             davies = davies_bouldin_score(scaled_data, labels)
             
@@ -255,8 +358,9 @@ def return_optimal_spectral(scaled_data, method, distance, method_distance, rang
 
     return n_clusters, affinity
 
-def return_optimal_dbscan(scaled_data, method, distance, method_distance, range=range(2,11)):
+def return_optimal_dbscan(scaled_data, method, distance, method_distance, range=range(2,11), scoring='auto'):
     best_score = -1
+    silhouette = get_silhouette_scorer(scoring, len(scaled_data))
     best_params = None
     
     for eps in np.logspace(-2, 2, 50):
@@ -266,7 +370,7 @@ def return_optimal_dbscan(scaled_data, method, distance, method_distance, range=
             n_clusters = len(set(labels)) - (1 if -1 in labels else 0)
 
             if n_clusters > 1:
-                score = silhouette_score(scaled_data, labels, metric=method_distance)
+                score = silhouette(scaled_data, labels, method_distance)
                 if score > best_score:
                     best_score = score
                     best_params = (eps, min_samples)
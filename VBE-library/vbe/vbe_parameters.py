@@ -23,6 +23,7 @@ def get_args():
     parser.add_argument('--dist_model', type=str, default='Euclidean', help='Distance method for clustering')
     parser.add_argument('--optimization_method', type=str, default='Silhouette Score (default)', help='Method to find optimal cluster')
     parser.add_argument('--dist_method', type=str, default='Euclidean', help='Distance method for parameter optimization')
+    parser.add_argument('--silhouette', type=str, default='auto', choices=['auto', 'exact', 'sampled', 'simplified'], help='Silhouette scoring for parameter optimization, auto samples large data')
     parser.add_argument('--optimize', type=str, default='Y', help='Flag to use optimal number of clusters calculated')
     parser.add_argument('--entropy', type=str, default='Min Entropy (default)', help='Entropy function for VBE calculation')
     
@@ -36,24 +37,24 @@ def get_args():
     args = parser.parse_args()
     return args
 
-def get_optimal_params(scaled_data, model, method, method_distance, distance=None):
+def get_optimal_params(scaled_data, model, method, method_distance, distance=None, scoring='auto'):
     if distance:
         distance = (distance.split(" ")[0]).lower()
     method_distance = (method_distance.split(" ")[0]).lower()
     if model == "K-means (default)":
-        optimal_k = return_optimal_kmeans(scaled_data, method, method_distance)
+        optimal_k = return_optimal_kmeans(scaled_data, method, method_distance, scoring=scoring)
         return optimal_k
     elif model == "Hierarchical":
-        n, linkage = return_optimal_hierarchical(scaled_data, method, distance, method_distance)
+        n, linkage = return_optimal_hierarchical(scaled_data, method, distance, method_distance, scoring=scoring)
         return n, linkage
     elif model == "GMM":
-        n_components, cov_type = return_optimal_gmm(scaled_data, method, method_distance)
+        n_components, cov_type = return_optimal_gmm(scaled_data, method, method_distance, scoring=scoring)
         return n_components, cov_type
     elif model == "Spectral Clustering":
-        num_clusters, affinity = return_optimal_spectral(scaled_data, method, distance, method_distance)
+        num_clusters, affinity = return_optimal_spectral(scaled_data, method, distance, method_distance, scoring=scoring)
         return num_clusters, affinity
     elif model == "DBSCAN":
-        eps, min_samples = return_optimal_dbscan(scaled_data, method, distance, method_distance)
+        eps, min_samples = return_optimal_dbscan(scaled_data, method, distance, method_distance, scoring=scoring)
         return eps, min_samples
 
 def scale_data(scaler, feature_vectors):
@@ -84,7 +85,7 @@ def impute_data(data, imputation_method):
     
     return X
 
-def cluster_votes(scaled_data, cluster_method, optimization_method, method_distance, distance, manual_k=None):
+def cluster_votes(scaled_data, cluster_method, optimization_method, method_distance, distance, manual_k=None, scoring='auto'):
     if distance:
         distance = (distance.split(" ")[0]).lower()
     method_distance = (method_distance.split(" ")[0]).lower()
@@ -92,30 +93,30 @@ def cluster_votes(scaled_data, cluster_method, optimization_method, method_dista
         if manual_k:
             clusters = KMeans(n_clusters=manual_k, random_state=42, n_init="auto")
         else:
-            k = get_optimal_params(scaled_data, cluster_method, optimization_method, method_distance, distance)
+            k = get_optimal_params(scaled_data, cluster_method, optimization_method, method_distance, distance, scoring)
             clusters = KMeans(n_clusters=k, random_state=42, n_init="auto")
         clusters.fit(scaled_data)
         return clusters.labels_
 
     elif cluster_method == "DBSCAN":        
-        eps, min_samples = get_optimal_params(scaled_data, cluster_method, optimization_method, method_distance, distance)
+        eps, min_samples = get_optimal_params(scaled_data, cluster_method, optimization_method, method_distance, distance, scoring)
         dbscan = DBSCAN(eps=eps, min_samples=min_samples, metric=distance)
         cluster_labels = dbscan.fit_predict(scaled_data)                
         
     elif cluster_method == "Hierarchical":
-        n, linkage = get_optimal_params(scaled_data, cluster_method, optimization_method, method_distance, distance)
+        n, linkage = get_optimal_params(scaled_data, cluster_method, optimization_method, method_distance, distance, scoring)
         clustering = AgglomerativeClustering(n_clusters=n, metric=distance, linkage=linkage)
         clustering.fit(scaled_data)
         return clustering.labels_
 
     elif cluster_method == "GMM":
-        best_n_components, best_cov_type = get_optimal_params(scaled_data, cluster_method, optimization_method, method_distance, distance)
+        best_n_components, best_cov_type = get_optimal_params(scaled_data, cluster_method, optimization_method, method_distance, distance, scoring)
         best_gmm = GaussianMixture(n_components=best_n_components, covariance_type=best_cov_type, random_state=42)
         best_gmm.fit(scaled_data)
         cluster_labels = best_gmm.predict(scaled_data)
 
     elif cluster_method == "Spectral Clustering":
-        n_clusters, affinity = get_optimal_params(scaled_data, cluster_method, optimization_method, method_distance, distance)
+        n_clusters, affinity = get_optimal_params(scaled_data, cluster_method, optimization_method, method_distance, distance, scoring)
         spectral = SpectralClustering(n_clusters=n_clusters, affinity=affinity, random_state=42)
         cluster_labels = spectral.fit_predict(scaled_data)
 
@@ -275,7 +276,7 @@ def main():
             scaled_data = scale_data(clustering['scaler'], imputed_feature_vectors)
 
             if not num_clusters:
-                num_clusters, _ = get_optimal_params(scaled_data, clustering['clustering_method'], clustering2['optimization_method'], clustering2['method_distance'], clustering2.get('distance', None))
+                num_clusters, _ = get_optimal_params(scaled_data, clustering['clustering_method'], clustering2['optimization_method'], clustering2['method_distance'], clustering2.get('distance', None), args.silhouette)
 
             print(f"Optimal number of clusters: {num_clusters}")
 
@@ -306,7 +307,7 @@ def main():
         
     imputed_feature_vectors = impute_data(feature_vectors, clustering['imputer'])
     scaled_data = scale_data(scaler, imputed_feature_vectors)
-    cluster_labels = cluster_votes(scaled_data, model, method, method_distance, distance, num_clusters_choice)
+    cluster_labels = cluster_votes(scaled_data, model, method, method_distance, distance, num_clusters_choice, args.silhouette)
     percentages = cluster_percentage(cluster_labels)
     vbe = calculate_vbe(percentages, entropy_fn)
 
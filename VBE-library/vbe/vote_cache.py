@@ -0,0 +1,288 @@
+"""
+This module keeps a local Parquet copy of the proposals and votes tables, partitioned by DAO, so runs read
+them from disk instead of downloading or parsing them again.
+
+The copy is refreshed incrementally. Rows with an id above the cached watermark are fetched from the database
+in id ranges and written as new files in each DAO's partition. When rows at or below the watermark were deleted from
+the database, the table is cached again. A CSV source is cached again when the file changes. Only the columns the loaders use are cached, and string columns are dictionary encoded.
+
+Example usage:
+    cache = VoteCache(db_connector)
+    loader = VoteDataLoader(db_connector, cache=cache)
+    voter_df = loader.load_table('clustering', 'votes', dao_ids=['aave.eth'])
+"""
+
+import json
+import os
+import shutil
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from psycopg2 import errors, sql
+from urllib.parse import quote
+
+from vote_data import COLUMN_SETS, select_list
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_cache')
+# Partition directory of rows without a DAO, read back as a missing dao_id
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+class VoteCache:
+    """
+    Parquet copy of the proposals and votes tables, one directory per DAO.
+
+    Attributes:
+        db_connector (DatabaseHandler): Database the tables are copied from, or None to copy the CSVs.
+        data_dir (str): Directory of the CSV files, named after their table.
+        cache_dir (str): Directory of the Parquet files.
+        refresh_rows (int): Number of rows fetched and written at a time while refreshing.
+    """
+    TABLES = ('proposals', 'votes')
+
+    def __init__(self, db_connector=None, data_dir='../data_output', cache_dir=DEFAULT_CACHE_DIR, refresh_rows=1000000):
+        self.db_connector = db_connector
+        self.data_dir = data_dir
+        self.cache_dir = cache_dir
+        self.refresh_rows = refresh_rows
+        self._refreshed = set()
+
+    @staticmethod
+    def columns(table):
+        """
+        Returns the cached columns of a table, every column a consumer loads, without the dao_id partition column.
+
+        Returns:
+            dict: dtype of each column, by column name.
+        """
+        columns = {}
+        for column_sets in COLUMN_SETS.values():
+            columns.update(column_sets.get(table, {}))
+        columns.pop('dao_id', None)
+        return columns
+
+    def _schema(self, table):
+        fields = [('id', pa.int64())]
+        fields += [(column, pa.string() if dtype is str else pa.from_numpy_dtype(dtype)) for column, dtype in self.columns(table).items()]
+        return pa.schema(fields)
+
+    def _table_dir(self, table):
+        return os.path.join(self.cache_dir, table)
+
+    def _load_state(self, table):
+        path = os.path.join(self._table_dir(table), '_state.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _save_state(self, table, state):
+        path = os.path.join(self._table_dir(table), '_state.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    def _reset(self, table, state):
+        """Removes a table's cached files and starts again from an empty copy."""
+        shutil.rmtree(self._table_dir(table), ignore_errors=True)
+        os.makedirs(self._table_dir(table))
+        self._save_state(table, state)
+        return state
+
+    def refresh(self, table):
+        """
+        Brings the cached copy of a table up to date with its source.
+
+        From the database, rows with an id above the watermark are appended, rows are expected to be
+        inserted but not updated. A CSV source is cached again whenever its size or modification time changes.
+
+        Args:
+            table (str): 'proposals' or 'votes'.
+        """
+        if table not in self.TABLES:
+            raise ValueError(f"Only {', '.join(self.TABLES)} are cached, not {table}")
+        columns = list(self.columns(table))
+        state = self._load_state(table)
+
+        if self.db_connector is not None:
+            if state is None or state.get('source') != 'database' or state.get('columns') != columns:
+                state = self._reset(table, {'source': 'database', 'columns': columns, 'max_id': 0})
+            self._refresh_from_database(table, state)
+        else:
+            path = os.path.join(self.data_dir, f'{table}.csv')
+            signature = None
+            if os.path.exists(path):
+                # Votes take their DAO from the proposals CSV, so they are cached again when either file changes
+                paths = [path, os.path.join(self.data_dir, 'proposals.csv')] if table == 'votes' else [path]
+                signature = [[os.stat(p).st_size, os.stat(p).st_mtime_ns] if os.path.exists(p) else None for p in paths]
+            if state is None or state.get('source') != 'csv' or state.get('columns') != columns or state.get('signature') != signature:
+                state = self._reset(table, {'source': 'csv', 'columns': columns, 'signature': None})
+                if signature is None:
+                    print(f"{path} not found, caching an empty {table} table")
+                else:
+                    self._refresh_from_csv(table, path)
+                state['signature'] = signature
+                self._save_state(table, state)
+        self._refreshed.add(table)
+
+    def _committed_ids(self, table, watermark):
+        """
+        Returns the largest id of a table such that every row at or below it is committed, and the number of rows with
+        an id at or below the cached watermark.
+
+        Ids are taken from a sequence before their transaction commits, so an extractor can still commit ids below
+        the largest committed one, which the watermark would then skip for good. A SHARE lock waits for the inserts in
+        progress, and later inserts get larger ids. A user without the privilege to lock the table, like a read-only
+        one, waits instead for the inserts in progress once the largest id is read.
+
+        Rows are only inserted above the watermark, so a count different from the cached rows means rows were deleted,
+        e.g. duplicates removed by migrations.py, or the cache missed rows.
+        """
+        connection = self.db_connector.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(sql.SQL("LOCK TABLE {} IN SHARE MODE").format(sql.Identifier(table)))
+                locked = True
+            except errors.InsufficientPrivilege:
+                connection.rollback()
+                locked = False
+            cursor.execute(sql.SQL("SELECT MAX(id) FROM {}").format(sql.Identifier(table)))
+            max_id = cursor.fetchone()[0]
+            cursor.execute(sql.SQL("SELECT COUNT(*) FROM {} WHERE id <= %s").format(sql.Identifier(table)), (watermark,))
+            row_count = cursor.fetchone()[0]
+            # Transactions writing to the table, any id at or below max_id that is not committed yet belongs to one of them
+            writers_query = (
+                "SELECT ARRAY_AGG(DISTINCT virtualtransaction) FROM pg_locks "
+                "WHERE relation = %s::regclass AND mode = 'RowExclusiveLock' AND granted AND pid <> pg_backend_pid() "
+                "AND virtualtransaction = ANY(COALESCE(%s, ARRAY[virtualtransaction]))"
+            )
+            writers = None
+            while not locked:
+                cursor.execute(writers_query, (table, writers))
+                writers = cursor.fetchone()[0]
+                if not writers:
+                    break
+                time.sleep(1)
+            connection.commit()
+        finally:
+            connection.close()
+        return max_id, row_count
+
+    def _refresh_from_database(self, table, state):
+        """
+        Appends the rows above the watermark, one id range at a time, and moves the watermark after each range. The
+        table is cached again from the start when rows below the watermark were deleted.
+        """
+        max_id, row_count = self._committed_ids(table, state['max_id'])
+        cached_rows = ds.dataset(self._table_dir(table), format='parquet').count_rows()
+        if row_count != cached_rows:
+            print(f"{cached_rows} {table} rows are cached up to id {state['max_id']}, the database holds {row_count}, caching {table} again")
+            state = self._reset(table, {**state, 'max_id': 0})
+        if pd.isna(max_id) or max_id <= state['max_id']:
+            print(f"Cached {table} is up to date")
+            return
+
+        columns = self.columns(table)
+        projection = select_list('t', {'id': 'int64', **columns})
+        if table == 'votes':
+            # Votes are partitioned by the DAO of their proposal, the first proposal row when an id is stored twice
+            query = sql.SQL(
+                "SELECT {}, p.dao_id FROM votes t LEFT JOIN "
+                "(SELECT DISTINCT ON (proposal_id) proposal_id, dao_id FROM proposals ORDER BY proposal_id, id) p ON p.proposal_id = t.proposal_id "
+                "WHERE t.id > %s AND t.id <= %s ORDER BY t.id"
+            ).format(projection)
+        else:
+            query = sql.SQL("SELECT {}, t.dao_id FROM {} t WHERE t.id > %s AND t.id <= %s ORDER BY t.id").format(projection, sql.Identifier(table))
+
+        low = state['max_id']
+        while low < max_id:
+            high = min(low + self.refresh_rows, int(max_id))
+            self._write_rows(table, self.db_connector.query_to_df(query, (low, high)), low + 1, high)
+            state['max_id'] = high
+            self._save_state(table, state)
+            low = high
+
+    def _refresh_from_csv(self, table, path):
+        """Caches a CSV in chunks, the row number takes the place of the id."""
+        columns = self.columns(table)
+        dao_ids = None
+        if table == 'votes':
+            proposals_path = os.path.join(self.data_dir, 'proposals.csv')
+            dao_ids = pd.Series(dtype=object)
+            if os.path.exists(proposals_path):
+                proposals = pd.read_csv(proposals_path, usecols=['proposal_id', 'dao_id'], dtype=str)
+                dao_ids = proposals.drop_duplicates('proposal_id').set_index('proposal_id')['dao_id']
+            usecols = columns
+        else:
+            usecols = {**columns, 'dao_id': str}
+
+        low = 0
+        for chunk in pd.read_csv(path, usecols=list(usecols), dtype=usecols, chunksize=self.refresh_rows):
+            if dao_ids is not None:
+                chunk['dao_id'] = chunk['proposal_id'].map(dao_ids)
+            chunk.insert(0, 'id', range(low + 1, low + len(chunk) + 1))
+            self._write_rows(table, chunk, low + 1, low + len(chunk))
+            low += len(chunk)
+
+    def _write_rows(self, table, df, first_id, last_id):
+        """Writes one id range as a file in each DAO's partition, rewriting the range is idempotent."""
+        schema = self._schema(table)
+        string_columns = [field.name for field in schema if pa.types.is_string(field.type)]
+        file_name = f"part-{first_id:012d}-{last_id:012d}.parquet"
+        for dao_id, dao_df in df.groupby('dao_id', dropna=False, sort=False):
+            partition = NULL_PARTITION if pd.isna(dao_id) else quote(str(dao_id), safe='')
+            partition_dir = os.path.join(self._table_dir(table), f"dao_id={partition}")
+            os.makedirs(partition_dir, exist_ok=True)
+            arrow_table = pa.Table.from_pandas(dao_df[schema.names], schema=schema, preserve_index=False)
+            pq.write_table(arrow_table, os.path.join(partition_dir, file_name), use_dictionary=string_columns)
+        print(f"Cached {len(df)} {table} rows, ids {first_id} to {last_id}")
+
+    def read(self, table, dtypes, dao_ids=None, start_date=None, end_date=None):
+        """
+        Reads columns of a cached table in source order, refreshing it first once per process.
+
+        Only the partitions of the requested DAOs are read.
+
+        Args:
+            table (str): 'proposals' or 'votes'.
+            dtypes (dict): dtype of each column to read, by column name. dao_id can be read as well.
+            dao_ids (list, optional): Only read rows of these DAOs.
+            start_date (str, optional): Only read rows of proposals ending at or after this date.
+            end_date (str, optional): Only read rows of proposals ending before this date.
+
+        Returns:
+            pandas.DataFrame: The rows read.
+        """
+        if table not in self._refreshed:
+            self.refresh(table)
+
+        schema = self._schema(table).append(pa.field('dao_id', pa.string()))
+        dataset = ds.dataset(
+            self._table_dir(table), schema=schema, format='parquet',
+            partitioning=ds.HivePartitioning(pa.schema([('dao_id', pa.string())]), null_fallback=NULL_PARTITION),
+        )
+
+        expression = None
+        conditions = []
+        if dao_ids is not None:
+            conditions.append(ds.field('dao_id').isin(pa.array([str(dao_id) for dao_id in dao_ids], type=pa.string())))
+        if table == 'proposals':
+            if start_date is not None:
+                conditions.append(ds.field('end_date') >= str(start_date))
+            if end_date is not None:
+                conditions.append(ds.field('end_date') < str(end_date))
+        elif start_date is not None or end_date is not None:
+            proposal_ids = self.read('proposals', {'proposal_id': str}, dao_ids, start_date, end_date)['proposal_id']
+            conditions.append(ds.field('proposal_id').isin(pa.array(proposal_ids.dropna().tolist(), type=pa.string())))
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+
+        df = dataset.to_table(columns=['id', *dtypes], filter=expression).to_pandas()
+        df = df.sort_values('id', kind='stable').drop(columns='id').reset_index(drop=True)
+        for column, dtype in dtypes.items():
+            if dtype is not str:
+                df[column] = df[column].astype(dtype)
+        return df
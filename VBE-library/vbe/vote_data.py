@@ -0,0 +1,308 @@
+"""
+This module loads the votes, proposals and DAOs each script needs, with only the columns it uses.
+
+Column sets and dtypes are declared per consumer. From the database, the projection, the DAO and date
+filters and the join of votes to their proposals run in SQL. From CSVs, the same columns are read with
+usecols and a dtype map. Proposals and votes are read from a local VoteCache first when one is given.
+Every load reports its rows, memory and time.
+
+Example usage:
+    loader = VoteDataLoader(db_connector)
+    voter_df = loader.load_table('clustering', 'votes', dao_ids=['aave.eth'])
+    merged_df = loader.load_joined_votes('analytics', start_date='2023-01-01')
+    for batch_df in loader.iter_joined_votes('analytics', order_by=('dao_id', 'voter_address')):
+        ...
+"""
+
+import os
+import time
+import pandas as pd
+from psycopg2 import sql
+
+# Columns and dtypes of each table, by the consumer that loads them
+COLUMN_SETS = {
+    # run_vbe.py and cluster_categories.py
+    'clustering': {
+        'votes': {'proposal_id': str, 'voter_address': str, 'choice': str, 'voting_power': 'float64'},
+        'proposals': {'proposal_id': str, 'dao_id': str, 'proposal_title': str, 'choices': str, 'end_date': str, 'state': str},
+    },
+    # data_analytics.py
+    'analytics': {
+        'votes': {'proposal_id': str, 'voter_address': str, 'choice': str, 'voting_power': 'float64'},
+        'proposals': {'proposal_id': str, 'dao_id': str},
+        'dao': {'dao_id': str, 'dao_name': str},
+        'proposal_stats': {'proposal_id': str},
+    },
+    # snapshot_api.py and tally_api.py, which only check what is already stored
+    'ingestion': {
+        'votes': {'proposal_id': str},
+        'proposals': {'proposal_id': str},
+        'dao': {'dao_id': str},
+    },
+}
+
+# Tables filtered through the DAO and end date of their proposal
+PROPOSAL_CHILD_TABLES = {'votes', 'proposal_stats'}
+
+
+def select_list(alias, dtypes):
+    """
+    Builds the SELECT list of a table's columns.
+
+    Text columns are cast to text, so dates stored as timestamps are read as the same sortable
+    ISO strings as dates stored as text.
+
+    Args:
+        alias (str): Alias of the table in the query.
+        dtypes (dict): dtype of each column, by column name.
+
+    Returns:
+        psycopg2.sql.Composed: The comma separated columns.
+    """
+    return sql.SQL(', ').join(
+        sql.SQL("CAST({} AS TEXT) AS {}").format(sql.Identifier(alias, column), sql.Identifier(column)) if dtype is str else sql.Identifier(alias, column)
+        for column, dtype in dtypes.items()
+    )
+
+
+class VoteDataLoader:
+    """
+    Loads tables from the database, or from CSVs when no database is given, projected to a consumer's columns.
+
+    Attributes:
+        db_connector (DatabaseHandler): Database to read from, or None to read CSV files.
+        data_dir (str): Directory of the CSV files, named after their table.
+        cache (VoteCache): Local copy the proposals and votes are read from first, or None to read the source.
+    """
+    def __init__(self, db_connector=None, data_dir='../data_output', cache=None):
+        self.db_connector = db_connector
+        self.data_dir = data_dir
+        self.cache = cache
+
+    @staticmethod
+    def columns(consumer, table):
+        """
+        Returns the columns and dtypes a consumer uses from a table.
+
+        Args:
+            consumer (str): A key of COLUMN_SETS.
+            table (str): The table name.
+
+        Returns:
+            dict: dtype of each column, by column name.
+        """
+        if consumer not in COLUMN_SETS:
+            raise ValueError(f"Unknown consumer {consumer}, expected one of {', '.join(COLUMN_SETS)}")
+        if table not in COLUMN_SETS[consumer]:
+            raise ValueError(f"Consumer {consumer} does not load table {table}")
+        return COLUMN_SETS[consumer][table]
+
+    def load_table(self, consumer, table, dao_ids=None, start_date=None, end_date=None, distinct=False):
+        """
+        Loads one table with the columns a consumer uses.
+
+        Args:
+            consumer (str): A key of COLUMN_SETS.
+            table (str): The table name.
+            dao_ids (list, optional): Only load rows of these DAOs.
+            start_date (str, optional): Only load rows of proposals ending at or after this date.
+            end_date (str, optional): Only load rows of proposals ending before this date.
+            distinct (bool, optional): Drop duplicate rows, in the database when reading from it.
+
+        Returns:
+            pandas.DataFrame: The projected rows.
+        """
+        start_time = time.perf_counter()
+        df = self._load(table, self.columns(consumer, table), dao_ids, start_date, end_date, distinct)
+        self._report(table, df, start_time, self._source(table))
+        return df
+
+    def _source(self, table):
+        if self.cache is not None and table in self.cache.TABLES:
+            return 'cache'
+        return 'database' if self.db_connector is not None else 'CSV'
+
+    def _load(self, table, dtypes, dao_ids=None, start_date=None, end_date=None, distinct=False):
+        """Loads the columns of a table from the cache, the database or the CSV, in that order."""
+        source = self._source(table)
+        if source == 'cache':
+            df = self.cache.read(table, dtypes, dao_ids, start_date, end_date)
+            if distinct:
+                df = df.drop_duplicates(ignore_index=True)
+        elif source == 'database':
+            alias = 'p' if table == 'proposals' else 't'
+            query = sql.SQL("SELECT {}{} FROM {} {}").format(
+                sql.SQL("DISTINCT ") if distinct else sql.SQL(""),
+                select_list(alias, dtypes),
+                sql.Identifier(table),
+                sql.Identifier(alias),
+            )
+            where, params = self._filters(table, alias, dao_ids, start_date, end_date)
+            df = self._cast(self.db_connector.query_to_df(query + where, params), dtypes)
+        else:
+            df = self._read_csv(table, dtypes)
+            df = df[self._csv_mask(df, table, dao_ids, start_date, end_date)].reset_index(drop=True)
+            if distinct:
+                df = df.drop_duplicates(ignore_index=True)
+        return df
+
+    def load_joined_votes(self, consumer, dao_ids=None, start_date=None, end_date=None):
+        """
+        Loads votes left joined to their proposal, and to the proposal's DAO when the consumer uses DAO columns.
+
+        Columns of a joined table that are already in the votes are taken from the votes, as with
+        pd.merge suffixes dropped afterwards.
+
+        Args:
+            consumer (str): A key of COLUMN_SETS.
+            dao_ids (list, optional): Only load votes on proposals of these DAOs.
+            start_date (str, optional): Only load votes on proposals ending at or after this date.
+            end_date (str, optional): Only load votes on proposals ending before this date.
+
+        Returns:
+            pandas.DataFrame: One row per vote and matching proposal and DAO.
+        """
+        vote_dtypes, proposal_dtypes, dao_dtypes = self._joined_dtypes(consumer)
+        start_time = time.perf_counter()
+        if self._source('votes') == 'database':
+            query, params = self._joined_query(vote_dtypes, proposal_dtypes, dao_dtypes, dao_ids, start_date, end_date)
+            df = self._cast(self.db_connector.query_to_df(query, params), {**vote_dtypes, **proposal_dtypes, **dao_dtypes})
+        else:
+            # Votes and proposals are joined locally when they come from the cache or the CSVs
+            proposal_df = self._load('proposals', {'proposal_id': str, **proposal_dtypes}, dao_ids, start_date, end_date)
+            df = pd.merge(self._load('votes', vote_dtypes, dao_ids, start_date, end_date), proposal_df, how='left', on='proposal_id')
+            if dao_dtypes:
+                dao_df = self._load('dao', {'dao_id': str, **dao_dtypes})
+                df = pd.merge(df, dao_df, how='left', on='dao_id')
+        self._report('votes joined to proposals', df, start_time, self._source('votes'))
+        return df
+
+    def iter_joined_votes(self, consumer, batch_size=100000, order_by=(), partition=None, dao_ids=None, start_date=None, end_date=None):
+        """
+        Streams the votes joined as in load_joined_votes from the database, in batches.
+
+        Args:
+            consumer (str): A key of COLUMN_SETS.
+            batch_size (int, optional): Number of votes per batch.
+            order_by (tuple, optional): Columns of the joined votes to sort by, in the database.
+            partition (tuple, optional): Only stream the votes of the DAOs hashed to partition k of n, given
+                as (k, n), so parallel workers can each stream a disjoint set of DAOs. Votes without a DAO
+                are in one of the partitions.
+            dao_ids (list, optional): Only stream votes on proposals of these DAOs.
+            start_date (str, optional): Only stream votes on proposals ending at or after this date.
+            end_date (str, optional): Only stream votes on proposals ending before this date.
+
+        Yields:
+            pandas.DataFrame: Up to batch_size joined votes.
+        """
+        if self.db_connector is None:
+            raise ValueError("Votes can only be streamed from the database")
+        vote_dtypes, proposal_dtypes, dao_dtypes = self._joined_dtypes(consumer)
+        query, params = self._joined_query(vote_dtypes, proposal_dtypes, dao_dtypes, dao_ids, start_date, end_date, partition)
+        if order_by:
+            query += sql.SQL(" ORDER BY {}").format(sql.SQL(', ').join(sql.Identifier(column) for column in order_by))
+        for df in self.db_connector.iter_query(query, params, batch_size):
+            yield self._cast(df, {**vote_dtypes, **proposal_dtypes, **dao_dtypes})
+
+    def _joined_dtypes(self, consumer):
+        """Splits a consumer's columns of the joined votes by the table they are taken from."""
+        vote_dtypes = self.columns(consumer, 'votes')
+        proposal_dtypes = {column: dtype for column, dtype in self.columns(consumer, 'proposals').items() if column not in vote_dtypes}
+        dao_dtypes = {}
+        if 'dao' in COLUMN_SETS[consumer]:
+            dao_dtypes = {column: dtype for column, dtype in self.columns(consumer, 'dao').items() if column not in vote_dtypes and column not in proposal_dtypes}
+        return vote_dtypes, proposal_dtypes, dao_dtypes
+
+    def _joined_query(self, vote_dtypes, proposal_dtypes, dao_dtypes, dao_ids, start_date, end_date, partition=None):
+        """Builds the query of the votes left joined to their proposal and DAO, with the filters applied to the proposal."""
+        columns = [select_list('v', vote_dtypes)]
+        joins = sql.SQL(" LEFT JOIN {} p ON p.{} = v.{}").format(sql.Identifier('proposals'), sql.Identifier('proposal_id'), sql.Identifier('proposal_id'))
+        if proposal_dtypes:
+            columns.append(select_list('p', proposal_dtypes))
+        if dao_dtypes:
+            columns.append(select_list('d', dao_dtypes))
+            joins += sql.SQL(" LEFT JOIN {} d ON d.{} = p.{}").format(sql.Identifier('dao'), sql.Identifier('dao_id'), sql.Identifier('dao_id'))
+        where, params = self._filters('proposals', 'p', dao_ids, start_date, end_date)
+        if partition is not None:
+            k, n = partition
+            # hashtext is a signed 32 bit hash, shifted to be non-negative before taking the remainder
+            condition = sql.SQL("MOD(hashtext(COALESCE({}, '')::TEXT)::BIGINT + 2147483648, %s) = %s").format(sql.Identifier('p', 'dao_id'))
+            where = (where + sql.SQL(" AND ") if params else sql.SQL(" WHERE ")) + condition
+            params = (*(params or ()), n, k)
+        query = sql.SQL("SELECT {} FROM {} v").format(sql.SQL(', ').join(columns), sql.Identifier('votes')) + joins + where
+        return query, params
+
+    def _filters(self, table, alias, dao_ids, start_date, end_date):
+        """Builds the WHERE clause for the DAO and date filters, through the proposals table when needed."""
+        conditions = []
+        params = []
+        if table == 'dao':
+            if dao_ids is not None:
+                conditions.append(sql.SQL("{} = ANY(%s)").format(sql.Identifier(alias, 'dao_id')))
+                params.append([str(dao_id) for dao_id in dao_ids])
+            if start_date is not None or end_date is not None:
+                raise ValueError("The dao table cannot be filtered by date")
+        else:
+            proposal_alias = alias if table == 'proposals' else 'p'
+            if dao_ids is not None:
+                conditions.append(sql.SQL("{} = ANY(%s)").format(sql.Identifier(proposal_alias, 'dao_id')))
+                params.append([str(dao_id) for dao_id in dao_ids])
+            # Dates are stored as timestamps or ISO formatted text, both compare in date order
+            if start_date is not None:
+                conditions.append(sql.SQL("{} >= %s").format(sql.Identifier(proposal_alias, 'end_date')))
+                params.append(str(start_date))
+            if end_date is not None:
+                conditions.append(sql.SQL("{} < %s").format(sql.Identifier(proposal_alias, 'end_date')))
+                params.append(str(end_date))
+            if conditions and table in PROPOSAL_CHILD_TABLES:
+                subquery = sql.SQL("SELECT {} FROM {} p WHERE {}").format(
+                    sql.Identifier('p', 'proposal_id'), sql.Identifier('proposals'), sql.SQL(' AND ').join(conditions)
+                )
+                conditions = [sql.SQL("{} IN ({})").format(sql.Identifier(alias, 'proposal_id'), subquery)]
+
+        if not conditions:
+            return sql.SQL(""), None
+        return sql.SQL(" WHERE ") + sql.SQL(' AND ').join(conditions), tuple(params)
+
+    def _csv_mask(self, df, table, dao_ids, start_date, end_date):
+        """Applies the DAO and date filters to a table read from CSV, through the proposals CSV when needed."""
+        mask = pd.Series(True, index=df.index)
+        if dao_ids is None and start_date is None and end_date is None:
+            return mask
+        if table == 'dao':
+            if start_date is not None or end_date is not None:
+                raise ValueError("The dao table cannot be filtered by date")
+            return df['dao_id'].isin([str(dao_id) for dao_id in dao_ids])
+
+        proposal_df = df if table == 'proposals' else self._read_csv('proposals', {'proposal_id': str, 'dao_id': str, 'end_date': str})
+        proposal_mask = pd.Series(True, index=proposal_df.index)
+        if dao_ids is not None:
+            proposal_mask &= proposal_df['dao_id'].isin([str(dao_id) for dao_id in dao_ids])
+        if start_date is not None:
+            proposal_mask &= proposal_df['end_date'] >= str(start_date)
+        if end_date is not None:
+            proposal_mask &= proposal_df['end_date'] < str(end_date)
+        if table == 'proposals':
+            return proposal_mask
+        return df['proposal_id'].isin(proposal_df.loc[proposal_mask, 'proposal_id'])
+
+    def _read_csv(self, table, dtypes):
+        """Reads the projected columns of a table's CSV, an empty frame if the file does not exist."""
+        path = os.path.join(self.data_dir, f'{table}.csv')
+        if not os.path.exists(path):
+            print(f"{path} not found, loading an empty {table} table")
+            return pd.DataFrame({column: pd.Series(dtype=object if dtype is str else dtype) for column, dtype in dtypes.items()})
+        return pd.read_csv(path, usecols=list(dtypes), dtype=dtypes)[list(dtypes)]
+
+    @staticmethod
+    def _cast(df, dtypes):
+        """Casts numeric columns read from the database, text columns are already strings or None."""
+        for column, dtype in dtypes.items():
+            if dtype is not str:
+                df[column] = pd.to_numeric(df[column], errors='coerce').astype(dtype)
+        return df
+
+    @staticmethod
+    def _report(name, df, start_time, source):
+        memory = df.memory_usage(deep=True).sum() / 1024 ** 2
+        print(f"Loaded {name} from {source}: {len(df)} rows, {len(df.columns)} columns, {memory:.1f} MB in {time.perf_counter() - start_time:.2f}s")
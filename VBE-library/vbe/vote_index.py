@@ -0,0 +1,135 @@
+"""
+This module contains the VoteIndex class, which groups a votes table by proposal so that the votes
+of any proposal, window of proposals or DAO can be fetched as slices instead of scanning the whole table.
+
+Example usage:
+    vote_index = VoteIndex(voter_df, proposal_df)
+    window_votes = vote_index.votes.iloc[vote_index.rows(proposal_ids)]
+    dao_votes = vote_index.dao_votes('ens.eth')
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def expand_ranges(starts, counts):
+    """Returns the indices covered by the ranges [start, start + count), in order."""
+    starts = np.asarray(starts, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + np.arange(counts.sum()) - offsets
+
+
+class VoteIndex:
+    """
+    Votes sorted by DAO and proposal, with CSR-style offset arrays over the sorted table.
+
+    The votes of proposal code p are rows offsets[p]:offsets[p + 1] of votes, and the proposals
+    of DAO code d are codes dao_offsets[d]:dao_offsets[d + 1]. Votes keep their original order
+    within a proposal.
+
+    Attributes:
+        votes (pandas.DataFrame): The votes, sorted by DAO and proposal, with a fresh RangeIndex.
+        proposal_ids (pd.Index): Proposal ID of each proposal code.
+        offsets (np.ndarray): Row offsets of each proposal code, of length len(proposal_ids) + 1.
+        dao_ids (pd.Index): DAO ID of each DAO code. Proposals without a known DAO come after every DAO.
+        dao_offsets (np.ndarray): Proposal code offsets of each DAO code, of length len(dao_ids) + 1.
+    """
+    def __init__(self, voter_df, proposal_df=None):
+        """
+        Args:
+            voter_df (pandas.DataFrame): Votes with a 'proposal_id' column, and optionally a 'dao_id' column.
+            proposal_df (pandas.DataFrame, optional): Proposals with 'proposal_id' and 'dao_id' columns, used to
+                group the votes by DAO when voter_df has no 'dao_id' column.
+        """
+        vote_proposals, proposal_ids = pd.factorize(voter_df['proposal_id'], sort=True)
+
+        # DAO of each proposal, from the votes themselves or from the proposals table
+        if 'dao_id' in voter_df.columns:
+            proposal_daos = pd.Series(voter_df['dao_id'].to_numpy()).groupby(vote_proposals).first()
+            proposal_daos = proposal_daos.reindex(range(len(proposal_ids)))
+        elif proposal_df is not None:
+            dao_map = proposal_df.drop_duplicates('proposal_id').set_index('proposal_id')['dao_id']
+            proposal_daos = pd.Series(proposal_ids.map(dao_map))
+        else:
+            proposal_daos = pd.Series([np.nan] * len(proposal_ids), dtype=object)
+        dao_codes, dao_ids = pd.factorize(proposal_daos, sort=True)
+        dao_codes = np.where(dao_codes < 0, len(dao_ids), dao_codes)
+
+        # Proposal codes are renumbered so that each DAO's proposals are consecutive
+        proposal_order = np.lexsort((np.arange(len(proposal_ids)), dao_codes))
+        proposal_rank = np.empty(len(proposal_ids), dtype=np.int64)
+        proposal_rank[proposal_order] = np.arange(len(proposal_ids))
+        vote_codes = np.where(vote_proposals < 0, len(proposal_ids), proposal_rank[np.maximum(vote_proposals, 0)])
+
+        # Votes without a proposal ID sort last and belong to no proposal
+        row_order = np.argsort(vote_codes, kind='stable')
+        self.votes = voter_df.take(row_order).reset_index(drop=True)
+        self.proposal_ids = proposal_ids[proposal_order]
+        self.offsets = np.searchsorted(vote_codes[row_order], np.arange(len(proposal_ids) + 1))
+        self.dao_ids = dao_ids
+        self.dao_offsets = np.searchsorted(dao_codes[proposal_order], np.arange(len(dao_ids) + 1))
+
+    @classmethod
+    def from_arrays(cls, proposal_ids, offsets, dao_ids, dao_offsets):
+        """
+        Rebuilds an index from its offset arrays, without the votes table, e.g. in a worker process
+        that only slices arrays aligned with the votes.
+        """
+        vote_index = cls.__new__(cls)
+        vote_index.votes = None
+        vote_index.proposal_ids = proposal_ids
+        vote_index.offsets = offsets
+        vote_index.dao_ids = dao_ids
+        vote_index.dao_offsets = dao_offsets
+        return vote_index
+
+    def _dao_code(self, dao_id):
+        if pd.isna(dao_id):
+            return -1
+        return self.dao_ids.get_indexer([dao_id])[0]
+
+    def locate(self, proposal_ids):
+        """Returns the proposal code of each proposal ID, -1 for proposals without votes."""
+        return self.proposal_ids.get_indexer(list(proposal_ids))
+
+    def ranges(self, proposal_ids):
+        """
+        Returns the row range of each proposal in the sorted votes table.
+
+        Args:
+            proposal_ids (list): Proposal IDs, which may repeat or have no votes.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: First row and number of votes of each proposal.
+        """
+        codes = self.locate(proposal_ids)
+        known = codes >= 0
+        starts = np.where(known, self.offsets[np.maximum(codes, 0)], 0)
+        counts = np.where(known, self.offsets[np.maximum(codes, 0) + 1] - starts, 0)
+        return starts, counts
+
+    def rows(self, proposal_ids):
+        """Returns the rows of the sorted votes table that belong to the given proposals, proposal by proposal."""
+        return expand_ranges(*self.ranges(proposal_ids))
+
+    def proposal_votes(self, proposal_id):
+        """Returns the votes of a single proposal as a slice of the sorted votes table."""
+        starts, counts = self.ranges([proposal_id])
+        return self.votes.iloc[starts[0]:starts[0] + counts[0]]
+
+    def dao_votes(self, dao_id):
+        """Returns the votes of every proposal of a DAO as a slice of the sorted votes table."""
+        dao_code = self._dao_code(dao_id)
+        if dao_code < 0:
+            return self.votes.iloc[0:0]
+        first = self.offsets[self.dao_offsets[dao_code]]
+        last = self.offsets[self.dao_offsets[dao_code + 1]]
+        return self.votes.iloc[first:last]
+
+    def dao_proposal_ids(self, dao_id):
+        """Returns the IDs of a DAO's proposals that have votes."""
+        dao_code = self._dao_code(dao_id)
+        if dao_code < 0:
+            return self.proposal_ids[:0]
+        return self.proposal_ids[self.dao_offsets[dao_code]:self.dao_offsets[dao_code + 1]]
@@ -0,0 +1,328 @@
+"""
+This module builds the voter x proposal choice matrices that are clustered for each VBE window.
+
+Voters are encoded to integer codes once for the whole votes table and the votes of a window are
+sliced out of a VoteIndex, so a window is assembled directly as a sparse matrix instead of through
+a cross product, merge and pivot_table.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from vote_index import expand_ranges
+
+
+def assemble_window(voters, slots, choices, voting_power, n_slots):
+    """
+    Assembles the choice matrix for the votes of a single window.
+
+    Rows follow the same rules as the original pivot_table path: one row per distinct
+    (voter, voting_power) pair, where missing voting power is filled with the voter's mean
+    voting power in the window, and voters that skipped a proposal get an extra row at
+    their mean voting power. Rows are ordered by voter code, then voting power.
+
+    Args:
+        voters (np.ndarray): Voter code of each vote.
+        slots (np.ndarray): Column (0 to n_slots - 1) of the proposal each vote belongs to.
+        choices (np.ndarray): Choice position of each vote.
+        voting_power (np.ndarray): Voting power of each vote, NaN where missing.
+        n_slots (int): Number of proposals in the window.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, scipy.sparse.csr_matrix]: The voter code and voting power
+        of each row, and the choice matrix of shape (rows, n_slots).
+    """
+    local_voters, voter_idx = np.unique(voters, return_inverse=True)
+    n_voters = len(local_voters)
+
+    # Mean voting power per voter over the votes that have one
+    has_vp = ~np.isnan(voting_power)
+    vp_sum = np.bincount(voter_idx[has_vp], weights=voting_power[has_vp], minlength=n_voters)
+    vp_count = np.bincount(voter_idx[has_vp], minlength=n_voters)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vp_mean = vp_sum / vp_count
+    filled_vp = np.where(has_vp, voting_power, vp_mean[voter_idx])
+
+    # Voters that did not vote on every proposal get a row at their mean voting power
+    present = np.zeros((n_voters, n_slots), dtype=bool)
+    present[voter_idx, slots] = True
+    missing = np.flatnonzero(~present.all(axis=1))
+
+    return _rows_from_entries(local_voters, voter_idx, filled_vp, slots, choices, missing, vp_mean, n_slots)
+
+
+def _rows_from_entries(local_voters, voter_idx, filled_vp, slots, choices, missing, vp_mean, n_slots):
+    n_votes = len(voter_idx)
+    row_voter = np.concatenate([voter_idx, missing])
+    row_vp = np.concatenate([filled_vp, vp_mean[missing]])
+
+    # Voters without any voting power are dropped, as pivot_table drops NaN index values
+    keep = np.flatnonzero(~np.isnan(row_vp))
+    order = keep[np.lexsort((row_vp[keep], row_voter[keep]))]
+    sorted_voter = row_voter[order]
+    sorted_vp = row_vp[order]
+    is_new_row = np.ones(len(order), dtype=bool)
+    is_new_row[1:] = (sorted_voter[1:] != sorted_voter[:-1]) | (sorted_vp[1:] != sorted_vp[:-1])
+    row_ids = np.cumsum(is_new_row) - 1
+    n_rows = int(row_ids[-1]) + 1 if len(row_ids) else 0
+
+    # Each vote lands in its (row, proposal) cell, duplicates are averaged like pivot_table does
+    entry_row = np.full(len(row_voter), -1, dtype=np.int64)
+    entry_row[order] = row_ids
+    vote_rows = entry_row[:n_votes]
+    counted = vote_rows >= 0
+    shape = (n_rows, n_slots)
+    sums = sparse.csr_matrix((choices[counted], (vote_rows[counted], slots[counted])), shape=shape)
+    counts = sparse.csr_matrix((np.ones(counted.sum()), (vote_rows[counted], slots[counted])), shape=shape)
+    matrix = sums.multiply(counts.power(-1)).tocsr() if counts.nnz else sums
+
+    return local_voters[sorted_voter[is_new_row]], sorted_vp[is_new_row], matrix
+
+
+class VoteMatrixBuilder:
+    """
+    Encodes a votes table once and builds the training matrix of any window of proposals from it.
+
+    Attributes:
+        vote_index (VoteIndex): The votes, grouped by proposal. Arrays below are aligned with vote_index.votes.
+        voter_addresses (pd.Index): Sorted voter addresses, indexed by voter code.
+    """
+    def __init__(self, vote_index):
+        """
+        Args:
+            vote_index (VoteIndex): Votes with 'voter_address', 'proposal_id', 'choice_position'
+                and 'voting_power' columns.
+        """
+        votes = vote_index.votes
+        self.vote_index = vote_index
+        # Votes without a voter address get code -1 and can never form a row
+        self.voter_codes, self.voter_addresses = pd.factorize(votes['voter_address'], sort=True)
+        self.choice_positions = votes['choice_position'].to_numpy(dtype=np.float64)
+        self.voting_power = pd.to_numeric(votes['voting_power'], errors='coerce').to_numpy(dtype=np.float64)
+
+    @classmethod
+    def from_arrays(cls, vote_index, voter_codes, voter_addresses, choice_positions, voting_power):
+        """Rebuilds a builder from its encoded arrays, e.g. arrays mapped from shared memory in a worker process."""
+        matrix_builder = cls.__new__(cls)
+        matrix_builder.vote_index = vote_index
+        matrix_builder.voter_codes = voter_codes
+        matrix_builder.voter_addresses = voter_addresses
+        matrix_builder.choice_positions = choice_positions
+        matrix_builder.voting_power = voting_power
+        return matrix_builder
+
+    def window_votes(self, proposal_ids):
+        """
+        Returns the rows of the votes of the given proposals that have a voter address.
+
+        Args:
+            proposal_ids (list): Proposal IDs, which may repeat or have no votes.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Row of each vote in vote_index.votes, and the position in
+            proposal_ids of the proposal it belongs to. Votes are grouped by position.
+        """
+        starts, counts = self.vote_index.ranges(proposal_ids)
+        rows = expand_ranges(starts, counts)
+        positions = np.repeat(np.arange(len(counts)), counts)
+        known = self.voter_codes[rows] >= 0
+        return rows[known], positions[known]
+
+    def build_matrix(self, proposal_ids):
+        """
+        Builds the sparse choice matrix for a window of proposals.
+
+        Args:
+            proposal_ids (list): Proposal IDs in the window.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, scipy.sparse.csr_matrix, list]: Voter codes and voting power of
+            each row, the choice matrix, and the proposal IDs of its columns. None if the window has no votes.
+        """
+        columns = sorted(set(proposal_ids))
+        in_window, vote_slots = self.window_votes(columns)
+        if len(in_window) == 0:
+            return None
+
+        row_voters, row_vp, matrix = assemble_window(
+            self.voter_codes[in_window],
+            vote_slots,
+            self.choice_positions[in_window],
+            self.voting_power[in_window],
+            len(columns),
+        )
+        if len(row_voters) == 0:
+            return None
+        return row_voters, row_vp, matrix, columns
+
+    def to_training_df(self, row_voters, row_vp, matrix, columns):
+        """
+        Converts a window matrix, sparse or dense, into the training DataFrame used for clustering.
+
+        Returns:
+            pandas.DataFrame: 'voter_address' and 'voting_power' columns followed by one choice column per proposal.
+        """
+        values = matrix.toarray() if sparse.issparse(matrix) else matrix
+        training_df = pd.DataFrame(values, columns=columns)
+        training_df.insert(0, 'voting_power', row_vp)
+        training_df.insert(0, 'voter_address', self.voter_addresses[row_voters])
+        return training_df
+
+    def build(self, proposal_ids):
+        """
+        Builds the training DataFrame for a window of proposals.
+
+        Args:
+            proposal_ids (list): Proposal IDs in the window.
+
+        Returns:
+            pandas.DataFrame: The training DataFrame, or None if the window has no votes.
+        """
+        window = self.build_matrix(proposal_ids)
+        if window is None:
+            return None
+        return self.to_training_df(*window)
+
+
+class SlidingWindowMatrix:
+    """
+    Builds the training matrices of windows that slide one proposal at a time over an ordered list of proposals.
+
+    The current window is kept as a rolling buffer with one column per proposal. Moving to the next
+    window drops the column of the proposal that leaves and fills the column of the proposal that
+    enters, and only the rows of voters who voted on either of those two proposals are recomputed.
+    A step therefore costs O(votes in one proposal) plus copying the buffer, instead of rebuilding
+    the window from all of its votes.
+
+    Attributes:
+        proposal_ids (list): Proposal IDs in the order the windows slide over them.
+        window_size (int): Number of proposals in each window.
+        voters (np.ndarray): Voter codes of everyone who voted on these proposals, sorted.
+    """
+    def __init__(self, matrix_builder, proposal_ids, window_size):
+        """
+        Args:
+            matrix_builder (VoteMatrixBuilder): The encoded votes table.
+            proposal_ids (list): Proposal IDs in window order, e.g. sorted by end date.
+            window_size (int): Number of proposals in each window.
+        """
+        self.builder = matrix_builder
+        self.proposal_ids = list(proposal_ids)
+        self.window_size = window_size
+
+        # Slice the votes of each position out of the index, a proposal listed twice gets its votes at both positions
+        self._n_positions = len(self.proposal_ids)
+        rows, vote_positions = matrix_builder.window_votes(self.proposal_ids)
+        self.voters, vote_voters = np.unique(matrix_builder.voter_codes[rows], return_inverse=True)
+
+        # Lay the votes out by position, sorted by voter within each position...
+        by_position = np.lexsort((vote_voters, vote_positions))
+        self._position_offsets = np.searchsorted(vote_positions[by_position], np.arange(self._n_positions + 1))
+        self._position_voters = vote_voters[by_position]
+
+        # ...and by voter, so a voter's votes in any window are one contiguous range
+        by_voter = np.lexsort((vote_positions, vote_voters))
+        self._voter_keys = vote_voters[by_voter] * self._n_positions + vote_positions[by_voter]
+        self._voter_positions = vote_positions[by_voter]
+        self._voter_vp = matrix_builder.voting_power[rows[by_voter]]
+        self._voter_choices = matrix_builder.choice_positions[rows[by_voter]]
+
+        self._start = None
+        self._slot_counts = np.zeros(len(self.voters), dtype=np.int64)
+        self._row_voters = np.empty(0, dtype=np.int64)
+        self._row_vp = np.empty(0, dtype=np.float64)
+        self._cells = np.empty((0, window_size), dtype=np.float64)
+
+    def _position_voter_set(self, position):
+        voters = self._position_voters[self._position_offsets[position]:self._position_offsets[position + 1]]
+        return voters[np.r_[True, voters[1:] != voters[:-1]]] if len(voters) else voters
+
+    def _reset(self, start):
+        self._start = start
+        self._slot_counts[:] = 0
+        self._row_voters = self._row_voters[:0]
+        self._row_vp = self._row_vp[:0]
+        self._cells = self._cells[:0]
+        for position in range(start, start + self.window_size):
+            self._slot_counts[self._position_voter_set(position)] += 1
+        self._refresh(np.flatnonzero(self._slot_counts))
+
+    def _step(self):
+        leaving = self._position_voter_set(self._start)
+        entering = self._position_voter_set(self._start + self.window_size)
+        self._slot_counts[leaving] -= 1
+        self._slot_counts[entering] += 1
+        self._start += 1
+        self._refresh(np.union1d(leaving, entering))
+
+    def _refresh(self, touched):
+        """Recomputes the rows of the given voters from their votes in the current window."""
+        window_size = self.window_size
+
+        # Drop the current rows of the touched voters
+        lower = np.searchsorted(self._row_voters, touched, side='left')
+        upper = np.searchsorted(self._row_voters, touched, side='right')
+        kept = np.ones(len(self._row_voters), dtype=bool)
+        kept[expand_ranges(lower, upper - lower)] = False
+        row_voters, row_vp, cells = self._row_voters[kept], self._row_vp[kept], self._cells[kept]
+
+        # Gather their votes in the window, each proposal keeps its column of the rolling buffer
+        first_key = touched * self._n_positions + self._start
+        left = np.searchsorted(self._voter_keys, first_key, side='left')
+        counts = np.searchsorted(self._voter_keys, first_key + window_size, side='left') - left
+        votes = expand_ranges(left, counts)
+
+        if len(votes):
+            voter_idx = np.repeat(np.arange(len(touched)), counts)
+            slots = self._voter_positions[votes] % window_size
+            voting_power = self._voter_vp[votes]
+
+            has_vp = ~np.isnan(voting_power)
+            vp_sum = np.bincount(voter_idx[has_vp], weights=voting_power[has_vp], minlength=len(touched))
+            vp_count = np.bincount(voter_idx[has_vp], minlength=len(touched))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                vp_mean = vp_sum / vp_count
+            filled_vp = np.where(has_vp, voting_power, vp_mean[voter_idx])
+            touched_slots = self._slot_counts[touched]
+            missing = np.flatnonzero((touched_slots > 0) & (touched_slots < window_size))
+
+            new_voters, new_vp, new_cells = _rows_from_entries(
+                touched, voter_idx, filled_vp, slots, self._voter_choices[votes], missing, vp_mean, window_size
+            )
+            insert_at = np.searchsorted(row_voters, new_voters)
+            row_voters = np.insert(row_voters, insert_at, new_voters)
+            row_vp = np.insert(row_vp, insert_at, new_vp)
+            cells = np.insert(cells, insert_at, new_cells.toarray(), axis=0)
+
+        self._row_voters, self._row_vp, self._cells = row_voters, row_vp, cells
+
+    def build(self, start):
+        """
+        Builds the training DataFrame of the window starting at the given position.
+
+        Moving forward by less than a window reuses the current buffer, any other move rebuilds it.
+
+        Args:
+            start (int): Position of the first proposal of the window in proposal_ids.
+
+        Returns:
+            pandas.DataFrame: The training DataFrame, or None if the window has no votes.
+        """
+        if self._start is not None and 0 <= start - self._start < self.window_size:
+            while self._start < start:
+                self._step()
+        else:
+            self._reset(start)
+
+        if len(self._row_voters) == 0:
+            return None
+
+        positions = range(start, start + self.window_size)
+        columns = sorted(positions, key=lambda position: self.proposal_ids[position])
+        return self.builder.to_training_df(
+            self.voters[self._row_voters],
+            self._row_vp,
+            self._cells[:, [position % self.window_size for position in columns]],
+            [self.proposal_ids[position] for position in columns],
+        )